@@ -3,9 +3,10 @@
 
 import adsk.core, adsk.fusion, adsk.cam, traceback
 import subprocess
-import cmath, math
 import sys, os, platform
 import inspect
+import json
+import threading
 
 #Use the below three lines if you get error "ModuleNotFoundError: No module named 'numpy'". They may not work on Mac.
 # import subprocess
@@ -39,6 +40,14 @@ try:
 finally:
     del sys.path[-1]
 
+# Export stages that do not need Fusion. See exportEngine.py
+sys.path.append(script_dir)
+try:
+    import exportEngine
+    import exportManifest
+finally:
+    del sys.path[-1]
+
 
 _app = adsk.core.Application.cast(None)
 _ui = adsk.core.UserInterface.cast(None)
@@ -67,15 +76,60 @@ _bedSizeY = 235
 _temperature = 200
 _bedTemperature = 60
 
+# Rotate the ring the short way and merge its moves. False gives one rotation per thread segment as drawn
+_planRingMoves = True
+
+# Slice each anchor shape once and move its g-code to the copies of it at other positions. False slices every anchor
+_reuseAnchorSlices = True
+
+# Print the anchor layers of every layer in the order with the least travel. False keeps the selection order
+_orderAnchors = True
+
+# Lay thread blocks with nothing printed between them under one tool change, without the over-rotation and bed
+# centering between them. False gives every thread block its own T1/T0
+_batchThreads = True
+
+# Merge nearly collinear extrusion moves of the body and anchors, and replace moves along a circle with G2/G3 arcs
+_mergeSegments = False
+_fitArcs = False
+
+# Smaller output: compact g-code (rounded coordinates, no repeated words or comments) and output-all.gcode.gz
+_compactOutput = False
+_gzipOutput = False
+
+# Write output-thread-tmp.gcode, output-body-tmp.gcode and output-anchorN-tmp.gcode for debugging
+_keepTmpFiles = False
+
+# Write export-report.json and export-report.txt with the time of every stage. _profile adds a cProfile dump
+_writeReport = True
+_profile = False
+
+# Skip stl export and slicing of bodies and anchors that did not change since the last export
+_incremental = True
+_manifest = None
+_stlFingerprints = {}   # stl path -> fingerprint of the body it was exported from
+
 # To combine three g-code files
 # _threadZPoints = [0.0]
 
 # Thread coordinates
 _lines = []
 
+# G-code passed from one stage to the next. Thread g-code as bytes, body and anchors as exportEngine GcodeFile
+_threadGcode = None
+_bodyGcode = None
+_anchorGcodes = None
+
 # Keep track of selected anchors and thread lines
 _numOfLinesAndAnchors = 20
 
+# Slicing and the g-code stages run on a worker thread after the Fusion API calls are done. The worker posts progress
+# and messages as custom events, which Fusion hands to ExportEventHandler on the UI thread.
+_exportEventId = 'rhapsoExportEvent'
+_exportWorker = None
+_progressDialog = None
+_terminateWhenDone = False
+
 
 def run(context):
     ui = None
@@ -83,6 +137,14 @@ def run(context):
         global _app, _ui
         _app = adsk.core.Application.get()
         _ui  = _app.userInterface
+        exportEngine.showMessage = _ui.messageBox
+
+        # Connect to the events of the export worker thread
+        _app.unregisterCustomEvent(_exportEventId)
+        exportEvent = _app.registerCustomEvent(_exportEventId)
+        onExportEvent = ExportEventHandler()
+        exportEvent.add(onExportEvent)
+        _handlers.append(onExportEvent)
 
         # Create the command definition. 
         cmdDef = _ui.commandDefinitions.itemById('rhapso')
@@ -118,6 +180,18 @@ def run(context):
             _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
 
+def stop(context):
+    try:
+        # Kill Slic3r if an export is still running
+        exportEngine.cancelExport()
+        if _app:
+            _app.unregisterCustomEvent(_exportEventId)
+
+    except:
+        if _ui:
+            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
 def createPrintBedAndThreadOriginBodies():
     try:
         design = adsk.fusion.Design.cast(_app.activeProduct)
@@ -271,7 +345,7 @@ class MyCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
                 anchorInput.addSelectionFilter(adsk.core.SelectionCommandInput.SolidBodies)
                 anchorInput.setSelectionLimits(0)
 
-                threadInput = groupChildInputs.addSelectionInput('selThread'+str(i), 'Select Thread Lines', 'Select sketchlines to export as thread. The first line should be connected to the thread origin. The lines should be connected.')
+                threadInput = groupChildInputs.addSelectionInput('selThread'+str(i), 'Select Thread Lines', 'Select sketchlines to export as thread. They should make a path from the thread origin, in any order.')
                 #threadInput.addSelectionFilter(adsk.core.SelectionCommandInput.Edges)
                 threadInput.addSelectionFilter(adsk.core.SelectionCommandInput.SketchCurves)
                 threadInput.setSelectionLimits(0)
@@ -294,6 +368,10 @@ class MyExecuteHandler(adsk.core.CommandEventHandler):
         try:
             adsk.core.EventArgs = adsk.core.CommandEventArgs.cast(args)
 
+            if _exportWorker is not None and _exportWorker.is_alive():
+                _ui.messageBox('An export is still running. Cancel it in its progress dialog or wait until it is done.')
+                return
+
             selBody = _inputs.itemById('selBody')
             selBody = adsk.core.SelectionCommandInput.cast(selBody)
             for i in range(0, selBody.selectionCount):
@@ -319,240 +397,195 @@ class MyExecuteHandler(adsk.core.CommandEventHandler):
                 if _selectedAnchors[-1] != None:
                     _selectedAnchors.append(None)
 
-            exportThread()
-            exportBody()
-            exportAnchor()
-            exportAll()
+            global _manifest
+            settings = getSettings()
+            _manifest = exportEngine.openManifest(settings)
+            report = exportEngine.startReport(settings)
 
-        except:
-            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+            # Stages that call the Fusion API run here. Anchors are exported before the thread, which is lifted over the
+            # anchors in its way.
+            for stage in [exportBody, exportAnchor]:
+                with report.stage(stage.__name__):
+                    stage()
 
+            startExportWorker(readThreadLines(), getBodyStlPaths(), settings, report)
 
-def exportThread():
-    try:
-        global _lines
-
-        _lines = np.zeros((len(_selectedLines), 2, 3))
-        
-        #ui.messageBox(str(lines))
-        for i in range(0, len(_selectedLines)):
-            if _selectedLines[i] != None:
-                #TODO: Remove below if. I don't accept BRepEdge anymore.
-                if _selectedLines[i].classType() == "adsk::fusion::BRepEdge":
-                    edge = adsk.fusion.BRepEdge.cast(_selectedLines[i]) 
-                    startPoint = edge.startVertex.geometry   # Point3D type
-                    endPoint = edge.endVertex.geometry
-                else:
-                    edge = adsk.fusion.SketchLine.cast(_selectedLines[i]) # "adsk::fusion::SketchLine"
-                    startPoint = edge.worldGeometry.startPoint
-                    endPoint = edge.worldGeometry.endPoint
-            
-                _lines[i][0] = [round(startPoint.x*10, 4), round(startPoint.y*10, 4), round(startPoint.z*10, 4)]
-                _lines[i][1] = [round(endPoint.x*10, 4), round(endPoint.y*10, 4), round(endPoint.z*10, 4)]
-            else:
-                _lines[i] = None
+        except:
+            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
 
-        # ##############################
-        # ### 1. Order lines from the origin ver. 1
-        
-        # #TODO: handle the case when the lines are not connected or are not connected the thread origin.
+def startExportWorker(lines, bodyStlPaths, settings, report):
+    # Run the thread, slicing and merge stages on a worker thread, with a progress dialog that can cancel them
+    global _exportWorker, _progressDialog
+    _progressDialog = _ui.createProgressDialog()
+    _progressDialog.isCancelButtonShown = True
+    _progressDialog.cancelButtonText = 'Cancel'
+    _progressDialog.isBackgroundTranslucent = False
+    _progressDialog.show('Rhapso export', 'Starting', 0, 1, 0)
 
-        # tmpIndex = np.where((_lines[:,:,0] == _threadOriginX) & (_lines[:,:,1] == 0) & (_lines[:,:,2] == 0))
+    exportEngine.cancelled.clear()
+    exportEngine.showMessage = lambda message: postExportEvent('message', message=message)
+    exportEngine.showProgress = lambda stage, done, total: postExportEvent('progress', stage=stage, done=done, total=total)
+    _exportWorker = threading.Thread(target=runExport, args=(lines, bodyStlPaths, settings, report), name='export', daemon=True)
+    _exportWorker.start()
+    # Events keep coming while Slic3r runs, so that the cancel button is seen
+    threading.Thread(target=tickExport, args=(_exportWorker,), name='exportTick', daemon=True).start()
 
-        # _lines[[tmpIndex[0][0], 0]] = _lines[[0, tmpIndex[0][0]]]     # Move origin to the first row
-        # _lines[0, [0, tmpIndex[1][0]]] = _lines[0, [tmpIndex[1][0], 0]]          # Move origin to the first column
 
+def postExportEvent(kind, **info):
+    # Safe to call from any thread
+    info['kind'] = kind
+    _app.fireCustomEvent(_exportEventId, json.dumps(info))
 
-        # # Sort lines from the origin.
-        # for i in range(1, len(_lines)):
-        #     tmpIndex = np.where((_lines[i:,:,0] == _lines[i-1, 1, 0]) & (_lines[i:,:,1] == _lines[i-1, 1, 1]) & (_lines[i:,:,2] == _lines[i-1, 1, 2]))
 
-        #     if i < len(_lines) - 1:
+def runExport(lines, bodyStlPaths, settings, report):
+    # Body of the worker thread. No Fusion API calls here but fireCustomEvent.
+    try:
+        stages = [('exportThread', lambda: exportThread(lines)), ('sliceBodyAndAnchors', lambda: sliceBodyAndAnchors(bodyStlPaths)),
+                  ('exportAll', exportAll)]
+        for i in range(len(stages)):
+            name, stage = stages[i]
+            exportEngine.checkCancelled()
+            exportEngine.showProgress(name, i, len(stages))
+            with report.stage(name):
+                stage()
+
+        if _manifest is not None:
+            _manifest.save()
+        exportEngine.saveReport(settings)
+        postExportEvent('done')
+
+    except exportEngine.ExportCancelled:
+        postExportEvent('cancelled')
+    except:
+        # The manifest and the report are not saved: the next export does the failed work again
+        postExportEvent('failed', message=traceback.format_exc())
 
-        #         _lines[[tmpIndex[0][0], i]] = _lines[[i, tmpIndex[0][0]]]     # Move the line to the current row
-        #     _lines[i, [0, tmpIndex[1][0]]] = _lines[i, [tmpIndex[1][0], 0]]                         # Move the point of the line that is connected to the previous line to the first column
-        
-        # _lines[:,:,0] = _lines[:,:,0] - _threadOriginX      # Shift x points to the center of the ring.
 
-        # # fThread.write(str(_lines))
-        # # _ui.messageBox(str(_lines))
+def tickExport(worker):
+    while worker.is_alive():
+        postExportEvent('tick')
+        worker.join(0.5)
 
-        ##############################
-        ### 1. Order lines from the origin ver. 2
-        
-        #TODO: handle the case when the lines are not connected to the thread origin or not chosen in the right order.Z
-
-        # _ui.messageBox(str(_lines))
-
-        if (_lines[0,0,0] != _threadOriginX) or (_lines[0,0,1] != 0) or (_lines[0,0,2] != 0):
-            #Assume the first line is connected to the origin. Move origin to the first column
-            tmp = _lines[0,0]
-            _lines[0,0] = _lines[0,1]
-            _lines[0,1] = tmp
-
-        # Sort lines from the origin.
-        for i in range(1, len(_lines)):
-            if not np.isnan(_lines[i,0,0]):
-                if not np.isnan(_lines[i-1,0,0]):
-                    if (_lines[i,0,0] != _lines[i-1,1,0]) or (_lines[i,0,1] != _lines[i-1,1,1]) or (_lines[i,0,2] != _lines[i-1,1,2]):
-                        tmp = _lines[i,0]
-                        _lines[i,0] = _lines[i,1]
-                        _lines[i,1] = tmp
-
-                elif not np.isnan(_lines[i-2,0,0]):
-                    if (_lines[i,0,0] != _lines[i-2,1,0]) or (_lines[i,0,1] != _lines[i-2,1,1]) or (_lines[i,0,2] != _lines[i-2,1,2]):
-                        tmp = _lines[i,0]
-                        _lines[i,0] = _lines[i,1]
-                        _lines[i,1] = tmp
-        
-        # _ui.messageBox(str(_lines))
 
-        _lines[:,:,0] = _lines[:,:,0] - _threadOriginX      # Shift x points to the center of the ring.
+class ExportEventHandler(adsk.core.CustomEventHandler):
+    # Events of the export worker, on the UI thread
+    def __init__(self):
+        super().__init__()
+    def notify(self, args):
+        try:
+            global _progressDialog
+            info = json.loads(args.additionalInfo)
+            kind = info['kind']
+
+            if kind == 'message':
+                _ui.messageBox(info['message'])
+            elif kind == 'progress' and _progressDialog is not None:
+                _progressDialog.message = info['stage'] + ' %v of %m'
+                _progressDialog.maximumValue = max(info['total'], 1)
+                _progressDialog.progressValue = info['done']
+            elif kind in ('done', 'cancelled', 'failed'):
+                if _progressDialog is not None:
+                    _progressDialog.hide()
+                    _progressDialog = None
+                exportEngine.showMessage = _ui.messageBox
+                if kind == 'cancelled':
+                    _ui.messageBox('The export was cancelled. output-all.gcode was not written.')
+                elif kind == 'failed':
+                    _ui.messageBox('Failed:\n{}'.format(info['message']))
+                if _terminateWhenDone:
+                    adsk.terminate()
+                return
+
+            if _progressDialog is not None and _progressDialog.wasCancelled and not exportEngine.cancelled.is_set():
+                _progressDialog.message = 'Cancelling'
+                exportEngine.cancelExport()
 
-        # fThread.write(str(_lines))
-        # _ui.messageBox(str(_lines))
+        except:
+            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
 
-        ##############################
-        ### 2. Conver thread geometry to g-code
+def getSettings():
+    return exportEngine.PrintSettings(filePath=_filePath, slic3rPath=_slic3rPath, slic3rExe=_slic3rExe,
+        layerThickness=_layerThickness, bedSizeX=_bedSizeX, bedSizeOriginalX=_bedSizeOriginalX, bedSizeY=_bedSizeY,
+        temperature=_temperature, bedTemperature=_bedTemperature, keepTmpFiles=_keepTmpFiles, incremental=_incremental,
+        writeReport=_writeReport, profile=_profile, planRingMoves=_planRingMoves,
+        reuseAnchorSlices=_reuseAnchorSlices, orderAnchors=_orderAnchors, batchThreads=_batchThreads,
+        compactOutput=_compactOutput, gzipOutput=_gzipOutput,
+        mergeSegments=_mergeSegments, fitArcs=_fitArcs)
 
-        h = _bedSizeOriginalX/2 # Center point of the ring in mm
-        r = 100 # Radius of the ring in mm
-        stepsPCircle = 142.5
-        theta = math.radians(-90)
-        
-        # fThread.write('\n\nT1 ; change tool to Extruder 2\n')
 
-        # 2. project the position on the ring. If there are anchors on the way, (1) lift the ring up, (2) go to the position (slightly outer than the anchor), (3) go to the position
-        preEValue = 0
-        
-        fThread = open(os.path.join(_filePath, "output-thread-tmp.gcode"), "w")
-        fThread.write(';anchor\n')
+def getBodyStlPaths():
+    return [os.path.join(_filePath, body.name + ".stl") for body in _selecedBodies]
 
-        for i in range(len(_lines)):
-            if not np.isnan(_lines[i,0,0]):
-                startPoint = _lines[i][0]
-                endPoint = _lines[i][1]
-                
-                x1 = startPoint[0]
-                y1 = startPoint[1]
-                z1 = startPoint[2]
-                x2 = endPoint[0]
-                y2 = endPoint[1]
-                z2 = endPoint[2]
-
-                if x2 != x1:
-                    la = (y2-y1)/(x2-x1)     # a for linear formulat y = ax + b
-                    lb = - la*x1 + y1         # b for linear formulat y = ax + b
-                    qa = 1 + pow(la,2)        #a for quadratic formula    ax^2 + bx + c = 0
-                    qb = 2*la*(lb-h) - 2*h    #b for quadratic formula    ax^2 + bx + c = 0
-                    qc = pow(lb-h,2) + pow(h,2) - pow(r, 2)
-                    spoolPoint1x = (-qb-cmath.sqrt(pow(qb,2) - 4*qa*qc))/(2*qa) 
-                    spoolPoint1y = la*spoolPoint1x + lb
-                    spoolPoint2x = (-qb+cmath.sqrt(pow(qb,2) - 4*qa*qc))/(2*qa)
-                    spoolPoint2y = la*spoolPoint2x + lb
-                    
-                else:                  
-                    qa = 1               # linear formula x = x1
-                    qb = - 2 * h
-                    qc = pow(h, 2) + pow (x1 - h, 2) - pow(r, 2)
-                    spoolPoint1y = (-qb-cmath.sqrt(pow(qb,2) - 4*qa*qc))/(2*qa)
-                    spoolPoint1x = x1
-                    spoolPoint2y = (-qb+cmath.sqrt(pow(qb,2) - 4*qa*qc))/(2*qa)
-                    spoolPoint2x = x1
-
-                # Remove imajinary numbers
-                spoolPoint1x = spoolPoint1x.real
-                spoolPoint1y = spoolPoint1y.real
-                spoolPoint2x = spoolPoint2x.real
-                spoolPoint2y = spoolPoint2y.real
-                
-                # fThread.write(';Spool points: (({},{}),({},{}))\n'.format(spoolPoint1x, spoolPoint1y, spoolPoint2x, spoolPoint2y))
-
-                # Choose a target spool point further from the startPoint
-                d1 = pow(spoolPoint1x-x1, 2) + pow(spoolPoint1y-y1, 2)
-                d2 = pow(spoolPoint2x-x1, 2) + pow(spoolPoint2y-y1, 2)
-                if d1 > d2:
-                    tSpoolPointx = spoolPoint1x
-                    tSpoolPointy = spoolPoint1y
-                else:
-                    tSpoolPointx = spoolPoint2x
-                    tSpoolPointy = spoolPoint2y
-
-                # Get spool point z
-                if x2 != x1:
-                    lza = (z2-z1)/(x2-x1)     # a for linear formulat z = ax + b
-                    lzb = - lza*x1 + z1 
-                    tSpoolPointz = lza * tSpoolPointx + lzb
-                else:
-                    lza = (z2-z1)/(y2-y1)     # a for linear formulat z = ax + b
-                    lzb = - lza*y1 + z1 
-                    tSpoolPointz = lza * tSpoolPointy + lzb
-
-                # Get target theta
-                tTheta = cmath.atan((tSpoolPointy-h)/(tSpoolPointx-h)).real
-                if tSpoolPointx-h < 0:
-                    tTheta = tTheta + cmath.pi            # add 90 degress if the target point is on the left side of the ring.
-
-
-                # fThread.write(';Target spool points: ({},{})\n'.format(tSpoolPointx, tSpoolPointy))
-                
-                # Convert spool xy point to the rotation of the ring
-                # Get rotational direction to get to the target spool point
 
+def getAnchorStlPaths():
+    # Same layout as _selectedAnchors. None separates anchor groups.
+    return [os.path.join(_filePath, "anchor" + str(i) + ".stl") if _selectedAnchors[i] is not None else None for i in range(len(_selectedAnchors))]
 
-                dTheta = tTheta - theta
-                # fThread.write(';Theta, tTheta, dTheta: ({},{},{})\n'.format(math.degrees(theta), math.degrees(tTheta), math.degrees(dTheta)))
-                
 
-                #_ui.messageBox("dTheta: {}".format(math.degrees(abs(dTheta))))
-                eValue = dTheta / (2 * cmath.pi) * stepsPCircle      # -1 is to inverse the angle. + is to rotate the ring clockwise and - is for anticlockwise
-                # _ui.messageBox("steps: {}".format(eValue))
+def bodyFingerprint(body):
+    # Changes when the body is edited or moved. Much cheaper than exporting the stl file.
+    box = body.boundingBox
+    return exportManifest.fingerprint(box.minPoint.asArray(), box.maxPoint.asArray(), body.volume, body.area,
+                                      body.faces.count, body.edges.count, body.vertices.count)
 
-                if z1 != z2:
-                    fThread.write('G0 Y%.5f ; Move bed to the center\n' % (_bedSizeY/2))    # put print bed at the center.
-                
-                fThread.write("G1 E{:.5f} Z{:.5f} F800\n".format(eValue-preEValue, tSpoolPointz))
-                fThread.write("G92 E0\n")
-                
-                if z1 != z2 and i != 0:
-                    fThread.write('G92 E0 ; set the current filament position to E2=0\n') # Assume 12 o'clock is E2=0
-                    preEValue = eValue
 
-                #TODO: check if preEValue works well. I need to put thread in another layer to test this.
-                    
-                theta = tTheta
+def exportStl(exportMgr, body, fileName):
+    # Export body to fileName.stl unless the body is unchanged since the last export and the file is still there
+    stlPath = fileName + ".stl"
+    fingerprint = bodyFingerprint(body) if _manifest is not None else None
+    if fingerprint is not None:
+        _stlFingerprints[stlPath] = fingerprint
+        if _manifest.unchanged('stl:' + stlPath, fingerprint) and os.path.exists(stlPath):
+            _manifest.update('stl:' + stlPath, fingerprint, skipped=True)
+            return
 
-            elif np.isnan(_lines[i,0,0]) and i != len(_lines)-1:
-                # Add comment for anchor
-                # Add gcode lines to over-rotate the ring. Thread can be fixed during print this way. Currently rotate 30 degree of the ring.
-                if eValue-preEValue >= 0:
-                    fThread.write('G0 Y117.50000 ; Move bed to the center\n')
-                    fThread.write('G1 E12 F800\n')
-                    fThread.write('G92 E0\n')
-                    fThread.write(';anchor\n')
-                    fThread.write('G1 E-12 F800\n')
-                    fThread.write('G92 E0\n')
+    # create stl exportOptions
+    stlExportOptions = exportMgr.createSTLExportOptions(body, fileName)
+    stlExportOptions.sendToPrintUtility = False
+    stlExportOptions.isBinaryFormat = True
 
-                else:
-                    fThread.write('G0 Y117.50000 ; Move bed to the center\n')
-                    fThread.write('G1 E-12 F800\n')
-                    fThread.write('G92 E0\n')
-                    fThread.write(';anchor\n')
-                    fThread.write('G1 E12 F800\n')
-                    fThread.write('G92 E0\n')
+    with exportEngine.report.stage('stlExport', file=os.path.basename(stlPath)) as record:
+        exportMgr.execute(stlExportOptions)
+        record['bytesWritten'] = os.path.getsize(stlPath) if os.path.exists(stlPath) else 0
+    if fingerprint is not None:
+        _manifest.update('stl:' + stlPath, fingerprint)
 
 
+def readThreadLines():
+    # Thread segments of the selected sketch lines in mm. Calls the Fusion API, so it runs on the UI thread.
+    lines = np.zeros((len(_selectedLines), 2, 3))
+    
+    for i in range(0, len(_selectedLines)):
+        if _selectedLines[i] != None:
+            #TODO: Remove below if. I don't accept BRepEdge anymore.
+            if _selectedLines[i].classType() == "adsk::fusion::BRepEdge":
+                edge = adsk.fusion.BRepEdge.cast(_selectedLines[i]) 
+                startPoint = edge.startVertex.geometry   # Point3D type
+                endPoint = edge.endVertex.geometry
+            else:
+                edge = adsk.fusion.SketchLine.cast(_selectedLines[i]) # "adsk::fusion::SketchLine"
+                startPoint = edge.worldGeometry.startPoint
+                endPoint = edge.worldGeometry.endPoint
+        
+            lines[i][0] = [round(startPoint.x*10, 4), round(startPoint.y*10, 4), round(startPoint.z*10, 4)]
+            lines[i][1] = [round(endPoint.x*10, 4), round(endPoint.y*10, 4), round(endPoint.z*10, 4)]
+        else:
+            lines[i] = None
 
-        # fThread.write('G92 E0 ; set the current filament position to E2=0\n')
+    return lines
 
-        # fThread.write('T0 ; change back to normal extruder')
-        fThread.close()
 
+# exportThread, sliceBodyAndAnchors and exportAll run on the export worker. Their errors go up to runExport, which
+# shows them and does not save the manifest, so that a failed stage is done again by the next export.
+def exportThread(lines=None):
+    global _lines, _threadGcode
+    if lines is None:
+        lines = readThreadLines()
 
-    except:
-            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+    # Order the lines, shift them to the ring and make the thread g-code
+    _lines, _threadGcode = exportEngine.exportThread(lines, getSettings(), getAnchorStlPaths())
 
 
 def exportBody():
@@ -564,180 +597,7 @@ def exportBody():
         #####################################
         # 1. Export each body to a stl file
         for body in _selecedBodies:
-            fileName = os.path.join(_filePath, body.name)
-
-            # create stl exportOptions
-            stlExportOptions = exportMgr.createSTLExportOptions(body, fileName)
-            stlExportOptions.sendToPrintUtility = False
-            stlExportOptions.isBinaryFormat = False
-            
-            exportMgr.execute(stlExportOptions)
-
-
-        #####################################
-        # 2. Combine all stl files into one file.
-        f_all = open(_filePath +"/body-all.stl", "w")
-        f_all.write("solid ASCII\n")
-
-        for body in _selecedBodies:
-            f = open(os.path.join(_filePath, body.name + ".stl"), "r")
-            count = f.readlines()
-            # _ui.messageBox(str(type(count)))
-            for i in range(1, len(count)-1):
-                f_all.write(count[i])
-
-        f_all.write("endsolid")
-        f_all.close()
-
-
-        #####################################
-        # 3. Make a g-code file
-        result = subprocess.check_output([os.path.join(_slic3rPath, _slic3rExe),
-        os.path.join(_filePath, "body-all.stl"),
-        "--first-layer-height", str(_layerThickness),
-        "--layer-height",str(_layerThickness),
-        "--temperature", str(_temperature),
-        "--bed-temperature", str(_bedTemperature),
-        "--filament-diameter","1.75",
-        "--nozzle-diameter","0.4",
-        "--skirts", "0",
-        "--dont-arrange",
-        "-o", os.path.join(_filePath, "output-body.gcode")]) 
-
-
-        #####################################
-        # 4. Clean the g-code file
-        fBody = open(_filePath +"/output-body.gcode", "r")
-        fBodyLines = fBody.readlines()
-        fBody.close()
-
-        # 4.1 Remove header and footer lines
-        layerChangeIndexesBody = [i for i, lA in enumerate(fBodyLines) if lA.startswith('G1 Z')] 
-
-        # 4.1.1 move the initial X,Y positions after the first G1 Z... line
-        if fBodyLines[layerChangeIndexesBody[1]-1].startswith('G1 X'):
-            fBodyLines.insert(layerChangeIndexesBody[1]+1, fBodyLines[layerChangeIndexesBody[1]-1])
-
-        # 4.1.2 Remove header. Lines before the second 'G1 Z...' and two lines after that. 'G1 E-2.00000 F2400.00000' and 'G92 E0'
-        del fBodyLines[:layerChangeIndexesBody[1]]
-        layerChangeIndexesBody = [i for i, lA in enumerate(fBodyLines) if lA.startswith('G1 Z')]
-        del fBodyLines[layerChangeIndexesBody[0]+1]
-        del fBodyLines[layerChangeIndexesBody[0]+1]
-
-        # 4.1.3 remove footer. Lines after the last 'G92 E0'
-        endOfPrintIndexAnchor = [i for i, lA in enumerate(fBodyLines) if lA.startswith('G92 E0')]
-        del fBodyLines[endOfPrintIndexAnchor[-1]+1:]
-
-        # 4.2 Copy M106 or M107 from the nearest previous line to set fan speed.
-        layerChangeIndexesBody = [i for i, lA in enumerate(fBodyLines) if lA.startswith('G1 Z')]
-        
-        fBodyLines.insert(layerChangeIndexesBody[0]+1, "M107\n") # First layer is always M107
-        layerChangeIndexesBody[1:] = [x + 1 for x in layerChangeIndexesBody[1:]] 
-        
-        for i in range(1, len(layerChangeIndexesBody)):
-            for j in range(layerChangeIndexesBody[i]-1, layerChangeIndexesBody[i-1], -1):
-                if fBodyLines[j].startswith('M106') or fBodyLines[j].startswith('M107'):
-                    fBodyLines.insert(layerChangeIndexesBody[i]+1, fBodyLines[j])
-                    layerChangeIndexesBody[i+1:] = [x + 1 for x in layerChangeIndexesBody[i+1:]] 
-                    break
-
-        # 4.3 Put 'G1 X... Y... F...' at i+2th line
-        for i in range(1, len(layerChangeIndexesBody)):
-            # 4.3.1 Move 'G1 X... Y... F...' to i+2th line if they are in next 2-4 lines
-            if fBodyLines[layerChangeIndexesBody[i]+2].startswith('G1 X') and (fBodyLines[layerChangeIndexesBody[i]+2].find('F') != -1):
-                pass
-
-            elif fBodyLines[layerChangeIndexesBody[i]+3].startswith('G1 X') and (fBodyLines[layerChangeIndexesBody[i]+3].find('F') != -1):
-                fBodyLines.insert(layerChangeIndexesBody[i]+2, fBodyLines[layerChangeIndexesBody[i]+3])
-                del fBodyLines[layerChangeIndexesBody[i]+4]
-                
-            elif fBodyLines[layerChangeIndexesBody[i]+4].startswith('G1 X') and (fBodyLines[layerChangeIndexesBody[i]+4].find('F') != -1):
-                fBodyLines.insert(layerChangeIndexesBody[i]+2, fBodyLines[layerChangeIndexesBody[i]+4])
-                del fBodyLines[layerChangeIndexesBody[i]+5]
-
-            # 4.3.2 Copy X,Y points from the nearest previous line if there is no G1 X... Y... F7800 in next 2-4 lines
-            else:
-                for j in range(layerChangeIndexesBody[i]-1, layerChangeIndexesBody[i-1], -1):
-                    if fBodyLines[j].startswith('G1 X') and fBodyLines[j].startswith('F') != -1:
-                        fBodyLines.insert(layerChangeIndexesBody[i]+2, fBodyLines[j])
-                        layerChangeIndexesBody[i+1:] = [x + 1 for x in layerChangeIndexesBody[i+1:]] 
-
-                        # Remove the previous X,Y coordinates to remove unnecessary movement at the end of the previous layer
-                        del fBodyLines[j]
-                        layerChangeIndexesBody[i:] = [x - 1 for x in layerChangeIndexesBody[i:]] 
-                        break
-
-                    elif fBodyLines[j].startswith('G1 X') and fBodyLines[j].startswith('E') != -1:
-                        strXY, sep, tail = fBodyLines[j].partition('E')       # strXY = 'G1 X... Y... '
-                        fBodyLines.insert(layerChangeIndexesBody[i]+2, strXY+'F7800.000')
-                        layerChangeIndexesBody[i+1:] = [x + 1 for x in layerChangeIndexesBody[i+1:]] 
-                        break
-
-                    elif fBodyLines[j].startswith('G1 X'):
-                        _ui.messageBox('Error!')
-                        break
-
-            # 4.4 Reset E values after every layer change
-        for i in range(1, len(layerChangeIndexesBody)):
-            # 4.4.1 If there is 'G91 E0' at 4th line after 'G1 Z...', Move that line and the previous line above 'G1 Z...'
-            if fBodyLines[layerChangeIndexesBody[i]+4].startswith('G92 E0'):
-                fBodyLines.insert(layerChangeIndexesBody[i], fBodyLines[layerChangeIndexesBody[i]+3])
-                del fBodyLines[layerChangeIndexesBody[i]+4]
-                fBodyLines.insert(layerChangeIndexesBody[i]+1, fBodyLines[layerChangeIndexesBody[i]+4])
-                del fBodyLines[layerChangeIndexesBody[i]+5]
-                layerChangeIndexesBody[i] = layerChangeIndexesBody[i]+2
-
-            # 4.4.2 If there is no 'G91 E0' before 'G1 Z...', Reset E value until meeting the next 'G92 E0'
-            elif not fBodyLines[layerChangeIndexesBody[i]-1].startswith('G92 E0'):
-                # 3.4.2.1 Insert 'G92 E0' before layer change
-                offset = 0
-                prevEValue = -1
-                while True:
-                    offset += 1
-                    if fBodyLines[layerChangeIndexesBody[i]-offset].find('E') != -1:
-                        if fBodyLines[layerChangeIndexesBody[i]-offset].find('F') != -1:
-                            _ui.messageBox('Error!')
-                        else:
-                            head, sep, eValueStr = fBodyLines[layerChangeIndexesBody[i]-offset].partition('E')
-                            prevEValue = float(eValueStr.strip())
-                            fBodyLines.insert(layerChangeIndexesBody[i], "G1 E"+str(round(prevEValue-2, 5))+" F2400.000\n") # Retract
-                            fBodyLines.insert(layerChangeIndexesBody[i]+1, "G92 E0\n")
-                            fBodyLines.insert(layerChangeIndexesBody[i]+5, "G1 E2.00000 F2400.000\n")
-                            
-                            layerChangeIndexesBody[i] = layerChangeIndexesBody[i]+2
-                            layerChangeIndexesBody[i+1:] = [x + 3 for x in layerChangeIndexesBody[i+1:]] 
-
-                        break
-                
-                # 4.4.2.1 Shift E values until meeting the next 'G92 E0'
-                eValueDiff = prevEValue - 2
-                offset = 3
-                while True:
-                    offset += 1
-                    if fBodyLines[layerChangeIndexesBody[i]+offset].startswith('G92 E0'):
-                        break
-                    elif fBodyLines[layerChangeIndexesBody[i]+offset].startswith('G1 X') and fBodyLines[layerChangeIndexesBody[i]+offset].find('E') != -1: #G1 X26.295 Y147.794 E75.48784
-                        head, sep, strEValue = fBodyLines[layerChangeIndexesBody[i]+offset].partition('E')
-                        newEValue = float(strEValue.strip()) - eValueDiff
-                        fBodyLines[layerChangeIndexesBody[i]+offset] = head + sep + "%.5f\n" % newEValue
-                    elif fBodyLines[layerChangeIndexesBody[i]+offset].startswith('G1 E') and fBodyLines[layerChangeIndexesBody[i]+offset].find('F') != -1: #G1 E88.29126 F2400.00000
-                        head, sepE, tail = fBodyLines[layerChangeIndexesBody[i]+offset].partition('E')
-                        strEValue, sepF, tailF = tail.partition('F')
-                        newEValue = float(strEValue.strip()) - eValueDiff
-                        fBodyLines[layerChangeIndexesBody[i]+offset] = head + sepE + ("%.5f " % newEValue) + sepF + tailF
-
-        ### 5. Add layer number before each G1 Z...
-        layerChangeIndexesBody = [i for i, lA in enumerate(fBodyLines) if lA.startswith('G1 Z')]
-        fBodyLines.insert(0, ';LAYER:1 ;BODY\n')
-        layerChangeIndexesBody = [x+1 for x in layerChangeIndexesBody]
-        for i in range(1, len(layerChangeIndexesBody)):
-            fBodyLines.insert(layerChangeIndexesBody[i], ';LAYER:'+str(i+1)+' ;BODY\n')
-            layerChangeIndexesBody[i+1:] = [x+1 for x in layerChangeIndexesBody[i+1:]]
-
-        fAnchorTmp = open(_filePath +"/output-body-tmp.gcode", "w")
-        fAnchorTmp.writelines(fBodyLines)
-        fAnchorTmp.close()
-
+            exportStl(exportMgr, body, os.path.join(_filePath, body.name))
 
     except:
         if _ui:
@@ -751,322 +611,28 @@ def exportAnchor():
         exportMgr = design.exportManager
 
         #####################################
-        # 1. Export each body to a stl file and then gcode file
-        for i in range(len(_selectedAnchors)):
-            if _selectedAnchors[i] is not None:
-                fileName = os.path.join(_filePath, "anchor" + str(i))
-
-                # create stl exportOptions
-                stlExportOptions = exportMgr.createSTLExportOptions(_selectedAnchors[i], fileName)
-                stlExportOptions.sendToPrintUtility = False
-                stlExportOptions.isBinaryFormat = False
-                
-                exportMgr.execute(stlExportOptions)
-
-                result = subprocess.check_output([os.path.join(_slic3rPath, _slic3rExe),
-                os.path.join(_filePath, "anchor" + str(i) + ".stl"),
-                "--first-layer-height", str(_layerThickness),
-                "--layer-height",str(_layerThickness),
-                "--temperature", str(_temperature),
-                "--bed-temperature", str(_bedTemperature),
-                "--filament-diameter","1.75",
-                "--nozzle-diameter","0.4",
-                "--skirts", "0",
-                "--dont-arrange",
-                "-o", os.path.join(_filePath, "output-anchor" + str(i) + ".gcode")]) 
-
-
-        #####################################
-        ### 2. Combine until thread line
-        ### 2.1 Check height of thread. Visit one of two points of all thread, and then make a list of height. Skip z=0.
-        threadHeights = []
-        threadHeightIndexes = []
-        for i in range(len(_lines)):
-            if not np.isnan(_lines[i,0,0]):
-                if _lines[i, 0, 2] != 0 and (len(threadHeights) == 0 or threadHeights[-1] != _lines[i, 0, 2]):
-                    threadHeights.append(_lines[i, 0, 2])        #Do not save 0
-                    threadHeightIndexes.append(i)
-        #TODO: threadHeightIndexes is never used in this function. Check if this block of code is necessary.
-
-
-        ### 2.2 Read all anchor gcode files
-        allfAnchorlines = []
+        # 1. Export each anchor to a stl file
         for i in range(len(_selectedAnchors)):
             if _selectedAnchors[i] is not None:
-                fAnchor = open(os.path.join(_filePath, "output-anchor" + str(i) + ".gcode"), "r")
-                fAnchorLines = fAnchor.readlines()
-                allfAnchorlines.append(fAnchorLines)
-                fAnchor.close()
-            else:
-                allfAnchorlines.append(None)
-
-        
-        #####################################
-        ### 3. Clean gcode files. Remove header and footer lines. Insert code resetting E value if none
-        # newAllfAnchorLines = list (allfAnchorlines)
-        for k in range(len(allfAnchorlines)):
-            if allfAnchorlines[k] is not None:
-
-                ### 3.1 Remove header and footer lines
-                layerChangeIndexesAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith('G1 Z')] 
-
-                ### 3.1.1 move the initial X,Y positions after the first G1 Z... line
-                if allfAnchorlines[k][layerChangeIndexesAnchor[1]-1].startswith('G1 X'):
-                    allfAnchorlines[k].insert(layerChangeIndexesAnchor[1]+1, allfAnchorlines[k][layerChangeIndexesAnchor[1]-1])
-
-                ### 3.1.2 Remove header. Lines before the second 'G1 Z...' and two lines after that. 'G1 E-2.00000 F2400.00000' and 'G92 E0'
-                del allfAnchorlines[k][:layerChangeIndexesAnchor[1]]
-                layerChangeIndexesAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith('G1 Z')]
-                del allfAnchorlines[k][layerChangeIndexesAnchor[0]+1]
-                del allfAnchorlines[k][layerChangeIndexesAnchor[0]+1]
-
-                ### 3.1.3 remove footer. Lines after the last 'G92 E0'
-                endOfPrintIndexAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith('G92 E0')]
-                del allfAnchorlines[k][endOfPrintIndexAnchor[-1]+1:]
-
-                ### 3.2 Copy M106 or M107 from the nearest previous line to set fan speed.
-                layerChangeIndexesAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith('G1 Z')]
-                
-                allfAnchorlines[k].insert(layerChangeIndexesAnchor[0]+1, "M107\n") # First layer is always M107
-                layerChangeIndexesAnchor[1:] = [x + 1 for x in layerChangeIndexesAnchor[1:]] 
-                
-                for i in range(1, len(layerChangeIndexesAnchor)):
-                    for j in range(layerChangeIndexesAnchor[i]-1, layerChangeIndexesAnchor[i-1], -1):
-                        if allfAnchorlines[k][j].startswith('M106') or allfAnchorlines[k][j].startswith('M107'):
-                            allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+1, allfAnchorlines[k][j])
-                            layerChangeIndexesAnchor[i+1:] = [x + 1 for x in layerChangeIndexesAnchor[i+1:]] 
-                            break
-
-                ### 3.3 Put 'G1 X... Y... F...' at i+2th line
-                for i in range(1, len(layerChangeIndexesAnchor)):
-                    ### 3.3.1 Move 'G1 X... Y... F...' to i+2th line if they are in next 2-4 lines
-                    if allfAnchorlines[k][layerChangeIndexesAnchor[i]+2].startswith('G1 X') and (allfAnchorlines[k][layerChangeIndexesAnchor[i]+2].find('F') != -1):
-                        pass
-
-                    elif allfAnchorlines[k][layerChangeIndexesAnchor[i]+3].startswith('G1 X') and (allfAnchorlines[k][layerChangeIndexesAnchor[i]+3].find('F') != -1):
-                        allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+2, allfAnchorlines[k][layerChangeIndexesAnchor[i]+3])
-                        del allfAnchorlines[k][layerChangeIndexesAnchor[i]+4]
-                        
-                    elif allfAnchorlines[k][layerChangeIndexesAnchor[i]+4].startswith('G1 X') and (allfAnchorlines[k][layerChangeIndexesAnchor[i]+4].find('F') != -1):
-                        allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+2, allfAnchorlines[k][layerChangeIndexesAnchor[i]+4])
-                        del allfAnchorlines[k][layerChangeIndexesAnchor[i]+5]
-
-                    ### 3.3.2 Copy X,Y points from the nearest previous line if there is no G1 X... Y... F7800 in next 2-4 lines
-                    # if ((not (allfAnchorlines[k][layerChangeIndexesAnchor[i]+2].startswith('G1 X') and allfAnchorlines[k][layerChangeIndexesAnchor[i]+2].find('F') != -1)) and 
-                    # (not (allfAnchorlines[k][layerChangeIndexesAnchor[i]+3].startswith('G1 X') and allfAnchorlines[k][layerChangeIndexesAnchor[i]+3].find('F') != -1)) and 
-                    # (not (allfAnchorlines[k][layerChangeIndexesAnchor[i]+4].startswith('G1 X') and allfAnchorlines[k][layerChangeIndexesAnchor[i]+4].find('F') != -1))):
-                    else:
-                        for j in range(layerChangeIndexesAnchor[i]-1, layerChangeIndexesAnchor[i-1], -1):
-                            if allfAnchorlines[k][j].startswith('G1 X') and allfAnchorlines[k][j].startswith('F') != -1:
-                                allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+2, allfAnchorlines[k][j])
-                                layerChangeIndexesAnchor[i+1:] = [x + 1 for x in layerChangeIndexesAnchor[i+1:]] 
-
-                                # Remove the previous X,Y coordinates to remove unnecessary movement at the end of the previous layer
-                                del allfAnchorlines[k][j]
-                                layerChangeIndexesAnchor[i:] = [x - 1 for x in layerChangeIndexesAnchor[i:]] 
-                                break
-
-                            elif allfAnchorlines[k][j].startswith('G1 X') and allfAnchorlines[k][j].startswith('E') != -1:
-                                strXY, sep, tail = allfAnchorlines[k][j].partition('E')       # strXY = 'G1 X... Y... '
-                                allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+2, strXY+'F7800.000')
-                                layerChangeIndexesAnchor[i+1:] = [x + 1 for x in layerChangeIndexesAnchor[i+1:]] 
-                                break
-
-                            elif allfAnchorlines[k][j].startswith('G1 X'):
-                                _ui.messageBox('Error!')
-                                break
-                    
-
-                ### 3.4 Reset E values after every layer change
-                for i in range(1, len(layerChangeIndexesAnchor)):
-                    # 3.4.1 If there is 'G91 E0' at 4th line after 'G1 Z...', Move that line and the previous line above 'G1 Z...'
-                    if allfAnchorlines[k][layerChangeIndexesAnchor[i]+4].startswith('G92 E0'):
-                        allfAnchorlines[k].insert(layerChangeIndexesAnchor[i], allfAnchorlines[k][layerChangeIndexesAnchor[i]+3])
-                        del allfAnchorlines[k][layerChangeIndexesAnchor[i]+4]
-                        allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+1, allfAnchorlines[k][layerChangeIndexesAnchor[i]+4])
-                        del allfAnchorlines[k][layerChangeIndexesAnchor[i]+5]
-                        layerChangeIndexesAnchor[i] = layerChangeIndexesAnchor[i]+2
-
-                    # 3.4.2 If there is no 'G91 E0' before 'G1 Z...', Reset E value until meeting the next 'G92 E0'
-                    elif not allfAnchorlines[k][layerChangeIndexesAnchor[i]-1].startswith('G92 E0'):
-                        # 3.4.2.1 Insert 'G92 E0' before layer change
-                        offset = 0
-                        prevEValue = -1
-                        while True:
-                            offset += 1
-                            if allfAnchorlines[k][layerChangeIndexesAnchor[i]-offset].find('E') != -1:
-                                if allfAnchorlines[k][layerChangeIndexesAnchor[i]-offset].find('F') != -1:
-                                    _ui.messageBox('Error!')
-                                else:
-                                    head, sep, eValueStr = allfAnchorlines[k][layerChangeIndexesAnchor[i]-offset].partition('E')
-                                    prevEValue = float(eValueStr.strip())
-                                    allfAnchorlines[k].insert(layerChangeIndexesAnchor[i], "G1 E"+str(round(prevEValue-2, 5))+" F2400.000\n") # Retract
-                                    allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+1, "G92 E0\n")
-                                    allfAnchorlines[k].insert(layerChangeIndexesAnchor[i]+5, "G1 E2.00000 F2400.000\n")
-                                    
-                                    layerChangeIndexesAnchor[i] = layerChangeIndexesAnchor[i]+2
-                                    layerChangeIndexesAnchor[i+1:] = [x + 3 for x in layerChangeIndexesAnchor[i+1:]] 
-
-                                break
-                        
-                        # 3.4.2.1 Shift E values until meeting the next 'G92 E0'
-                        eValueDiff = prevEValue - 2
-                        offset = 3
-                        while True:
-                            offset += 1
-                            if allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].startswith('G92 E0'):
-                                break
-                            elif allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].startswith('G1 X') and allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].find('E') != -1: #G1 X26.295 Y147.794 E75.48784
-                                head, sep, strEValue = allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].partition('E')
-                                newEValue = float(strEValue.strip()) - eValueDiff
-                                allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset] = head + sep + "%.5f\n" % newEValue
-                            elif allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].startswith('G1 E') and allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].find('F') != -1: #G1 E88.29126 F2400.00000
-                                head, sepE, tail = allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset].partition('E')
-                                strEValue, sepF, tailF = tail.partition('F')
-                                newEValue = float(strEValue.strip()) - eValueDiff
-                                allfAnchorlines[k][layerChangeIndexesAnchor[i]+offset] = head + sepE + ("%.5f " % newEValue) + sepF + tailF
-
-                ### 4. Add layer number before each G1 Z...
-                layerChangeIndexesAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith('G1 Z')]
-                allfAnchorlines[k].insert(0, ';LAYER:1 ;ANCHOR'+str(k)+'\n')
-                layerChangeIndexesAnchor = [x+1 for x in layerChangeIndexesAnchor]
-                for i in range(1, len(layerChangeIndexesAnchor)):
-                    allfAnchorlines[k].insert(layerChangeIndexesAnchor[i], ';LAYER:'+str(i+1)+' ;ANCHOR'+str(k)+'\n')
-                    layerChangeIndexesAnchor[i+1:] = [x+1 for x in layerChangeIndexesAnchor[i+1:]]
-            
-                fAnchorTmp = open(_filePath +"/output-anchor"+str(k)+"-tmp.gcode", "w")
-                fAnchorTmp.writelines(allfAnchorlines[k])
-                fAnchorTmp.close()
-        
+                exportStl(exportMgr, _selectedAnchors[i], os.path.join(_filePath, "anchor" + str(i)))
 
     except:
         if _ui:
             _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
 
-def exportAll():
-    try:
-        fThread = open(os.path.join(_filePath, "output-thread-tmp.gcode"), "r")
-        fBody = open(os.path.join(_filePath, "output-body-tmp.gcode"), "r")
-        fAll  = open(os.path.join(_filePath, "output-all.gcode"), "w")
-
-        # Read body, anchor, thread files
-        fBodyLines = fBody.readlines()
-        allfAnchorlines = []
-        for i in range(len(_selectedAnchors)):
-            if _selectedAnchors[i] is not None:
-                fAnchor = open(os.path.join(_filePath, "output-anchor" + str(i) + "-tmp.gcode"), "r")
-                fAnchorLines = fAnchor.readlines()
-                allfAnchorlines.append(fAnchorLines)
-                fAnchor.close()
-            else:
-                allfAnchorlines.append(None)
-        fThreadLines = fThread.readlines()
-
-        # Add header
-        fAll.write(";Header\n")
-        fAll.write("M107\n")
-        fAll.write("M104 S200 ; set temperature\n")
-        fAll.write("G28 ; home all axes\n")
-        fAll.write("G1 Z5 F5000 ; lift nozzle\n\n")        
-        fAll.write("; Filament gcode\n\n")
-
-        fAll.write("M109 S200 ; set temperature and wait for it to be reached\n")
-        fAll.write("G21 ; set units to millimeters\n")
-        fAll.write("G90 ; use absolute coordinates\n")
-        fAll.write("M82 ; use absolute distances for extrusion\n")
-        fAll.write("G92 E0\n\n")
-        fAll.write(";End of header\n")
-
-        ##############################
-        ### 1. Check height of thread. Visit one of two points of all thread, and then make a list of height. Skip z=0.
-        threadHeights = []
-        threadHeightIndexes = []
-        for i in range(len(_lines)):
-            if (not np.isnan(_lines[i,0,0])) and _lines[i, 0, 2] != 0 and (len(threadHeights) == 0 or threadHeights[-1] != _lines[i, 0, 2]):
-                threadHeights.append(_lines[i, 0, 2])        #Do not save 0
-                threadHeightIndexes.append(i)
-
-        ##############################
-        ### 2. Get indexes of layer change lines
-        ### 2.1 For body gcode file
-        layerChangeIndexesBody = [i for i, lA in enumerate(fBodyLines) if lA.startswith(';LAYER:')]
-        ### 2.2 For anchor gcode files
-        allLayerChangeIndexesAnchor = []
-        for k in range(len(allfAnchorlines)):
-            if allfAnchorlines[k] is not None:
-                layerChangeIndexesAnchor = [i for i, lA in enumerate(allfAnchorlines[k]) if lA.startswith(';LAYER:')]
-                allLayerChangeIndexesAnchor.append(layerChangeIndexesAnchor)
-            else:
-                allLayerChangeIndexesAnchor.append(None)       
-        ### 2.3 For Thread gcode file
-        threadPauseIndexes =  [i for i, lA in enumerate(fThreadLines) if lA.startswith(';anchor')]
-        # _ui.messageBox(str(placeToPutAnchorLines))
-        
-        ##############################
-        ### 3. Combine body, anchor, thread gcode files
-        prevThreadLayerIndex = 0
-        fAll.write("T0\n")      # Say below code is for Extruder 1
-
-        ### 3.1 Add body & anchor lines until the thread height
-        threadLayer = int(threadHeights[0] / _layerThickness)
-        layerAfterThread = 0
-        for i in range(0, threadLayer + 1):
-            ### 3.1.1 Add body g-code until the thread layer
-            if i < len(layerChangeIndexesBody) - 1:
-                fAll.writelines(fBodyLines[layerChangeIndexesBody[i]:layerChangeIndexesBody[i+1]-1])
-            elif i == len(layerChangeIndexesBody) - 1:  # when i is last layer, copy until the end of the file
-                fAll.writelines(fBodyLines[layerChangeIndexesBody[i]:-1])
-            
-            ### 3.1.2 Add anchor g-code until the thread layer
-            for k in range(len(allfAnchorlines)):
-                if allfAnchorlines[k] is not None:
-                    if i < len(allLayerChangeIndexesAnchor[k]) - 1:
-                        fAll.writelines(allfAnchorlines[k][allLayerChangeIndexesAnchor[k][i]:allLayerChangeIndexesAnchor[k][i+1]-1])
-                    elif i == len(allLayerChangeIndexesAnchor[k]) - 1:  # when i is last layer, copy until the end of the file
-                        fAll.writelines(allfAnchorlines[k][allLayerChangeIndexesAnchor[k][i]:-1])
-            layerAfterThread = i
-        
-        ##############################
-        ### 4. Add anchor gcode until the end and add thread
-        layerAfterThread += 1
-        threadCounter = 0
-        for k in range(len(allfAnchorlines)): 
-            if allfAnchorlines[k] is not None:
-                fAll.writelines(allfAnchorlines[k][allLayerChangeIndexesAnchor[k][layerAfterThread]:-1])
-            else: #TODO write thread lines
-                fAll.write("T1 ;Thread\n")
-                if threadCounter < len(threadPauseIndexes) - 1:
-                    fAll.writelines(fThreadLines[threadPauseIndexes[threadCounter]+1:threadPauseIndexes[threadCounter+1]])
-                elif threadCounter == len(threadPauseIndexes) - 1:
-                    fAll.writelines(fThreadLines[threadPauseIndexes[threadCounter]+1:])
-                fAll.write("T0 ;End of thread\n")
-                threadCounter += 1
-
-        ##############################
-        ### 5. Add rest of the body lines
-        # _ui.messageBox('layerAfterThread:'+str(layerAfterThread)+'\nlen(layerChangeIndexesBody):'+str(len(layerChangeIndexesBody)))
-        if layerAfterThread <= len(layerChangeIndexesBody):
-            fAll.writelines(fBodyLines[layerChangeIndexesBody[layerAfterThread]:-1])
-            
-        ##############################
-        # 6. Add footer
-        fAll.write(';Footer\n')
-        fAll.write('M104 S0 ; turn off temperature\n')
-        fAll.write('G28 X0  ; home X axis\n')
-        fAll.write('M84     ; disable motors\n\n')
-        fAll.write('M140 S0 ; set bed temperature\n')
-        fAll.write(';End of footer \n')
-
-        fBody.close()
-        fAnchor.close()
-        fThread.close()
-        fAll.close()
+def sliceBodyAndAnchors(bodyStlPaths=None):
+    # Slice the body and all anchors at the same time, then clean the g-code.
+    global _bodyGcode, _anchorGcodes
+    settings = getSettings()
+    if bodyStlPaths is None:
+        bodyStlPaths = getBodyStlPaths()
+    _bodyGcode, _anchorGcodes = exportEngine.exportBodyAndAnchors(bodyStlPaths, getAnchorStlPaths(), settings, exportEngine.openSlicerCache(settings),
+                                                                  _manifest, _stlFingerprints if _manifest is not None else None)
 
 
-    except:
-        if _ui:
-            _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+def exportAll():
+    exportEngine.exportAll(_lines, getAnchorStlPaths(), getSettings(), _bodyGcode, _anchorGcodes, _threadGcode)
 
 
 
@@ -1077,7 +643,12 @@ class MyCommandDestroyHandler(adsk.core.CommandEventHandler):
         try:
             # when the command is done, terminate the script
             # this will release all globals which will remove all event handlers
-            adsk.terminate()
+            # A running export terminates the script when it is done instead
+            global _terminateWhenDone
+            if _exportWorker is not None and _exportWorker.is_alive():
+                _terminateWhenDone = True
+            else:
+                adsk.terminate()
         except:
             if _ui:
                 _ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
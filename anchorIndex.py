@@ -0,0 +1,196 @@
+# Spatial index of the anchors for exportEngine.exportThread.
+# A thread segment must not be pulled through an anchor that is already printed. The bounding boxes of the anchor stl
+# files are put in a uniform grid over XY, so each segment is tested only against the boxes in the cells it covers
+# instead of against every anchor.
+
+import os
+
+import numpy as np
+
+import stlTools
+
+
+maxCellsPerAxis = 256
+
+
+def stlBounds(path):
+    # (min, max) corners of the triangles of an stl file, or None if it has none
+    triangles = stlTools.readStlTriangles(path)
+    if len(triangles) == 0:
+        return None
+    vertices = np.asarray(triangles['vertices'], dtype=float).reshape(-1, 3)
+    return vertices.min(axis=0), vertices.max(axis=0)
+
+
+def _expandRanges(starts, counts):
+    # For ranges [start, start+count): the index of the range and the value of every element
+    owners = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return owners, np.arange(int(counts.sum())) - np.repeat(offsets - starts, counts)
+
+
+class AnchorGrid:
+    def __init__(self, boxes, groups, cellSize=None):
+        # boxes is (M,2,3): min and max corner of every anchor. groups is the anchor group of each, in print order.
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 2, 3)
+        self.groups = np.asarray(groups, dtype=np.int64)
+        if len(self.boxes) == 0:
+            self.origin, self.cellSize, self.shape = np.zeros(2), 1.0, (1, 1)
+            self.cellStarts = np.zeros(2, dtype=np.int64)
+            self.cellBoxes = np.zeros(0, dtype=np.int64)
+            return
+
+        # Cells about twice the size of a typical anchor, with at most maxCellsPerAxis cells along X and Y
+        low = self.boxes[:,0,:2].min(axis=0)
+        high = self.boxes[:,1,:2].max(axis=0)
+        if cellSize is None:
+            cellSize = 2 * float(np.median(np.max(self.boxes[:,1,:2] - self.boxes[:,0,:2], axis=1)))
+        cellSize = max(cellSize, float(np.max(high - low)) / maxCellsPerAxis, 1e-3)
+        self.origin = low
+        self.cellSize = cellSize
+        self.shape = tuple(int(n) for n in np.floor((high - low) / cellSize).astype(np.int64) + 1)
+
+        # Box indexes sorted by cell, and where the boxes of every cell start
+        first, last = self.cellRange(self.boxes[:,0,:2], self.boxes[:,1,:2])
+        counts = np.prod(last - first + 1, axis=1)
+        boxIndexes, k = _expandRanges(np.zeros(len(counts), dtype=np.int64), counts)
+        width = (last - first + 1)[boxIndexes, 1]
+        cells = (first[boxIndexes, 0] + k // width) * self.shape[1] + first[boxIndexes, 1] + k % width
+        order = np.argsort(cells, kind='stable')
+        self.cellBoxes = boxIndexes[order]
+        self.cellStarts = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    @classmethod
+    def fromStlFiles(cls, anchorStlPaths, cellSize=None):
+        # anchorStlPaths has the layout of ExportThread.getAnchorStlPaths(): None separates the groups.
+        # Files that were not exported are left out.
+        boxes = []
+        groups = []
+        group = 0
+        for path in anchorStlPaths:
+            if path is None:
+                group += 1
+            elif os.path.exists(path):
+                bounds = stlBounds(path)
+                if bounds is not None:
+                    boxes.append(bounds)
+                    groups.append(group)
+        return cls(np.array(boxes).reshape(-1, 2, 3), groups, cellSize)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def cellRange(self, low, high):
+        # First and last cell along X and Y of the XY ranges [low, high], clipped to the grid
+        shape = np.array(self.shape)
+        first = np.clip(np.floor((low - self.origin) / self.cellSize), 0, shape - 1).astype(np.int64)
+        last = np.clip(np.floor((high - self.origin) / self.cellSize), 0, shape - 1).astype(np.int64)
+        return first, last
+
+    def candidates(self, p1, p2, clearance):
+        # Pairs (segment, box) of the boxes in the cells within clearance of the XY segments p1-p2. Only the cells
+        # along a segment are visited, column by column: in every column the segment covers the Y range it has at the
+        # two sides of the column. A pair can show up once per shared cell.
+        shape = np.array(self.shape)
+        low = np.minimum(p1, p2)
+        high = np.maximum(p1, p2)
+        outside = np.any((high + clearance < self.origin) | (low - clearance > self.origin + shape * self.cellSize), axis=1)
+        first, last = self.cellRange(low - clearance, high + clearance)
+        columnCounts = np.where(outside, 0, last[:,0] - first[:,0] + 1)
+        segments, columns = _expandRanges(first[:,0], columnCounts)
+
+        # Y of the segment at the X range of the column grown by clearance, clipped to the segment
+        columnLow = self.origin[0] + columns * self.cellSize - clearance
+        xLow = np.clip(columnLow, low[segments,0], high[segments,0])
+        xHigh = np.clip(columnLow + self.cellSize + 2 * clearance, low[segments,0], high[segments,0])
+        start = p1[segments]
+        direction = p2[segments] - start
+        flat = direction[:,0] == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(flat, 0, direction[:,1] / direction[:,0])
+        yAtLow = start[:,1] + (xLow - start[:,0]) * slope
+        yAtHigh = start[:,1] + (xHigh - start[:,0]) * slope
+        yLow = np.where(flat, low[segments,1], np.minimum(yAtLow, yAtHigh)) - clearance
+        yHigh = np.where(flat, high[segments,1], np.maximum(yAtLow, yAtHigh)) + clearance
+        yFirst = np.clip(np.floor((yLow - self.origin[1]) / self.cellSize), 0, shape[1] - 1).astype(np.int64)
+        yLast = np.clip(np.floor((yHigh - self.origin[1]) / self.cellSize), 0, shape[1] - 1).astype(np.int64)
+
+        owners, cellYs = _expandRanges(yFirst, yLast - yFirst + 1)
+        cells = columns[owners] * self.shape[1] + cellYs
+        starts = self.cellStarts[cells]
+        pairOwners, pairSlots = _expandRanges(starts, self.cellStarts[cells + 1] - starts)
+        return segments[owners[pairOwners]], self.cellBoxes[pairSlots]
+
+    def conflicts(self, lines, lineGroups, clearance, chunkSize=4096):
+        # Anchors in the way of the thread segments (N,2,3). A segment of group g can hit the anchors of groups 0 to g,
+        # which are printed before it. It conflicts with an anchor when it passes through the anchor box grown by
+        # clearance in X and Y, below its top plus clearance. Anchors around either end of the segment hold the thread
+        # and are not in the way. Returns the pairs (segment, anchor), sorted by segment.
+        # Segments are tested chunkSize at a time to bound the memory of the candidate pairs.
+        lines = np.asarray(lines, dtype=float)
+        lineGroups = np.asarray(lineGroups)
+        valid = np.flatnonzero(~np.isnan(lines[:,0,0]))
+        found = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))]
+        if len(self) == 0:
+            valid = valid[:0]
+        for chunkStart in range(0, len(valid), chunkSize):
+            rows = valid[chunkStart:chunkStart + chunkSize]
+            segments, boxes = self._conflicts(lines[rows,0], lines[rows,1], lineGroups[rows], clearance)
+            found.append((rows[segments], boxes))
+        return np.concatenate([pair[0] for pair in found]), np.concatenate([pair[1] for pair in found])
+
+    def _conflicts(self, p1, p2, lineGroups, clearance):
+        segments, boxes = self.candidates(p1[:,:2], p2[:,:2], clearance)
+        keep = self.groups[boxes] <= lineGroups[segments]
+        segments, boxes = segments[keep], boxes[keep]
+
+        # Slab test of every segment against the box grown by clearance, which reaches down without end.
+        # Both the segment and the box are (start, end) pairs along X, Y and Z.
+        enter = np.zeros(len(segments))
+        leave = np.ones(len(segments))
+        ends = []
+        for axis in range(3):
+            a = p1[segments, axis]
+            b = p2[segments, axis]
+            high = self.boxes[boxes,1,axis] + clearance
+            if axis < 2:
+                low = self.boxes[boxes,0,axis] - clearance
+                ends.append(((a >= low) & (a <= high), (b >= low) & (b <= high)))
+            else:
+                low = np.full(len(boxes), -np.inf)
+            direction = b - a
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t0 = (low - a) / direction
+                t1 = (high - a) / direction
+            flat = direction == 0
+            inside = (a >= low) & (a <= high)
+            np.maximum(enter, np.where(flat, np.where(inside, 0, 2), np.minimum(t0, t1)), out=enter)
+            np.minimum(leave, np.where(flat, np.where(inside, 1, -1), np.maximum(t0, t1)), out=leave)
+        hit = enter <= leave
+
+        # An anchor around either end of the segment holds it
+        hit &= ~(ends[0][0] & ends[1][0]) & ~(ends[0][1] & ends[1][1])
+        pairs = np.unique(segments[hit] * len(self) + boxes[hit])
+        return pairs // len(self), pairs % len(self)
+
+    def holds(self, points, pointGroups, clearance):
+        # Whether an anchor of groups 0 to g is within clearance of every XY point of group g. nan points are not held.
+        points = np.asarray(points, dtype=float)
+        held = np.zeros(len(points), dtype=bool)
+        valid = np.flatnonzero(~np.isnan(points[:,0]))
+        if len(self) == 0 or len(valid) == 0:
+            return held
+        xy = points[valid,:2]
+        rows, boxes = self.candidates(xy, xy, clearance)
+        inside = (self.groups[boxes] <= np.asarray(pointGroups)[valid][rows]) & \
+                 np.all((xy[rows] >= self.boxes[boxes,0,:2] - clearance) & (xy[rows] <= self.boxes[boxes,1,:2] + clearance), axis=1)
+        held[valid[rows[inside]]] = True
+        return held
+
+    def clearHeights(self, lines, lineGroups, clearance):
+        # Height every segment has to be lifted to, to pass over the anchors in its way. nan if none is in the way.
+        segments, boxes = self.conflicts(lines, lineGroups, clearance)
+        heights = np.full(len(lines), -np.inf)
+        np.maximum.at(heights, segments, self.boxes[boxes,1,2] + clearance)
+        heights[np.isinf(heights)] = np.nan
+        return heights, len(segments)
@@ -0,0 +1,98 @@
+# Travel-optimized order of the anchor layers for exportEngine.exportAll.
+# On every layer the body is printed first and then one layer of every anchor. Each anchor layer is a block that
+# starts and ends at known XY points. The blocks of a layer are put in nearest-neighbour order from where the body
+# layer ends and then improved with 2-opt, so the nozzle does not zig-zag across the bed between anchors.
+# A block cannot be printed backwards, so the travel from A to B is not the travel from B to A: 2-opt adds up the
+# travel of a reversed run of blocks from prefix sums of the travel between neighbours in both directions.
+
+import numpy as np
+
+
+maxMoves = 1000         # 2-opt reversals per layer at most
+
+
+def _distances(fromPoints, toPoints):
+    return np.hypot(*(np.asarray(toPoints) - np.asarray(fromPoints)).T)
+
+
+def travelLength(order, starts, ends, origin=None, finish=None):
+    # Travel from origin through the blocks in order to finish. origin and finish None: no travel before or after.
+    order = np.asarray(order, dtype=np.int64)
+    if len(order) == 0:
+        return 0.0
+    length = float(_distances(ends[order[:-1]], starts[order[1:]]).sum())
+    if origin is not None:
+        length += float(np.hypot(*(starts[order[0]] - origin)))
+    if finish is not None:
+        length += float(np.hypot(*(finish - ends[order[-1]])))
+    return length
+
+
+def nearestNeighbour(starts, ends, origin=None):
+    # From origin, or from the end of the first block, always on to the block that starts closest
+    count = len(starts)
+    left = np.ones(count, dtype=bool)
+    order = []
+    point = origin
+    if point is None:
+        order.append(0)
+        left[0] = False
+        point = ends[0]
+    for step in range(len(order), count):
+        distances = np.where(left, np.hypot(*(starts - point).T), np.inf)
+        block = int(np.argmin(distances))
+        order.append(block)
+        left[block] = False
+        point = ends[block]
+    return np.array(order, dtype=np.int64)
+
+
+def twoOpt(order, starts, ends, origin=None, finish=None):
+    # Reverse the run of blocks order[i..j] that shortens the travel most, until no reversal shortens it.
+    # With origin None the first block stays first.
+    order = np.array(order, dtype=np.int64)
+    count = len(order)
+    if count < 2:
+        return order
+    first = 0 if origin is not None else 1
+    i, j = np.triu_indices(count, 1)
+    keep = i >= first
+    i, j = i[keep], j[keep]
+    for step in range(maxMoves):
+        blockStarts = starts[order]
+        blockEnds = ends[order]
+        # Travel between neighbours forwards and backwards, and their sums up to every block
+        forward = np.concatenate(([0.0], np.cumsum(_distances(blockEnds[:-1], blockStarts[1:]))))
+        backward = np.concatenate(([0.0], np.cumsum(_distances(blockEnds[1:], blockStarts[:-1]))))
+
+        # Point before block i and after block j, nan when there is none
+        before = np.vstack(([origin] if origin is not None else [[np.nan, np.nan]], blockEnds[:-1]))
+        after = np.vstack((blockStarts[1:], [finish] if finish is not None else [[np.nan, np.nan]]))
+        oldIn = np.nan_to_num(_distances(before[i], blockStarts[i]))
+        newIn = np.nan_to_num(_distances(before[i], blockStarts[j]))
+        oldOut = np.nan_to_num(_distances(blockEnds[j], after[j]))
+        newOut = np.nan_to_num(_distances(blockEnds[i], after[j]))
+        change = newIn + (backward[j] - backward[i]) + newOut - oldIn - (forward[j] - forward[i]) - oldOut
+        if len(change) == 0:
+            break
+        best = int(np.argmin(change))
+        if change[best] > -1e-9:
+            break
+        order[i[best]:j[best] + 1] = order[i[best]:j[best] + 1][::-1].copy()
+    return order
+
+
+def orderBlocks(starts, ends, origin=None, finish=None):
+    # Order of the blocks with the least travel found, and the travel in the given order and in that order.
+    # The given order is kept when the search does not shorten the travel.
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    given = np.arange(len(starts))
+    before = travelLength(given, starts, ends, origin, finish)
+    if len(starts) < 2:
+        return given, before, before
+    order = twoOpt(nearestNeighbour(starts, ends, origin), starts, ends, origin, finish)
+    after = travelLength(order, starts, ends, origin, finish)
+    if after >= before:
+        return given, before, before
+    return order, before, after
@@ -0,0 +1,335 @@
+# Benchmarks of the export stages with synthetic input, for tracking performance across versions.
+# Neither Fusion nor Slic3r is needed. A stub of the adsk modules is installed so that ExportThread.py can be imported,
+# and Slic3r-style g-code is generated instead of sliced.
+#
+# Usage:
+#   python benchmark.py                                   # all sizes, results in benchmark-results.json
+#   python benchmark.py --quick                           # smallest sizes only
+#   python benchmark.py --layers 100,1000 --anchors 1,10 --segments 10,1000 -o results.json
+#
+# Stages:
+#   exportThread        ExportThread.exportThread with stub SketchLines: read selections, order, make thread g-code
+#   cleanGcode          cleanup of one Slic3r g-code file, as in exportBody and exportAnchor
+#   gcodeColumns        parse of one Slic3r g-code file into columns and formatting it back
+#   rebaseEValues       E value shifts of step 4 of the cleanup on every extrusion line of one file, one and four at once
+#   anchorClearance     grid of the anchor boxes and the segments that pass through them
+#   threadLayers        body layer of every thread group, for groups at rising heights
+#   exportAll           merge of body, anchor and thread g-code into output-all.gcode
+# Every case reports the best wall and CPU time of --repeat runs and the peak Python memory of one more run.
+
+import argparse
+import datetime
+import gc
+import importlib.util
+import json
+import os, platform, sys
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+import anchorIndex
+import exportEngine
+import gcodeColumns
+import gcodeEValues
+
+
+##############################
+# adsk stub
+class _StubType:
+    # Stands for every adsk class. cast() returns its argument, like a successful cast in Fusion.
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def cast(obj):
+        return obj
+
+
+def installAdskStub():
+    if 'adsk' in sys.modules:
+        return
+    adsk = types.ModuleType('adsk')
+    for name in ('core', 'fusion', 'cam'):
+        module = types.ModuleType('adsk.' + name)
+        module.__getattr__ = lambda attr: _StubType
+        setattr(adsk, name, module)
+        sys.modules['adsk.' + name] = module
+    sys.modules['adsk'] = adsk
+
+
+class _StubUI:
+    def messageBox(self, message):
+        raise RuntimeError(message)
+
+
+class _StubPoint:
+    # Fusion points are in cm
+    def __init__(self, p):
+        self.x, self.y, self.z = p[0] / 10, p[1] / 10, p[2] / 10
+
+
+class _StubSketchLine:
+    def __init__(self, start, end):
+        self.worldGeometry = types.SimpleNamespace(startPoint=_StubPoint(start), endPoint=_StubPoint(end))
+
+    def classType(self):
+        return "adsk::fusion::SketchLine"
+
+
+def importExportThread():
+    installAdskStub()
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ExportThread.py")
+    spec = importlib.util.spec_from_file_location("ExportThread", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module._ui = _StubUI()
+    if not hasattr(module, '_slic3rPath'):     # ExportThread.py only sets these on Windows and Mac
+        defaults = exportEngine.PrintSettings()
+        module._filePath, module._slic3rPath, module._slic3rExe = defaults.filePath, defaults.slic3rPath, defaults.slic3rExe
+    return module
+
+
+##############################
+# Synthetic input
+def synthThreadLines(segments, groups, settings, height=2.0, seed=0, heightStep=0.0):
+    # Connected thread segments in design coordinates (mm), starting at the thread origin.
+    # A row of nan is put after each of the groups, as ExportThread.py does after each thread selector.
+    # Group g is laid at height + g * heightStep, so with heightStep its first segment rises from the group before.
+    rnd = random.Random(seed)
+    points = [(settings.threadOriginX, 0.0, 0.0)]
+    groupSize = max(1, -(-segments // groups))
+    for i in range(segments):
+        points.append((settings.threadOriginX + rnd.uniform(10, settings.bedSizeX - 10), rnd.uniform(20, settings.bedSizeY - 20),
+                       height + i // groupSize * heightStep))
+
+    lines = []
+    for i in range(segments):
+        lines.append([points[i], points[i+1]])
+        if (i + 1) % groupSize == 0 or i == segments - 1:
+            lines.append([[np.nan] * 3, [np.nan] * 3])
+    return np.array(lines, dtype=float)
+
+
+def synthSlic3rGcode(path, layers, movesPerLayer=20, layerHeight=0.2, bounds=(0, 0, 60, 60), seed=0):
+    # Write g-code with the header, layer changes, retractions, fan commands and footer of Slic3r 1.3
+    rnd = random.Random(seed)
+    x0, y0, x1, y1 = bounds
+    with open(path, "w") as f:
+        f.write("; generated by Slic3r 1.3.0\n\n")
+        f.write("M107\nM104 S200 ; set temperature\nG28 ; home all axes\nG1 Z5 F5000 ; lift nozzle\n\n; Filament gcode\n\n")
+        f.write("M109 S200 ; set temperature and wait for it to be reached\nG21 ; set units to millimeters\n")
+        f.write("G90 ; use absolute coordinates\nM82 ; use absolute distances for extrusion\nG92 E0\n")
+        e = 0.0
+        for layer in range(layers):
+            f.write("G1 E%.5f F2400.00000\nG92 E0\n" % (e - 2))
+            f.write("G1 Z%.3f F7800.000\n" % (layerHeight * (layer + 1)))
+            if layer == 1:
+                f.write("M106 S255\n")
+            f.write("G1 X%.3f Y%.3f F7800.000\n" % (rnd.uniform(x0, x1), rnd.uniform(y0, y1)))
+            f.write("G1 E2.00000 F2400.00000\nG1 F1800.000\n")
+            e = 2.0
+            for move in range(movesPerLayer):
+                e += rnd.uniform(0.01, 0.5)
+                f.write("G1 X%.3f Y%.3f E%.5f\n" % (rnd.uniform(x0, x1), rnd.uniform(y0, y1), e))
+        f.write("G1 E%.5f F2400.00000\nG92 E0\n" % (e - 2))
+        f.write("M107\nM104 S0 ; turn off temperature\nG28 X0  ; home X axis\nM84     ; disable motors\n\n")
+
+
+##############################
+# Measurement
+def measure(fn, repeat):
+    wall = []
+    cpu = []
+    for i in range(repeat):
+        gc.collect()
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        fn()
+        cpu.append(time.process_time() - cpuStart)
+        wall.append(time.perf_counter() - wallStart)
+
+    # tracemalloc slows everything down, so memory is measured in a separate run
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'wallSeconds': min(wall), 'cpuSeconds': min(cpu), 'peakBytes': peakBytes}
+
+
+def benchExportThread(segmentCounts, workDir, repeat):
+    module = importExportThread()
+    module._filePath = workDir
+    results = []
+    for segments in segmentCounts:
+        lines = synthThreadLines(segments, 1, module.getSettings())
+        module._selectedLines[:] = [_StubSketchLine(line[0], line[1]) if not np.isnan(line[0, 0]) else None for line in lines]
+        results.append(dict(stage='exportThread', params={'segments': segments}, **measure(module.exportThread, repeat)))
+    return results
+
+
+def benchCleanGcode(layerCounts, workDir, repeat):
+    results = []
+    for layers in layerCounts:
+        rawPath = os.path.join(workDir, "bench-body.gcode")
+        synthSlic3rGcode(rawPath, layers)
+        results.append(dict(stage='cleanGcode', params={'layers': layers, 'bytes': os.path.getsize(rawPath)},
+                            **measure(lambda: exportEngine.cleanGcode(rawPath, 'BODY'), repeat)))
+    return results
+
+
+def benchGcodeColumns(layerCounts, workDir, repeat):
+    results = []
+    for layers in layerCounts:
+        rawPath = os.path.join(workDir, "bench-body.gcode")
+        synthSlic3rGcode(rawPath, layers)
+        with open(rawPath, "rb") as f:
+            data = f.read()
+        columns = gcodeColumns.GcodeColumns.parse(data)
+        params = {'layers': layers, 'lines': len(columns), 'bytes': len(data)}
+        results.append(dict(stage='gcodeColumns.parse', params=params, **measure(lambda: gcodeColumns.GcodeColumns.parse(data), repeat)))
+        results.append(dict(stage='gcodeColumns.format', params=params, **measure(columns.tobytes, repeat)))
+    return results
+
+
+def benchRebaseEValues(layerCounts, workDir, repeat):
+    results = []
+    for layers in layerCounts:
+        rawPath = os.path.join(workDir, "bench-body.gcode")
+        synthSlic3rGcode(rawPath, layers)
+        with open(rawPath, "r") as f:
+            lines = [line for line in f if line.startswith('G1 X') and line.find('E') != -1]
+        shiftValues = np.array([-3.0, 12.5, 0.25, -7.125])
+        for shifts in (1, 4):
+            first = np.zeros(len(lines), dtype=np.int64)
+            count = np.full(len(lines), shifts, dtype=np.int64)
+            run = lambda: gcodeEValues.rebaseEValues(lines, first, count, shiftValues)
+            results.append(dict(stage='rebaseEValues', params={'layers': layers, 'lines': len(lines), 'shifts': shifts}, **measure(run, repeat)))
+    return results
+
+
+def benchAnchorClearance(segmentCounts, anchorCounts, repeat):
+    settings = exportEngine.PrintSettings()
+    results = []
+    for anchorCount in anchorCounts:
+        # 4 x 4 mm anchors over the bed, in one group
+        rnd = random.Random(0)
+        corners = [(rnd.uniform(0, settings.bedSizeX - 4), rnd.uniform(0, settings.bedSizeY - 4)) for k in range(anchorCount)]
+        boxes = np.array([[[x, y, 0], [x + 4, y + 4, 4]] for x, y in corners], dtype=float)
+        for segments in segmentCounts:
+            lines = synthThreadLines(segments, 1, settings)
+            lines[:,:,0] -= settings.threadOriginX
+            lineGroups = np.zeros(len(lines), dtype=np.int64)
+            run = lambda: anchorIndex.AnchorGrid(boxes, np.zeros(anchorCount)).clearHeights(lines, lineGroups, settings.anchorClearance)
+            results.append(dict(stage='anchorClearance', params={'anchors': anchorCount, 'segments': segments}, **measure(run, repeat)))
+    return results
+
+
+def benchExportAll(layerCounts, anchorCounts, workDir, repeat):
+    settings = exportEngine.PrintSettings(filePath=workDir, useCache=False)
+    rawPath = os.path.join(workDir, "bench-raw.gcode")
+    results = []
+    for layers in layerCounts:
+        synthSlic3rGcode(rawPath, layers)
+        body = exportEngine.cleanGcode(rawPath, 'BODY')
+        synthSlic3rGcode(rawPath, min(layers, 30), movesPerLayer=8, bounds=(20, 20, 24, 24))
+        anchor = exportEngine.cleanGcode(rawPath, 'ANCHOR')
+
+        for anchorCount in anchorCounts:
+            # One anchor per group, so every anchor is followed by a thread block
+            anchorStlPaths = []
+            anchors = []
+            for k in range(anchorCount):
+                anchorStlPaths += ["anchor%d.stl" % k, None]
+                anchors += [anchor, None]
+            lines, threadGcode = exportEngine.exportThread(synthThreadLines(anchorCount * 4, anchorCount, settings), settings)
+            run = lambda: exportEngine.exportAll(lines, anchorStlPaths, settings, body, anchors, threadGcode)
+            result = dict(stage='exportAll', params={'layers': layers, 'anchors': anchorCount}, **measure(run, repeat))
+            result['params']['bytes'] = os.path.getsize(os.path.join(workDir, "output-all.gcode"))
+            results.append(result)
+    return results
+
+
+def benchThreadLayers(segmentCounts, workDir, repeat):
+    # Layers of thread groups laid at rising heights. test_threadGroupLayers.py checks that they are right
+    settings = exportEngine.PrintSettings(filePath=workDir, useCache=False)
+    rawPath = os.path.join(workDir, "bench-raw.gcode")
+    synthSlic3rGcode(rawPath, 100)
+    bodyIndex = exportEngine.cleanGcode(rawPath, 'BODY').index
+    results = []
+    for segments in segmentCounts:
+        groups = min(segments, 8)
+        lines, pieces = exportEngine.chainThreadLines(synthThreadLines(segments, groups, settings, heightStep=2.0), (settings.threadOriginX, 0, 0))
+        run = lambda: exportEngine.threadGroupLayers(lines, bodyIndex)
+        results.append(dict(stage='threadLayers', params={'segments': segments, 'groups': groups}, **measure(run, repeat)))
+    return results
+
+
+def versionInfo():
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def intList(text):
+    return [int(value) for value in text.split(',') if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the export stages with synthetic input.')
+    parser.add_argument('--layers', type=intList, default=[100, 1000, 10000], help='Comma separated layer counts of the body g-code.')
+    parser.add_argument('--anchors', type=intList, default=[1, 10, 50], help='Comma separated anchor counts.')
+    parser.add_argument('--segments', type=intList, default=[10, 1000, 100000], help='Comma separated thread segment counts.')
+    parser.add_argument('--stages', default='exportThread,cleanGcode,gcodeColumns,rebaseEValues,anchorClearance,threadLayers,exportAll', help='Comma separated stages to run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case. The best one is reported.')
+    parser.add_argument('--quick', action='store_true', help='Only the smallest size of each parameter.')
+    parser.add_argument('-o', '--output', default='benchmark-results.json', help='JSON file for the results.')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.layers, args.anchors, args.segments = args.layers[:1], args.anchors[:1], args.segments[:1]
+    stages = args.stages.split(',')
+
+    exportEngine.showMessage = lambda message: None
+    workDir = tempfile.mkdtemp(prefix='exportthread-bench-')
+    results = []
+    try:
+        if 'exportThread' in stages:
+            results += benchExportThread(args.segments, workDir, args.repeat)
+        if 'cleanGcode' in stages:
+            results += benchCleanGcode(args.layers, workDir, args.repeat)
+        if 'gcodeColumns' in stages:
+            results += benchGcodeColumns(args.layers, workDir, args.repeat)
+        if 'rebaseEValues' in stages:
+            results += benchRebaseEValues(args.layers, workDir, args.repeat)
+        if 'anchorClearance' in stages:
+            results += benchAnchorClearance(args.segments, args.anchors, args.repeat)
+        if 'threadLayers' in stages:
+            results += benchThreadLayers(args.segments, workDir, args.repeat)
+        if 'exportAll' in stages:
+            results += benchExportAll(args.layers, args.anchors, workDir, args.repeat)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    for result in results:
+        params = ' '.join('{}={}'.format(name, value) for name, value in result['params'].items())
+        print('{:<20}{:<40}{:>10.4f} s {:>10.4f} s cpu {:>10.1f} MB'.format(result['stage'], params, result['wallSeconds'],
+                                                                              result['cpuSeconds'], result['peakBytes'] / (1 << 20)))
+
+    with open(args.output, "w") as f:
+        json.dump({'version': versionInfo(), 'repeat': args.repeat, 'results': results}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
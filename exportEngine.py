@@ -0,0 +1,1232 @@
+# Headless export engine for ExportThread.
+# Converts thread lines, STL files and print settings to g-code without Fusion 360.
+# ExportThread.py collects the selections inside Fusion and calls the functions below.
+#
+# Command line usage:
+#   python exportEngine.py --threads ExportThread.pythreadCoordinates.txt --ring-coordinates
+#       --body body.stl --anchors anchor0.stl,anchor1.stl -o output/
+
+import subprocess
+import math
+import sys, os, platform
+import signal
+import argparse
+import heapq
+import gzip
+import re
+import collections
+import concurrent.futures
+import threading
+import traceback
+
+import numpy as np
+
+import anchorIndex
+import anchorOrder
+import exportManifest
+import exportReport
+import gcodeArcs
+import gcodeCleaner
+import gcodeColumns
+import gcodeCompact
+import gcodeIndex
+import slicerCache
+import stlTools
+
+# Change when cleanSlic3rGcode writes different output, so that cached cleaned g-code is not reused.
+_cleanVersion = 2
+
+# An X or Y word in a gcodeColumns template that is kept as text, so translateGcode() cannot move it
+_literalXY = re.compile('[ \t][XY](?!%)')
+
+
+class PrintSettings:
+    def __init__(self, **kwargs):
+        # Output folder and Slic3r location
+        if platform.system() == 'Windows':
+            self.filePath = "C:\\Program Files\\Slic3r"
+            self.slic3rPath = "C:\\Program Files\\Slic3r\\"
+            self.slic3rExe = 'slic3r-console'
+        elif platform.system() == 'Darwin':
+            self.filePath = '/tmp'
+            self.slic3rPath = '/Applications/Slic3r.app/Contents/MacOS'
+            self.slic3rExe = 'Slic3r'
+        else:
+            self.filePath = '/tmp'
+            self.slic3rPath = ''        # Use slic3r from PATH
+            self.slic3rExe = 'slic3r'
+
+        # Print settings
+        self.layerThickness = 0.2
+        self.bedSizeX = 79        ##TODO Currently set for 79 x 235 mm.
+        self.bedSizeOriginalX = 235
+        self.bedSizeY = 235
+        self.temperature = 200
+        self.bedTemperature = 60
+        self.filamentDiameter = 1.75
+        self.nozzleDiameter = 0.4
+        self.slicerWorkers = os.cpu_count() or 1     # Slic3r processes running at the same time
+
+        # Cache of Slic3r output. cacheDir None means a slic3r-cache folder in filePath.
+        self.useCache = True
+        self.cacheDir = None
+        self.cacheMaxBytes = 1 << 30
+        self.writeBufferSize = 8 << 20     # Write buffer of output-all.gcode
+        self.compactOutput = False         # Round coordinates and drop repeated words, resets and comments. See gcodeCompact.py
+        self.compactDecimals = 3           # Decimals of X, Y, Z and F in compact output
+        self.compactEDecimals = 5          # Decimals of E in compact output
+        self.gzipOutput = False            # Write output-all.gcode.gz instead of output-all.gcode
+        self.gzipLevel = 6
+        self.incremental = True            # Skip slicing of stl files that did not change since the last export. Needs the cache
+        self.writeReport = True            # Write export-report.json and export-report.txt next to output-all.gcode
+        self.profile = False               # Also write a cProfile dump, export-profile.prof
+        self.keepTmpFiles = False          # Also write output-thread-tmp.gcode and the other -tmp files, for debugging
+        self.reuseAnchorSlices = True      # Slice each anchor shape once and move its g-code to the other copies
+        self.mergeSegments = False         # Merge nearly collinear extrusion moves of the body and anchors. See gcodeArcs.py
+        self.fitArcs = False               # Replace extrusion moves along a circle with G2/G3 arcs
+        self.segmentTolerance = 0.01       # mm. How far merged moves and arcs may be from the points they replace
+        self.orderAnchors = True           # Print the anchor layers of every layer in the order with the least travel. See anchorOrder.py
+        self.batchThreads = True           # Lay thread blocks with nothing printed between them under one tool change
+
+        # Thread ring
+        self.ringRadius = 100             # mm
+        self.ringStepsPerCircle = 142.5   # E steps for a full turn of the ring
+        self.anchorClearance = 1.0        # mm. Thread segments are lifted this far over the anchors in their way
+        self.planRingMoves = True         # Shortest ring rotations, merged moves, no repeated bed centering or G92 E0
+
+        for name, value in kwargs.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown print setting: ' + name)
+            setattr(self, name, value)
+
+    @property
+    def threadOriginX(self):
+        return -(self.bedSizeOriginalX/2 - self.bedSizeX/2)
+
+
+# Called for recoverable problems found in the g-code. ExportThread.py replaces it with a message box.
+def showMessage(message):
+    print(message, file=sys.stderr)
+
+
+# Called with the name of the running stage, the items done and the item count, e.g. ('slice', 2, 5).
+# ExportThread.py replaces it to move its progress dialog. It can be called from any thread.
+def showProgress(stage, done, total):
+    pass
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+# Set by cancelExport() from any thread. Stages call checkCancelled() between their steps.
+cancelled = threading.Event()
+_slicerProcesses = set()
+_slicerProcessesLock = threading.RLock()
+
+
+def cancelExport():
+    # Stop the running export. Slic3r processes that are running are killed.
+    with _slicerProcessesLock:
+        cancelled.set()
+        killSlicers()
+
+
+def killSlicers():
+    # Kill every running Slic3r process with the processes it started
+    with _slicerProcessesLock:
+        for process in _slicerProcesses:
+            try:
+                if platform.system() == 'Windows':
+                    subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                else:
+                    os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def checkCancelled():
+    if cancelled.is_set():
+        raise ExportCancelled()
+
+
+# Timing of the stages. Replaced by startReport() for each export, like showMessage is replaced inside Fusion.
+report = exportReport.RunReport(enabled=False)
+
+
+def startReport(settings):
+    global report
+    report = exportReport.RunReport(enabled=settings.writeReport or settings.profile, profile=settings.profile)
+    report.startProfile()
+    return report
+
+
+def saveReport(settings):
+    return report.save(settings.filePath)
+
+
+def loadThreadLines(path):
+    # Read an (N,2,3) array of thread segments. Rows of NaN separate thread groups.
+    # Accepts .npy files, str(_lines) dumps such as ExportThread.pythreadCoordinates.txt,
+    # and plain text with six numbers (x1 y1 z1 x2 y2 z2) per line.
+    if path.endswith('.npy'):
+        return np.load(path).reshape(-1, 2, 3)
+
+    with open(path, "r") as f:
+        text = f.read()
+
+    text = text.strip()
+    if text.startswith('['):
+        text = text[:text.find(']]]')]     # Ignore anything written after the array
+    values = text.replace('[', ' ').replace(']', ' ').replace(',', ' ').split()
+
+    return np.array([float(v) for v in values]).reshape(-1, 2, 3)
+
+
+def slic3rOptions(settings):
+    return ["--first-layer-height", str(settings.layerThickness),
+    "--layer-height",str(settings.layerThickness),
+    "--temperature", str(settings.temperature),
+    "--bed-temperature", str(settings.bedTemperature),
+    "--filament-diameter", str(settings.filamentDiameter),
+    "--nozzle-diameter", str(settings.nozzleDiameter),
+    "--skirts", "0",
+    "--dont-arrange"]
+
+
+def sliceStl(stlPath, gcodePath, settings):
+    # CPU time of Slic3r itself is not in the record. It runs in a child process, which cancelExport() can kill.
+    command = [os.path.join(settings.slic3rPath, settings.slic3rExe), stlPath] + slic3rOptions(settings) + ["-o", gcodePath]
+    with report.stage('slic3r', file=os.path.basename(stlPath), bytesRead=os.path.getsize(stlPath)) as record:
+        with _slicerProcessesLock:
+            checkCancelled()
+            # A process group of its own on POSIX, so that killSlicers() also stops the processes Slic3r starts
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, start_new_session=platform.system() != 'Windows')
+            _slicerProcesses.add(process)
+        try:
+            output = process.communicate()[0]
+        finally:
+            with _slicerProcessesLock:
+                _slicerProcesses.discard(process)
+        checkCancelled()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output)
+        record['bytesWritten'] = os.path.getsize(gcodePath)
+    return output
+
+
+# Thread line ends closer than this (mm) are the same point. ExportThread.py rounds coordinates to 4 decimals.
+endpointQuantum = 1e-4
+
+
+def chainThreadLines(lines, origin):
+    # Orders and flips the lines of each group (rows between rows of NaN) into one path, starting at origin for the
+    # first group and where the previous group ended for the others. Ends are matched through a hash map of quantized
+    # points, so this is linear. Where the path can go on with several lines, the one selected first is taken, so lines
+    # selected in path order keep their order.
+    # When no line is left at the current point, the path goes on from the nearest end of another piece (a point with an
+    # odd number of free lines) and that end is returned as the start of a disconnected piece.
+    # Returns the new lines and the list of piece starts.
+    lines = np.array(lines, dtype=float)
+    result = lines.copy()
+    pieces = []
+    current = np.array(origin, dtype=float)
+    valid = ~np.isnan(lines[:,0,0])
+    groupStarts = np.flatnonzero(valid & ~np.concatenate(([False], valid[:-1])))
+    groupEnds = np.flatnonzero(valid & ~np.concatenate((valid[1:], [False]))) + 1
+    keys = [tuple(point) for point in np.rint(np.where(np.isnan(lines), 0, lines) / endpointQuantum).astype(np.int64).reshape(-1, 3).tolist()]
+
+    for groupStart, groupEnd in zip(groupStarts.tolist(), groupEnds.tolist()):
+        # Line ends at each point, the first selected last so that pop() takes it
+        ends = {}
+        for i in range(groupEnd - 1, groupStart - 1, -1):
+            ends.setdefault(keys[2*i+1], []).append((i, 1))
+            ends.setdefault(keys[2*i], []).append((i, 0))
+        freeCount = {key: len(value) for key, value in ends.items()}
+        used = np.zeros(groupEnd - groupStart, dtype=bool)
+        currentKey = tuple(np.rint(current / endpointQuantum).astype(np.int64).tolist())
+
+        for row in range(groupStart, groupEnd):
+            candidates = ends.get(currentKey, [])
+            while candidates and used[candidates[-1][0] - groupStart]:
+                candidates.pop()
+            if candidates:
+                i, side = candidates.pop()
+            else:
+                free = np.flatnonzero(~used) + groupStart
+                distances = np.linalg.norm(lines[free] - current, axis=2)
+                isPieceEnd = np.array([[freeCount[keys[2*i]] % 2, freeCount[keys[2*i+1]] % 2] for i in free.tolist()], dtype=bool)
+                if isPieceEnd.any():
+                    distances[~isPieceEnd] = np.inf
+                nearest = int(np.argmin(distances))
+                i, side = int(free[nearest // 2]), nearest % 2
+                pieces.append(tuple(lines[i, side].tolist()))
+            used[i - groupStart] = True
+            freeCount[keys[2*i]] -= 1
+            freeCount[keys[2*i+1]] -= 1
+            result[row] = lines[i] if side == 0 else lines[i, ::-1]
+            current = result[row, 1]
+            currentKey = keys[2*i + 1 - side]
+
+    return result, pieces
+
+
+def exportThread(lines, settings, anchorStlPaths=None):
+    # lines are thread segments in design coordinates (mm). anchorStlPaths are the exported anchors, if any, so that
+    # segments can be lifted over the anchors in their way.
+    # Returns the ordered segments shifted to the ring center and the thread g-code as bytes.
+    lines = np.array(lines, dtype=float)
+    threadOriginX = settings.threadOriginX
+
+    ##############################
+    ### 1. Order lines from the origin, whatever order they were selected in
+    with report.stage('chainThread', segments=len(lines)) as record:
+        lines, pieces = chainThreadLines(lines, (threadOriginX, 0, 0))
+        record['pieces'] = len(pieces)
+    if pieces:
+        showMessage('The thread lines are not connected. {} piece(s) do not start where the thread is, the first at X{:.4f} Y{:.4f} Z{:.4f}'.format(
+            len(pieces), *pieces[0]))
+
+    ##############################
+    ### 2. Find the anchors on the way of every segment. The anchor stl files are in design coordinates too.
+    clearHeights = None
+    anchorHolds = None
+    if anchorStlPaths:
+        with report.stage('anchorClearance', segments=len(lines)) as record:
+            grid = anchorIndex.AnchorGrid.fromStlFiles(anchorStlPaths)
+            lineGroups = np.cumsum(np.isnan(lines[:,0,0]))      # Thread group g is printed after anchor group g
+            clearHeights, conflicts = grid.clearHeights(lines, lineGroups, settings.anchorClearance)
+            anchorHolds = grid.holds(lines[:,0], lineGroups, settings.anchorClearance)
+            record['anchors'] = len(grid)
+            record['conflicts'] = conflicts
+
+    lines[:,:,0] = lines[:,:,0] - threadOriginX      # Shift x points to the center of the ring.
+
+    ##############################
+    ### 3. Conver thread geometry to g-code
+    with report.stage('threadToGcode', segments=len(lines)) as record:
+        threadGcode = ''.join(threadToGcode(lines, settings, clearHeights, anchorHolds, record)).encode()
+        record['bytesWritten'] = len(threadGcode)
+    if settings.keepTmpFiles:
+        with open(os.path.join(settings.filePath, "output-thread-tmp.gcode"), "wb") as fThread:
+            fThread.write(threadGcode)
+
+    return lines, threadGcode
+
+
+def projectToRing(lines, settings):
+    # Project every thread segment on the ring at once. Rows of NaN stay NaN.
+    # Returns the target spool points (N,2), their theta, their z and the ring position in E steps.
+    h = settings.bedSizeOriginalX/2 # Center point of the ring in mm
+    r = settings.ringRadius
+
+    x1 = lines[:,0,0]
+    y1 = lines[:,0,1]
+    z1 = lines[:,0,2]
+    x2 = lines[:,1,0]
+    y2 = lines[:,1,1]
+    z2 = lines[:,1,2]
+    vertical = x2 == x1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ### 1. Intersections of the line and the ring
+        # y = ax + b for non-vertical lines
+        la = np.where(vertical, 0, (y2-y1)/(x2-x1))
+        lb = - la*x1 + y1
+        qa = np.where(vertical, 1, 1 + la*la)                                  # a for quadratic formula    ax^2 + bx + c = 0
+        qb = np.where(vertical, -2*h, 2*la*(lb-h) - 2*h)                       # b for quadratic formula    ax^2 + bx + c = 0
+        qc = np.where(vertical, h*h + (x1-h)*(x1-h) - r*r, (lb-h)*(lb-h) + h*h - r*r)
+
+        # The real part of a complex root is -qb/2qa. Same as removing imaginary numbers.
+        sqrtD = np.sqrt(np.maximum(qb*qb - 4*qa*qc, 0))
+        root1 = (-qb-sqrtD)/(2*qa)
+        root2 = (-qb+sqrtD)/(2*qa)
+
+        spoolPoint1x = np.where(vertical, x1, root1)
+        spoolPoint1y = np.where(vertical, root1, la*root1 + lb)
+        spoolPoint2x = np.where(vertical, x1, root2)
+        spoolPoint2y = np.where(vertical, root2, la*root2 + lb)
+
+        ### 2. Choose a target spool point further from the startPoint
+        d1 = (spoolPoint1x-x1)*(spoolPoint1x-x1) + (spoolPoint1y-y1)*(spoolPoint1y-y1)
+        d2 = (spoolPoint2x-x1)*(spoolPoint2x-x1) + (spoolPoint2y-y1)*(spoolPoint2y-y1)
+        tSpoolPointx = np.where(d1 > d2, spoolPoint1x, spoolPoint2x)
+        tSpoolPointy = np.where(d1 > d2, spoolPoint1y, spoolPoint2y)
+
+        ### 3. Get spool point z. z = ax + b, or z = ay + b for vertical lines
+        lza = np.where(vertical, (z2-z1)/(y2-y1), (z2-z1)/(x2-x1))
+        tSpoolPointz = np.where(vertical, lza*tSpoolPointy + (- lza*y1 + z1), lza*tSpoolPointx + (- lza*x1 + z1))
+
+        ### 4. Get target theta. Add 180 degrees if the target point is on the left side of the ring.
+        tTheta = np.arctan((tSpoolPointy-h)/(tSpoolPointx-h))
+        tTheta = np.where(tSpoolPointx-h < 0, tTheta + math.pi, tTheta)
+
+    ### 5. A segment that only rises in Z has no direction on the bed. The ring stays where it is and the spool point
+    # rises to the end of the segment
+    valid = ~np.isnan(x1)
+    rise = valid & (x1 == x2) & (y1 == y2)
+    if rise.any():
+        rows = np.flatnonzero(valid)
+        kept = np.maximum.accumulate(np.where(rise[rows], -1, np.arange(len(rows))))
+        start = kept < 0        # Rises before any other segment keep the start of the ring at -90 degrees
+        source = rows[np.maximum(kept, 0)]
+        tTheta[rows] = np.where(start, math.radians(-90), tTheta[source])
+        tSpoolPointx[rows] = np.where(start, h, tSpoolPointx[source])
+        tSpoolPointy[rows] = np.where(start, h - r, tSpoolPointy[source])
+        tSpoolPointz[rise] = z2[rise]
+
+    ### 6. Convert the rotation from the previous target to E steps. The ring starts at -90 degrees.
+    theta = np.full(len(lines), np.nan)
+    validTheta = tTheta[valid]
+    theta[valid] = np.concatenate(([math.radians(-90)], validTheta[:-1]))
+    eValue = (tTheta - theta) / (2 * math.pi) * settings.ringStepsPerCircle     # + is to rotate the ring clockwise and - is for anticlockwise
+
+    return np.stack((tSpoolPointx, tSpoolPointy), axis=1), tTheta, tSpoolPointz, eValue
+
+
+def ringMoves(lines, eValues):
+    # Rotation written for every segment in E steps: its E value from projectToRing less the E value of the last
+    # segment before it that changes height, after which E is set to 0 again
+    moves = eValues.copy()
+    valid = np.flatnonzero(~np.isnan(lines[:,0,0]))
+    resets = (lines[valid,0,2] != lines[valid,1,2]) & (valid != 0)
+    last = np.maximum.accumulate(np.where(resets, np.arange(len(valid)), -1))
+    before = np.concatenate(([-1], last[:-1]))
+    moves[valid] = eValues[valid] - np.where(before >= 0, eValues[valid][np.maximum(before, 0)], 0)
+    return moves
+
+
+def planRingRotations(lines, eValues, settings, anchorHolds=None):
+    # Rotation of every segment in E steps, the short way round unless the thread bends around an anchor at the start
+    # of the segment. Then the ring turns the way the thread bends, so that it wraps on the right side of the anchor.
+    # anchorHolds from anchorIndex tells which segments start at an anchor. Without it no segment does.
+    # eValues are the rotations ringMoves gives, so that the planned rotation is the one written.
+    steps = settings.ringStepsPerCircle
+    valid = np.flatnonzero(~np.isnan(lines[:,0,0]))
+    planned = eValues.copy()
+    if len(valid) == 0:
+        return planned
+    if anchorHolds is None:
+        anchorHolds = np.zeros(len(lines), dtype=bool)
+    previous = np.concatenate(([valid[0]], valid[:-1]))
+    dIn = lines[previous,1,:2] - lines[previous,0,:2]
+    dOut = lines[valid,1,:2] - lines[valid,0,:2]
+    turn = dIn[:,0]*dOut[:,1] - dIn[:,1]*dOut[:,0]
+    bends = np.abs(turn) > 1e-9 * np.hypot(*dIn.T) * np.hypot(*dOut.T)
+    bends[0] = False                        # The first segment starts at the thread origin
+    bends &= anchorHolds[valid]
+
+    e = eValues[valid]
+    shortest = e - steps * np.round(e / steps)
+    planned[valid] = np.where(bends, np.where(turn > 0, np.remainder(e, steps), -np.remainder(-e, steps)), shortest)
+    return planned
+
+
+class RingGcode(list):
+    # Thread g-code lines. With plan, rotations at the same height in the same direction are merged into one move, and
+    # bed centering and G92 E0 that change nothing are left out. The state starts over at every ';anchor' line, where
+    # anchor g-code is put in between by exportAll.
+    def __init__(self, plan):
+        super().__init__()
+        self.plan = plan
+        self.bedY = None
+        self.eZero = False
+        self.pending = None     # (index, E, Z) of the last rotation, while only G92 E0 came after it
+        self.merged = 0
+        self.dropped = 0
+
+    def marker(self, line):
+        self.append(line)
+        self.bedY = None
+        self.eZero = False
+        self.pending = None
+
+    def centerBed(self, y, line):
+        if self.plan and self.bedY == y:
+            self.dropped += 1
+            return
+        self.append(line)
+        self.bedY = y
+        self.pending = None
+
+    def resetE(self, line):
+        if self.plan and self.eZero:
+            self.dropped += 1
+            return
+        self.append(line)
+        self.eZero = True
+
+    def move(self, line):
+        # Any other move of the ring
+        self.append(line)
+        self.eZero = False
+        self.pending = None
+
+    def rotate(self, e, z, mergeable):
+        if self.plan and mergeable and self.pending is not None and self.pending[2] == z and self.pending[1] * e >= 0:
+            index, total, z = self.pending
+            self.pending = (index, total + e, z)
+            self[index] = "G1 E{:.5f} Z{:.5f} F800\n".format(total + e, z)
+            self.merged += 1
+            return
+        self.append("G1 E{:.5f} Z{:.5f} F800\n".format(e, z))
+        self.eZero = False
+        self.pending = (len(self) - 1, e, z) if mergeable else None
+
+
+def threadToGcode(lines, settings, clearHeights=None, anchorHolds=None, record=None):
+    spoolPoints, tTheta, tSpoolPointz, eValues = projectToRing(lines, settings)
+    moves = ringMoves(lines, eValues)
+    plannedMoves = planRingRotations(lines, moves, settings, anchorHolds) if settings.planRingMoves else moves
+
+    # If there are anchors on the way, (1) lift the ring up, (2) go to the position (slightly outer than the anchor), (3) go to the position
+    # clearHeights from anchorIndex has the height to lift every segment to, nan if no anchor is in the way.
+    move = 0
+    ringSteps = 0
+    unplannedRingSteps = 0
+
+    gcode = RingGcode(settings.planRingMoves)
+    gcode.marker(';anchor\n')
+
+    for i in range(len(lines)):
+        if not np.isnan(lines[i,0,0]):
+            z1 = lines[i,0,2]
+            z2 = lines[i,1,2]
+            move = plannedMoves[i]
+            ringSteps += abs(move)
+            unplannedRingSteps += abs(moves[i])
+
+            if z1 != z2:
+                gcode.centerBed(settings.bedSizeY/2, 'G0 Y%.5f ; Move bed to the center\n' % (settings.bedSizeY/2))    # put print bed at the center.
+
+            if clearHeights is not None and not np.isnan(clearHeights[i]):
+                gcode.move("G1 Z{:.5f} F800 ; lift over anchors\n".format(max(clearHeights[i], tSpoolPointz[i])))
+                gcode.move("G1 E{:.5f} F800\n".format(move))
+                gcode.move("G1 Z{:.5f} F800\n".format(tSpoolPointz[i]))
+            else:
+                gcode.rotate(move, tSpoolPointz[i], z1 == z2)
+            gcode.resetE("G92 E0\n")
+
+            if z1 != z2 and i != 0:
+                gcode.resetE('G92 E0 ; set the current filament position to E2=0\n') # Assume 12 o'clock is E2=0
+                move = 0
+
+            #TODO: check if the E reset after a height change works well. I need to put thread in another layer to test this.
+
+        elif i != len(lines)-1:
+            # Add comment for anchor
+            # Add gcode lines to over-rotate the ring. Thread can be fixed during print this way. Currently rotate 30 degree of the ring.
+            if move >= 0:
+                gcode.centerBed(117.5, 'G0 Y117.50000 ; Move bed to the center\n')
+                gcode.move('G1 E12 F800\n')
+                gcode.resetE('G92 E0\n')
+                gcode.marker(';anchor\n')
+                gcode.move('G1 E-12 F800\n')
+                gcode.resetE('G92 E0\n')
+
+            else:
+                gcode.centerBed(117.5, 'G0 Y117.50000 ; Move bed to the center\n')
+                gcode.move('G1 E-12 F800\n')
+                gcode.resetE('G92 E0\n')
+                gcode.marker(';anchor\n')
+                gcode.move('G1 E12 F800\n')
+                gcode.resetE('G92 E0\n')
+
+    if record is not None:
+        record['ringSteps'] = ringSteps
+        record['ringStepsSaved'] = unplannedRingSteps - ringSteps
+        record['movesMerged'] = gcode.merged
+        record['linesDropped'] = gcode.dropped
+    return gcode
+
+
+def cleanGcode(inPath, tag):
+    # Strip header and footer of Slic3r output, set fan speed, first X/Y travel and E=0 on every layer,
+    # and put ';LAYER:n ;tag' before each 'G1 Z...'. See gcodeCleaner.py
+    # Returns the cleaned g-code in memory with its layer index, built while the lines are cleaned.
+    record = report.begin('clean', tag=tag, bytesRead=os.path.getsize(inPath))
+    timings = {} if report.enabled else None
+    index = gcodeIndex.LayerIndexBuilder()
+    cleaned = []
+    with open(inPath, "r") as fIn:
+        for line in gcodeCleaner.cleanSlic3rGcode(fIn, tag, showMessage, timings):
+            index.add(line)
+            cleaned.append(line)
+    gcode = gcodeIndex.GcodeFile.fromBytes(''.join(cleaned).encode(), index.finish())
+
+    record['bytesWritten'] = gcode.index.byteCount
+    report.end(record)
+    for step, (wallSeconds, cpuSeconds) in sorted((timings or {}).items()):
+        report.add('clean ' + step, wallSeconds, cpuSeconds, tag=tag)
+    return gcode
+
+
+def openSlicerCache(settings):
+    if not settings.useCache:
+        return None
+    cacheDir = settings.cacheDir if settings.cacheDir else os.path.join(settings.filePath, "slic3r-cache")
+    return slicerCache.SlicerCache(cacheDir, settings.cacheMaxBytes)
+
+
+def openManifest(settings):
+    if not settings.incremental or not settings.useCache:
+        return None
+    return exportManifest.ExportManifest(settings.filePath)
+
+
+def sliceAndClean(stlPath, gcodePath, tmpPath, tag, stlFingerprint, settings, cache, manifest=None):
+    # Slice one stl file and clean the result. Reuses cached g-code when the stl and the Slic3r options are unchanged.
+    # With a manifest, an stl whose fingerprint did not change since the last export is not even read.
+    # Returns the cleaned g-code as an in-memory GcodeFile. tmpPath is only written when settings.keepTmpFiles is set.
+    command = [os.path.join(settings.slic3rPath, settings.slic3rExe)] + slic3rOptions(settings)
+    if manifest is not None and stlFingerprint is not None and cache is not None:
+        name = 'gcode:' + tag
+        jobFingerprint = exportManifest.fingerprint(stlFingerprint, command, _cleanVersion)
+        if manifest.unchanged(name, jobFingerprint):
+            data = cache.load(manifest.value(name))
+            if data is not None:
+                cache.record(True)
+                manifest.update(name, jobFingerprint, manifest.value(name), skipped=True)
+                gcode = gcodeIndex.GcodeFile.fromBytes(data)
+                if settings.keepTmpFiles:
+                    gcode.save(tmpPath)
+                return gcode
+
+    if cache is None:
+        sliceStl(stlPath, gcodePath, settings)
+        gcode = cleanGcode(gcodePath, tag)
+
+    else:
+        key = cache.key(stlPath, command)
+        cleanKey = cache.subKey(key, 'clean', _cleanVersion, tag)
+        if manifest is not None and stlFingerprint is not None:
+            manifest.update(name, jobFingerprint, cleanKey)
+
+        data = cache.load(cleanKey)
+        if data is not None:
+            cache.record(True)
+            gcode = gcodeIndex.GcodeFile.fromBytes(data)
+        else:
+            if cache.get(key, gcodePath):
+                cache.record(True)
+            else:
+                cache.record(False)
+                sliceStl(stlPath, gcodePath, settings)
+                cache.put(key, gcodePath)
+
+            gcode = cleanGcode(gcodePath, tag)
+            cache.store(cleanKey, gcode.tobytes())
+
+    if settings.keepTmpFiles:
+        gcode.save(tmpPath)
+    return gcode
+
+
+def sliceAll(jobs, settings, cache=None, manifest=None):
+    # jobs is a list of (stlPath, gcodePath, tmpPath, tag, stlFingerprint). stlFingerprint can be None.
+    # Runs up to settings.slicerWorkers Slic3r processes at once.
+    # Threads are enough here because each of them mostly waits for its Slic3r process. Results keep the order of jobs.
+    done = [0]
+    doneLock = threading.Lock()
+    showProgress('slice', 0, len(jobs))
+
+    failed = threading.Event()
+
+    def run(job):
+        if failed.is_set():
+            raise ExportCancelled()
+        gcode = timedSliceAndClean(job, settings, cache, manifest)
+        with doneLock:
+            done[0] += 1
+            showProgress('slice', done[0], len(jobs))
+        return gcode
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings.slicerWorkers)) as pool:
+        try:
+            return list(pool.map(run, jobs))
+        except BaseException:
+            # A failed job or Ctrl-C. Do not wait for the other Slic3r processes
+            failed.set()
+            killSlicers()
+            raise
+
+
+def timedSliceAndClean(job, settings, cache, manifest):
+    checkCancelled()
+    with report.stage('sliceAndClean', tag=job[3]) as record:
+        gcode = sliceAndClean(*job, settings, cache, manifest)
+        record['bytesWritten'] = gcode.index.byteCount
+    return gcode
+
+
+def simplifyGcode(gcode, tag, tmpPath, settings):
+    # Merge nearly collinear extrusion moves and fit arcs, see gcodeArcs.py. Returns gcode itself when both are off.
+    if not settings.mergeSegments and not settings.fitArcs:
+        return gcode
+    with report.stage('simplify', tag=tag, bytesRead=gcode.index.byteCount) as record:
+        data, counts = gcodeArcs.simplifyMoves(gcode.tobytes(), settings.segmentTolerance, settings.fitArcs, settings.mergeSegments)
+        gcode = gcodeIndex.GcodeFile.fromBytes(data)
+        record.update(counts)
+        record['bytesWritten'] = len(data)
+    if settings.keepTmpFiles:
+        gcode.save(tmpPath)
+    return gcode
+
+
+def anchorCopies(anchorStlPaths):
+    # Anchors that are copies of an earlier anchor at another XY position: k -> (index of the first anchor of that
+    # shape, XY offset from it). See stlTools.shapeFingerprint.
+    firsts = {}
+    copies = {}
+    for k, path in enumerate(anchorStlPaths):
+        if path is None or not os.path.exists(path):
+            continue
+        fingerprint = stlTools.shapeFingerprint(path)
+        if fingerprint is None:
+            continue
+        shape, corner = fingerprint
+        if shape in firsts:
+            first, firstCorner = firsts[shape]
+            copies[k] = (first, np.round(corner - firstCorner, 3))
+        else:
+            firsts[shape] = (k, corner)
+    return copies
+
+
+def translateGcode(gcode, offset, fromTag, toTag):
+    # Cleaned g-code moved by the XY offset, with ';fromTag' of the layer lines changed to ';toTag'.
+    # None if an X or Y word is not a number gcodeColumns reads, e.g. 'X+12.5'; such g-code is sliced again instead.
+    columns = gcodeColumns.GcodeColumns.parse(gcode.tobytes())
+    if any(_literalXY.search(fmt) for fmt, fields in columns.templates):
+        return None
+    columns.x += offset[0]
+    columns.y += offset[1]
+    suffix = ';' + fromTag
+    for row, comment in columns.comments.items():
+        if comment.endswith(suffix):
+            columns.comments[row] = comment[:-len(fromTag)] + toTag
+    return gcodeIndex.GcodeFile.fromBytes(columns.tobytes())
+
+
+def exportBodyAndAnchors(bodyStlPaths, anchorStlPaths, settings, cache=None, manifest=None, stlFingerprints=None):
+    # anchorStlPaths follows _selectedAnchors: one stl path per anchor and None after each group.
+    # manifest is an exportManifest.ExportManifest. stlFingerprints maps stl paths to fingerprints of the geometry
+    # they were exported from. Without it the fingerprints come from the file size and modification time.
+    # Returns the cleaned g-code of the body and a list of anchor g-code in the same layout as anchorStlPaths.
+    if manifest is not None and stlFingerprints is None:
+        stlFingerprints = {path: exportManifest.fileFingerprint(path) for path in bodyStlPaths + anchorStlPaths if path is not None}
+    if stlFingerprints is None:
+        stlFingerprints = {}
+
+    #####################################
+    # 1. Combine all body stl files into one binary stl file.
+    bodyAllPath = os.path.join(settings.filePath, "body-all.stl")
+    bodyFingerprint = None
+    if all(path in stlFingerprints for path in bodyStlPaths):
+        bodyFingerprint = exportManifest.fingerprint([stlFingerprints[path] for path in bodyStlPaths])
+    if manifest is not None and bodyFingerprint is not None and manifest.unchanged('stl:body-all', bodyFingerprint) and os.path.exists(bodyAllPath):
+        manifest.update('stl:body-all', bodyFingerprint, skipped=True)
+    else:
+        with report.stage('mergeStl', file="body-all.stl", bytesRead=sum(os.path.getsize(path) for path in bodyStlPaths)) as record:
+            stlTools.mergeStlFiles(bodyStlPaths, bodyAllPath)
+            record['bytesWritten'] = os.path.getsize(bodyAllPath)
+        if manifest is not None and bodyFingerprint is not None:
+            manifest.update('stl:body-all', bodyFingerprint)
+
+    #####################################
+    # 2. Make g-code files of the body and every anchor at the same time, and clean them.
+    #    Remove header and footer lines. Insert code resetting E value if none
+    #    An anchor that is a copy of an earlier one at another XY position is not sliced: the g-code of the first
+    #    anchor of its shape is moved to it.
+    def anchorJob(k):
+        return (anchorStlPaths[k], os.path.join(settings.filePath, "output-anchor" + str(k) + ".gcode"),
+                os.path.join(settings.filePath, "output-anchor"+str(k)+"-tmp.gcode"), 'ANCHOR'+str(k),
+                stlFingerprints.get(anchorStlPaths[k]))
+
+    copies = {}
+    if settings.reuseAnchorSlices:
+        with report.stage('anchorShapes', anchors=sum(path is not None for path in anchorStlPaths)) as record:
+            copies = anchorCopies(anchorStlPaths)
+            record['copies'] = len(copies)
+
+    sliced = [k for k in range(len(anchorStlPaths)) if anchorStlPaths[k] is not None and k not in copies]
+    jobs = [(bodyAllPath, os.path.join(settings.filePath, "output-body.gcode"),
+             os.path.join(settings.filePath, "output-body-tmp.gcode"), 'BODY', bodyFingerprint)]
+    jobs += [anchorJob(k) for k in sliced]
+    results = sliceAll(jobs, settings, cache, manifest)
+    results = [simplifyGcode(gcode, job[3], job[2], settings) for gcode, job in zip(results, jobs)]
+
+    anchors = [None] * len(anchorStlPaths)
+    for k, gcode in zip(sliced, results[1:]):
+        anchors[k] = gcode
+
+    if copies:
+        resliced = []
+        with report.stage('anchorCopies', copies=len(copies)) as record:
+            for k, (first, offset) in sorted(copies.items()):
+                gcode = translateGcode(anchors[first], offset, 'ANCHOR'+str(first), 'ANCHOR'+str(k))
+                if gcode is None:
+                    resliced.append(k)
+                    continue
+                anchors[k] = gcode
+                if settings.keepTmpFiles:
+                    gcode.save(anchorJob(k)[2])
+            record['slicesSaved'] = len(copies) - len(resliced)
+        if resliced:
+            for k, gcode in zip(resliced, sliceAll([anchorJob(k) for k in resliced], settings, cache, manifest)):
+                anchors[k] = simplifyGcode(gcode, anchorJob(k)[3], anchorJob(k)[2], settings)
+
+    if cache is not None:
+        cache.evict()
+
+    return results[0], anchors
+
+
+def threadGroupLayers(lines, bodyIndex):
+    # Body layer after which every thread group is laid. The height of a group is the highest z other than 0 of the
+    # end points of its segments, where the thread is laid. Its start point is where the group before it ended
+    # (chainThreadLines), so it has the height of that group. Groups without a height, e.g. a group of moves at z=0,
+    # take the layer of the group before them, or of the first group with a height. Groups are laid in order, so a
+    # layer is never below the layer of the group before it.
+    heights = []
+    height = None
+    for i in range(len(lines)):
+        if np.isnan(lines[i,0,0]):
+            heights.append(height)
+            height = None
+        elif lines[i,1,2] != 0 and (height is None or lines[i,1,2] > height):
+            height = lines[i,1,2]
+    if height is not None or len(heights) == 0:
+        heights.append(height)
+
+    known = [height for height in heights if height is not None]
+    layers = []
+    layer = bodyIndex.layerAtZ(known[0]) if known else 0
+    for height in heights:
+        if height is not None:
+            layer = max(layer, bodyIndex.layerAtZ(height))
+        layers.append(layer)
+    return layers
+
+
+def mergeSchedule(bodyLength, anchorLengths, threadLayers):
+    # Order of the pieces of output-all.gcode: ('body', None, start, stop) and ('anchor', a, start, stop) for layers
+    # start..stop-1 of the body and of anchor a, and ('thread', None, k, k+1) for thread block k.
+    # anchorLengths has the layout of anchorStlPaths: the layer count of every anchor, None after each group. Thread
+    # block k follows anchor group k and is laid after body layer threadLayers[k].
+    # Body and anchor layers up to the thread layer are printed one layer at a time, the body first. At the thread
+    # layer the anchors of the group are printed to their top and the thread is laid. The body is printed to its top
+    # after the last thread. Each piece has a key (layer, rank, group, order, index) and the pieces of the body, every
+    # anchor and the threads are merged by key with a priority queue in one pass.
+    def layerOfGroup(group):
+        return threadLayers[min(group, len(threadLayers) - 1)]
+
+    def bodyPieces(lastLayer):
+        for i in range(min(bodyLength, lastLayer + 1)):
+            yield (i, 0, 0, 0, 0), ('body', None, i, i+1)
+        yield (lastLayer, 3, 0, 0, 0), ('body', None, lastLayer + 1, bodyLength)
+
+    def anchorPieces(a, group):
+        layer = layerOfGroup(group)
+        for i in range(min(anchorLengths[a], layer + 1)):
+            yield (i, 1, 0, 0, a), ('anchor', a, i, i+1)
+        yield (layer, 2, group, 0, a), ('anchor', a, layer + 1, anchorLengths[a])
+
+    streams = []
+    group = 0
+    for a in range(len(anchorLengths)):
+        if anchorLengths[a] is None:
+            group += 1
+        else:
+            streams.append(anchorPieces(a, group))
+    streams.append(((layerOfGroup(k), 2, k, 1, 0), ('thread', None, k, k+1)) for k in range(group))
+    streams.append(bodyPieces(layerOfGroup(max(group - 1, 0))))
+    return [piece for key, piece in heapq.merge(*streams)]
+
+
+def orderAnchorLayers(schedule, body, anchors):
+    # Reorder every run of single anchor layers in the schedule of mergeSchedule, i.e. one layer of each anchor
+    # after a body layer, for the least travel between them. The run starts where the piece before it ends and ends
+    # where the piece after it starts. Returns the new schedule, the runs reordered and the travel before and after
+    # in mm.
+    endpoints = {}
+
+    def pointsOf(index):
+        if index not in endpoints:
+            endpoints[index] = (body if index is None else anchors[index]).layerEndpoints()
+        return endpoints[index]
+
+    def endOf(piece):
+        kind, index, start, stop = piece
+        if kind == 'thread' or start >= stop:
+            return None
+        point = pointsOf(index)[1][stop - 1]
+        return None if np.isnan(point).any() else point
+
+    def startOf(piece):
+        kind, index, start, stop = piece
+        if kind == 'thread' or start >= stop:
+            return None
+        point = pointsOf(index)[0][start]
+        return None if np.isnan(point).any() else point
+
+    ordered = list(schedule)
+    reordered = 0
+    travelBefore = travelAfter = 0.0
+    first = 0
+    while first < len(ordered):
+        kind, index, start, stop = ordered[first]
+        last = first
+        while last < len(ordered) and ordered[last][0] == 'anchor' and ordered[last][2:] == (start, start + 1):
+            last += 1
+        if last - first < 2:
+            first = max(last, first + 1)
+            continue
+        run = ordered[first:last]
+        starts = np.array([pointsOf(piece[1])[0][start] for piece in run])
+        ends = np.array([pointsOf(piece[1])[1][start] for piece in run])
+        if not (np.isnan(starts).any() or np.isnan(ends).any()):
+            origin = endOf(ordered[first - 1]) if first > 0 else None
+            finish = startOf(ordered[last]) if last < len(ordered) else None
+            order, before, after = anchorOrder.orderBlocks(starts, ends, origin, finish)
+            ordered[first:last] = [run[k] for k in order.tolist()]
+            reordered += after < before
+            travelBefore += before
+            travelAfter += after
+        first = last
+    return ordered, reordered, travelBefore, travelAfter
+
+
+def batchThreadBlocks(schedule, threadLayers):
+    # Thread pieces of the schedule of mergeSchedule that are laid after the same body layer with nothing printed
+    # between them, e.g. the groups of one layer whose anchors are already at their top, become one piece
+    # ('thread', None, first, stop) for blocks first..stop-1, laid under one tool change. Empty body and anchor
+    # pieces are left out.
+    batched = []
+    for piece in schedule:
+        kind, index, start, stop = piece
+        if start >= stop:
+            continue
+        if kind == 'thread' and batched and batched[-1][0] == 'thread' and threadLayers[batched[-1][2]] == threadLayers[start]:
+            batched[-1] = ('thread', None, batched[-1][2], stop)
+        else:
+            batched.append(piece)
+    return batched
+
+
+_bedCenter = re.compile(rb'G0 Y(-?[0-9.]+)')
+_overRotation = re.compile(rb'G1 E(-?[0-9.]+) F800\n')
+
+
+def _threadState(lines, bedY, eZero):
+    # Where the bed is and whether E is 0 after the thread g-code lines, from the state before them
+    for line in lines:
+        match = _bedCenter.match(line)
+        if match:
+            bedY = float(match.group(1))
+        elif line.startswith(b'G92 E0'):
+            eZero = True
+        elif b' E' in line.partition(b';')[0]:
+            eZero = False
+    return bedY, eZero
+
+
+def joinThreadBlocks(blocks, removed):
+    # Thread blocks laid one after the other as one block. At every join the over-rotation that holds the thread
+    # while the anchors of the next group are printed is left out: 'G1 E12', 'G92 E0' at the end of a block and
+    # 'G1 E-12', 'G92 E0' at the start of the next, or the other way round. So are bed centering before the
+    # over-rotation and at the start of the next block when the bed is already there, and G92 E0 when E is already 0.
+    # removed counts the lines left out.
+    joined = []
+    tail = []
+    bedY, eZero = None, False      # State before tail
+    for block in blocks:
+        head = bytes(block).splitlines(True)
+        if len(tail) >= 2 and len(head) >= 2 and tail[-1] == head[1] == b'G92 E0\n':
+            turn = _overRotation.fullmatch(tail[-2])
+            back = _overRotation.fullmatch(head[0])
+            if turn and back and float(turn.group(1)) == -float(back.group(1)):
+                del tail[-2:], head[:2]
+                removed['overRotation'] += 2
+                removed['G92 E0'] += 2
+                # The bed centering RingGcode put before the over-rotation, when the bed is already there
+                match = _bedCenter.match(tail[-1]) if tail else None
+                if match and float(match.group(1)) == _threadState(tail[:-1], bedY, eZero)[0]:
+                    del tail[-1]
+                    removed['bedCenter'] += 1
+
+        bedY, eZero = _threadState(tail, bedY, eZero)
+        joined += tail
+        while head and joined:
+            match = _bedCenter.match(head[0])
+            if match and float(match.group(1)) == bedY:
+                removed['bedCenter'] += 1
+            elif head[0].startswith(b'G92 E0') and eZero:
+                removed['G92 E0'] += 1
+            else:
+                break
+            del head[0]
+        tail = head
+    return b''.join(joined + tail)
+
+
+def exportAll(lines, anchorStlPaths, settings, body=None, anchors=None, threadGcode=None):
+    # body and anchors come from exportBodyAndAnchors and threadGcode from exportThread.
+    # Without them the -tmp files written with settings.keepTmpFiles are memory-mapped instead.
+    # Layers and thread blocks are copied as slices of the sources by their byte offsets through a large write buffer.
+    opened = []
+    if body is None:
+        body = gcodeIndex.GcodeFile.open(os.path.join(settings.filePath, "output-body-tmp.gcode"))
+        opened.append(body)
+    if anchors is None:
+        anchors = []
+        for i in range(len(anchorStlPaths)):
+            if anchorStlPaths[i] is not None:
+                anchors.append(gcodeIndex.GcodeFile.open(os.path.join(settings.filePath, "output-anchor" + str(i) + "-tmp.gcode")))
+                opened.append(anchors[-1])
+            else:
+                anchors.append(None)
+    if threadGcode is None:
+        threadGcode = gcodeIndex.mapFile(os.path.join(settings.filePath, "output-thread-tmp.gcode"))
+        if not isinstance(threadGcode, bytes):
+            opened.append(threadGcode)
+    threadView = memoryview(threadGcode)
+    # The merged g-code goes through the compact writer and gzip when they are on
+    outPath = outputPath(settings)
+    fFile = open(outPath, "wb", buffering=settings.writeBufferSize)
+    fOut = fFile
+    if settings.gzipOutput:
+        fOut = gzip.GzipFile(filename="output-all.gcode", mode="wb", fileobj=fFile, compresslevel=settings.gzipLevel, mtime=0)
+    fAll = fOut
+    if settings.compactOutput:
+        fAll = gcodeCompact.CompactWriter(fOut, settings.compactDecimals, settings.compactEDecimals)
+    record = report.begin('merge', file=os.path.basename(outPath))
+
+    # Add header
+    fAll.write(b";Header\n")
+    fAll.write(b"M107\n")
+    fAll.write(b"M104 S200 ; set temperature\n")
+    fAll.write(b"G28 ; home all axes\n")
+    fAll.write(b"G1 Z5 F5000 ; lift nozzle\n\n")
+    fAll.write(b"; Filament gcode\n\n")
+
+    fAll.write(b"M109 S200 ; set temperature and wait for it to be reached\n")
+    fAll.write(b"G21 ; set units to millimeters\n")
+    fAll.write(b"G90 ; use absolute coordinates\n")
+    fAll.write(b"M82 ; use absolute distances for extrusion\n")
+    fAll.write(b"G92 E0\n\n")
+    fAll.write(b";End of header\n")
+
+    ##############################
+    ### 1. Layer of every thread group: the first body layer above the group
+    threadLayers = threadGroupLayers(lines, body.index)
+
+    ##############################
+    ### 2. Get byte ranges of the thread blocks. Layers of body and anchors are in their indexes
+    threadBlocks = gcodeIndex.markerRanges(threadGcode, b';anchor')
+
+    ##############################
+    ### 3. Combine body, anchor, thread gcode files layer by layer
+    fAll.write(b"T0\n")      # Say below code is for Extruder 1
+
+    anchorLengths = [len(anchor) if anchor is not None else None for anchor in anchors]
+    schedule = mergeSchedule(len(body), anchorLengths, threadLayers)
+    if settings.orderAnchors:
+        with report.stage('anchorOrder') as orderRecord:
+            schedule, reordered, travelBefore, travelAfter = orderAnchorLayers(schedule, body, anchors)
+            orderRecord['layersReordered'] = reordered
+            orderRecord['travelBefore'] = round(travelBefore, 1)
+            orderRecord['travelAfter'] = round(travelAfter, 1)
+            orderRecord['travelSaved'] = round(travelBefore - travelAfter, 1)
+    removed = collections.Counter()
+    if settings.batchThreads:
+        schedule = batchThreadBlocks(schedule, threadLayers)
+    for kind, index, start, stop in schedule:
+        if kind == 'body':
+            body.copyLayers(fAll, start, stop)
+        elif kind == 'anchor':
+            anchors[index].copyLayers(fAll, start, stop)
+        else:
+            fAll.write(b"T1 ;Thread\n")
+            if stop - start == 1:
+                if start < len(threadBlocks):
+                    fAll.write(threadView[threadBlocks[start][0]:threadBlocks[start][1]])
+            else:
+                fAll.write(joinThreadBlocks([threadView[first:end] for first, end in threadBlocks[start:stop]], removed))
+                removed['T0/T1'] += 2 * (stop - start - 1)
+            fAll.write(b"T0 ;End of thread\n")
+    record['threadLayers'] = threadLayers
+    if settings.batchThreads:
+        record['toolChanges'] = sum(kind == 'thread' for kind, index, start, stop in schedule)
+        record['linesRemoved'] = dict(removed)
+
+    ##############################
+    # 4. Add footer
+    fAll.write(b';Footer\n')
+    fAll.write(b'M104 S0 ; turn off temperature\n')
+    fAll.write(b'G28 X0  ; home X axis\n')
+    fAll.write(b'M84     ; disable motors\n\n')
+    fAll.write(b'M140 S0 ; set bed temperature\n')
+    fAll.write(b';End of footer \n')
+
+    merged = fAll.bytesIn if settings.compactOutput else fOut.tell()
+    fAll.close()
+    compacted = fAll.bytesOut if settings.compactOutput else merged
+    fOut.close()
+    fFile.close()
+
+    record['bytesRead'] = body.index.byteCount + sum(anchor.index.byteCount for anchor in anchors if anchor is not None) + len(threadGcode)
+    record['bytesWritten'] = os.path.getsize(outPath)
+    if settings.compactOutput or settings.gzipOutput:
+        record['bytesMerged'] = merged
+        record['bytesCompacted'] = compacted
+    report.end(record)
+
+    threadView.release()
+    for source in opened:
+        source.close()
+
+    if removed:
+        showMessage('Thread batching: {} thread blocks laid with {} tool changes. Left out: {}'.format(
+            len(threadLayers), record['toolChanges'], ', '.join('{} {}'.format(count, name) for name, count in sorted(removed.items()))))
+    if settings.orderAnchors and travelAfter < travelBefore:
+        showMessage('Anchor order: {:.0f} mm of travel saved on {} layers ({:.0f} mm instead of {:.0f} mm)'.format(
+            travelBefore - travelAfter, reordered, travelAfter, travelBefore))
+    if settings.compactOutput or settings.gzipOutput:
+        showMessage(outputSizeSummary(outPath, merged, compacted if settings.compactOutput else None, record['bytesWritten']))
+
+
+def outputPath(settings):
+    return os.path.join(settings.filePath, "output-all.gcode.gz" if settings.gzipOutput else "output-all.gcode")
+
+
+def outputSizeSummary(outPath, merged, compacted, written):
+    # e.g. 'output-all.gcode.gz: 3172 kB, 12% of 26419 kB (compact 14540 kB, gzip 3172 kB)'
+    def kB(size):
+        return '%.0f kB' % (size / 1024.0)
+    steps = []
+    if compacted is not None:
+        steps.append('compact ' + kB(compacted))
+    if outPath.endswith('.gz'):
+        steps.append('gzip ' + kB(written))
+    return '{}: {}, {:.0f}% of {} ({})'.format(os.path.basename(outPath), kB(written), 100.0 * written / max(merged, 1), kB(merged), ', '.join(steps))
+
+
+def exportJob(lines, bodyStlPaths, anchorStlPaths, settings):
+    # Run every stage. Same order as MyExecuteHandler in ExportThread.py.
+    # Raises ExportCancelled after cancelExport(), before anything is written to output-all.gcode.
+    os.makedirs(settings.filePath, exist_ok=True)
+    cancelled.clear()
+    startReport(settings)
+    showProgress('exportThread', 0, 3)
+    with report.stage('exportThread'):
+        lines, threadGcode = exportThread(lines, settings, anchorStlPaths)
+    cache = openSlicerCache(settings)
+    manifest = openManifest(settings)
+    showProgress('sliceBodyAndAnchors', 1, 3)
+    with report.stage('sliceBodyAndAnchors'):
+        body, anchors = exportBodyAndAnchors(bodyStlPaths, anchorStlPaths, settings, cache, manifest)
+    checkCancelled()
+    showProgress('exportAll', 2, 3)
+    with report.stage('exportAll'):
+        exportAll(lines, anchorStlPaths, settings, body, anchors, threadGcode)
+    showProgress('exportAll', 3, 3)
+    if manifest is not None:
+        manifest.save()
+    saveReport(settings)
+    if cache is not None:
+        showMessage(cache.summary())
+    return outputPath(settings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export thread, body and anchor g-code without Fusion 360.')
+    parser.add_argument('--threads', required=True, help='Thread segments. .npy, str(_lines) dump or six numbers per line. Rows of nan separate groups.')
+    parser.add_argument('--ring-coordinates', action='store_true', help='Thread segments are already shifted to the ring center, as in ExportThread.pythreadCoordinates.txt.')
+    parser.add_argument('--body', action='append', default=[], help='Binary or ASCII stl of a main body. Repeat for several bodies.')
+    parser.add_argument('--anchors', action='append', default=[], help='Comma separated anchor stl files of one group. Repeat once per group, in print order.')
+    parser.add_argument('-o', '--output-dir', help='Folder for the g-code files.')
+    parser.add_argument('--slic3r-path', help='Folder of the Slic3r executable.')
+    parser.add_argument('--slic3r-exe', help='Name of the Slic3r executable.')
+    parser.add_argument('--layer-thickness', type=float)
+    parser.add_argument('--temperature', type=int)
+    parser.add_argument('--bed-temperature', type=int)
+    parser.add_argument('--anchor-clearance', type=float, help='mm. Thread segments are lifted this far over the anchors in their way. Default is 1.')
+    parser.add_argument('--no-ring-plan', action='store_true', help='Rotate the ring for every segment as the thread lines give it, without shortening or merging the moves.')
+    parser.add_argument('--no-anchor-reuse', action='store_true', help='Slice every anchor, also copies of the same shape at other positions.')
+    parser.add_argument('--no-anchor-order', action='store_true', help='Print the anchors of every layer in selection order, not in the order with the least travel.')
+    parser.add_argument('--no-thread-batching', action='store_true', help='One tool change per thread block, also when nothing is printed between blocks.')
+    parser.add_argument('--merge-segments', action='store_true', help='Merge nearly collinear extrusion moves of the body and anchors.')
+    parser.add_argument('--fit-arcs', action='store_true', help='Replace extrusion moves along a circle with G2/G3 arcs.')
+    parser.add_argument('--segment-tolerance', type=float, help='mm. How far merged moves and arcs may be from the original points. Default is 0.01.')
+    parser.add_argument('--compact', action='store_true', help='Round coordinates and leave out repeated words, resets and comments in output-all.gcode.')
+    parser.add_argument('--decimals', type=int, help='Decimals of X, Y, Z and F with --compact. Default is 3.')
+    parser.add_argument('--gzip', action='store_true', help='Write output-all.gcode.gz.')
+    parser.add_argument('--workers', type=int, help='Number of Slic3r processes running at the same time. Default is the number of CPUs.')
+    parser.add_argument('--cache-dir', help='Folder of the Slic3r cache. Default is slic3r-cache in the output folder.')
+    parser.add_argument('--cache-size', type=int, help='Size limit of the Slic3r cache in MB. Default is 1024.')
+    parser.add_argument('--no-cache', action='store_true', help='Always run Slic3r.')
+    parser.add_argument('--full', action='store_true', help='Slice every stl file even if it did not change since the last export.')
+    parser.add_argument('--no-report', action='store_true', help='Do not write export-report.json and export-report.txt.')
+    parser.add_argument('--profile', action='store_true', help='Also write a cProfile dump, export-profile.prof.')
+    parser.add_argument('--keep-tmp', action='store_true', help='Also write the cleaned -tmp.gcode files, for debugging.')
+    args = parser.parse_args(argv)
+
+    settings = PrintSettings()
+    for name, value in [('filePath', args.output_dir), ('slic3rPath', args.slic3r_path), ('slic3rExe', args.slic3r_exe),
+                        ('layerThickness', args.layer_thickness), ('temperature', args.temperature), ('bedTemperature', args.bed_temperature), ('slicerWorkers', args.workers),
+                        ('anchorClearance', args.anchor_clearance), ('compactDecimals', args.decimals),
+                        ('segmentTolerance', args.segment_tolerance),
+                        ('cacheDir', args.cache_dir), ('cacheMaxBytes', args.cache_size * (1 << 20) if args.cache_size is not None else None)]:
+        if value is not None:
+            setattr(settings, name, value)
+    if args.no_cache:
+        settings.useCache = False
+    if args.full:
+        settings.incremental = False
+    if args.no_report:
+        settings.writeReport = False
+    if args.profile:
+        settings.profile = True
+    if args.keep_tmp:
+        settings.keepTmpFiles = True
+    if args.no_ring_plan:
+        settings.planRingMoves = False
+    if args.no_anchor_reuse:
+        settings.reuseAnchorSlices = False
+    if args.no_anchor_order:
+        settings.orderAnchors = False
+    if args.no_thread_batching:
+        settings.batchThreads = False
+    if args.merge_segments:
+        settings.mergeSegments = True
+    if args.fit_arcs:
+        settings.fitArcs = True
+    if args.compact:
+        settings.compactOutput = True
+    if args.gzip:
+        settings.gzipOutput = True
+
+    lines = loadThreadLines(args.threads)
+    if args.ring_coordinates:
+        lines[:,:,0] = lines[:,:,0] + settings.threadOriginX
+
+    # Same layout as _selectedAnchors: anchors of a group followed by None.
+    anchorStlPaths = []
+    for group in args.anchors:
+        anchorStlPaths.extend([path for path in group.split(',') if path])
+        if len(anchorStlPaths) > 0 and anchorStlPaths[-1] is not None:
+            anchorStlPaths.append(None)
+
+    try:
+        outPath = exportJob(lines, args.body, anchorStlPaths, settings)
+    except:
+        print('Failed:\n{}'.format(traceback.format_exc()), file=sys.stderr)
+        return 1
+
+    print(outPath)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
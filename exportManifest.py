@@ -0,0 +1,58 @@
+# Manifest of the previous export for exportEngine.py and ExportThread.py.
+# Stores a fingerprint of every body, anchor and stl file that was exported, and the cache key of the cleaned g-code
+# made from it. The next export compares fingerprints and skips the stl export and slicing of everything unchanged.
+
+import hashlib
+import json
+import os
+import threading
+
+
+def fingerprint(*parts):
+    # parts are numbers, strings or lists of them
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def fileFingerprint(path):
+    # Fingerprint of a file without reading it. Used when there is no Fusion geometry, e.g. on the command line.
+    stat = os.stat(path)
+    return fingerprint(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class ExportManifest:
+    fileName = "export-manifest.json"
+
+    def __init__(self, filePath):
+        self.path = os.path.join(filePath, self.fileName)
+        self.previous = {}      # Entries of the last export
+        self.entries = {}       # Entries of this export. Only these are saved.
+        self.skipped = 0
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                self.previous = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def unchanged(self, name, fingerprint):
+        entry = self.previous.get(name)
+        return entry is not None and entry['fingerprint'] == fingerprint
+
+    def value(self, name):
+        return self.previous[name].get('value')
+
+    def update(self, name, fingerprint, value=None, skipped=False):
+        # Record name for the next export. skipped counts work that was not redone.
+        with self._lock:
+            self.entries[name] = {'fingerprint': fingerprint, 'value': value}
+            if skipped:
+                self.skipped += 1
+
+    def save(self):
+        tmpPath = self.path + ".part"
+        with open(tmpPath, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmpPath, self.path)
+
+    def summary(self):
+        return "Incremental export: {} of {} unchanged".format(self.skipped, len(self.entries))
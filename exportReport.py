@@ -0,0 +1,114 @@
+# Timing and profiling of the export stages for exportEngine.py and ExportThread.py.
+# A RunReport keeps one record per stage or sub-step: wall time, CPU time of the thread that ran it, bytes read and
+# written, and the peak memory of the process when it ended. save() writes the records as JSON and text next to
+# output-all.gcode, and a cProfile dump of the calling thread when profiling is on.
+
+import contextlib
+import cProfile
+import json
+import os, sys
+import threading
+import time
+
+
+def peakMemory():
+    # Peak resident memory of this process in bytes, or None when it cannot be read
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+                           [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                            'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return None
+            return counters.PeakWorkingSetSize
+
+        import resource
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxRss if sys.platform == 'darwin' else maxRss * 1024     # bytes on Mac, kB on Linux
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+class RunReport:
+    def __init__(self, enabled=True, profile=False):
+        self.enabled = enabled
+        self.profile = profile
+        self.records = []
+        self._lock = threading.Lock()
+        self._profiler = None
+
+    def begin(self, name, **info):
+        # Start a record. Fill in bytesRead and bytesWritten and pass it to end().
+        record = {'stage': name, 'thread': threading.current_thread().name, 'bytesRead': 0, 'bytesWritten': 0}
+        record.update(info)
+        record['_start'] = (time.perf_counter(), time.thread_time())
+        return record
+
+    def end(self, record):
+        wallStart, cpuStart = record.pop('_start')
+        if not self.enabled:
+            return
+        record['wallSeconds'] = time.perf_counter() - wallStart
+        record['cpuSeconds'] = time.thread_time() - cpuStart
+        record['peakMemory'] = peakMemory()
+        with self._lock:
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        # with report.stage('slic3r', file=path) as record: ... record['bytesWritten'] = ...
+        record = self.begin(name, **info)
+        try:
+            yield record
+        finally:
+            self.end(record)
+
+    def add(self, name, wallSeconds, cpuSeconds, **info):
+        # Record a sub-step that was timed by the caller, e.g. a cleanup section summed over all layers
+        if not self.enabled:
+            return
+        record = {'stage': name, 'thread': threading.current_thread().name, 'bytesRead': 0, 'bytesWritten': 0,
+                  'wallSeconds': wallSeconds, 'cpuSeconds': cpuSeconds, 'peakMemory': None}
+        record.update(info)
+        with self._lock:
+            self.records.append(record)
+
+    def startProfile(self):
+        # cProfile only sees the calling thread. Slicing workers show up in the stage records only.
+        if self.profile and self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stopProfile(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def text(self):
+        lines = ['{:<28}{:<20}{:>10}{:>10}{:>12}{:>12}{:>10}'.format('stage', 'item', 'wall s', 'cpu s', 'read kB', 'written kB', 'peak MB')]
+        for record in self.records:
+            item = str(record.get('tag', record.get('file', '')))
+            if len(item) > 19:
+                item = '...' + item[-16:]
+            peak = record['peakMemory']
+            lines.append('{:<28}{:<20}{:>10.3f}{:>10.3f}{:>12.1f}{:>12.1f}{:>10}'.format(
+                record['stage'], item, record['wallSeconds'], record['cpuSeconds'] if record['cpuSeconds'] is not None else 0.0,
+                record['bytesRead'] / 1024, record['bytesWritten'] / 1024, '%.1f' % (peak / (1 << 20)) if peak is not None else '-'))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, dirPath):
+        # Writes export-report.json, export-report.txt and, when profiling, export-profile.prof. Returns the text report.
+        if not self.enabled:
+            return ''
+        self.stopProfile()
+        with open(os.path.join(dirPath, "export-report.json"), "w") as f:
+            json.dump({'records': self.records}, f, indent=1)
+        text = self.text()
+        with open(os.path.join(dirPath, "export-report.txt"), "w") as f:
+            f.write(text)
+        if self._profiler is not None:
+            self._profiler.dump_stats(os.path.join(dirPath, "export-profile.prof"))
+        return text
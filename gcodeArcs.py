@@ -0,0 +1,285 @@
+# Collinear merging and arc fitting of cleaned g-code for exportEngine.py.
+# Slic3r writes curved and long walls as many short 'G1 X.. Y.. E..' moves, more than the planner of the printer can
+# look ahead over. simplifyMoves() works on the runs of such extrusion moves, all runs of a file at once:
+#   1. Moves whose points lie on one circle within tolerance become one G2/G3 move, up to maxArcSweep each. The circle
+#      is fitted to all points of a run that turns one way, through its first and last point
+#   2. A point between two moves is left out when every point it stood for is within tolerance of the new move.
+#      Points are left out in passes, each pass the best of every two neighbours, until no point can go
+# A point is only left out when E along the new move grows with its length as it did along the old moves, so the
+# filament is laid the same way. The E value at the end of every run is kept, and so are all other lines: the layer
+# line, the travel and E/F lines at the start of a layer and the last line of every layer, which copyLayers() leaves
+# out. The kept lines are copied byte for byte.
+
+import math
+import re
+
+import numpy as np
+
+import gcodeColumns
+
+
+minArcSegments = 3          # Moves an arc has to replace
+maxArcRadius = 1000.0       # mm
+maxArcSweep = math.pi       # Radians of one G2/G3 move, well below a full circle
+maxArcTurn = math.pi / 4    # Radians the path may turn between two moves of an arc
+maxArcSplits = 6            # Times a run that does not fit one circle is split in two and tried again
+eTolerance = 0.05           # Part of the E of a new move by which the E at its old points may differ from an even flow
+_eResolution = 2e-5         # E values are written with 5 decimals
+
+_extrusion = re.compile('G1 X%\\.(\\d+)f Y%\\.(\\d+)f E%\\.(\\d+)f')
+
+
+def _expandRanges(starts, counts):
+    # Every element of the ranges [start, start+count), and where the elements of every range start
+    offsets = np.cumsum(counts) - counts
+    return np.arange(int(counts.sum())) - np.repeat(offsets - starts, counts), offsets
+
+
+def _valueBefore(values):
+    # Last value other than nan on the rows before every row, nan if none
+    last = np.maximum.accumulate(np.where(np.isnan(values), -1, np.arange(len(values))))
+    before = np.concatenate(([-1], last[:-1]))
+    return np.where(before >= 0, values[np.maximum(before, 0)], np.nan)
+
+
+class _Points:
+    # The points of all runs of extrusion moves: the start point of every run, then the end point of each move
+    def __init__(self, columns, eligible):
+        rows = np.flatnonzero(eligible)
+        runFirst = eligible & ~np.concatenate(([False], eligible[:-1]))
+        run = np.cumsum(runFirst)[rows] - 1
+        position = np.arange(len(rows)) + run + 1
+        count = len(rows) + int(runFirst.sum())
+        starts = position[runFirst[rows]] - 1
+
+        self.row = np.full(count, -1, dtype=np.int64)
+        self.row[position] = rows
+        self.x = np.zeros(count)
+        self.y = np.zeros(count)
+        self.e = np.zeros(count)
+        for values, column, before in ((self.x, columns.x, _valueBefore(columns.x)), (self.y, columns.y, _valueBefore(columns.y)),
+                                       (self.e, columns.e, _valueBefore(columns.e))):
+            values[position] = column[rows]
+            values[starts] = before[rows[runFirst[rows]]]
+        self.first = self.row == -1
+        self.last = np.append(self.first[1:], True)
+
+        # Length of the moves up to every point. Differences are only taken within a run
+        lengths = np.where(self.last[:-1], 0.0, np.hypot(np.diff(self.x), np.diff(self.y)))
+        self.length = np.concatenate(([0.0], np.cumsum(lengths)))
+
+    def __len__(self):
+        return len(self.row)
+
+    def flowError(self, a, b, q):
+        # How far the E at points q is from an even flow along the move a-b, less what is allowed. <= 0 is good
+        span = self.length[b] - self.length[a]
+        eSpan = self.e[b] - self.e[a]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = self.e[a] + eSpan * (self.length[q] - self.length[a]) / span
+        error = np.abs(self.e[q] - expected) - eTolerance * eSpan - _eResolution
+        return np.where(span > 0, error, np.inf)
+
+
+def _fitArcs(points, tolerance, decimals):
+    # Arcs as (first point, last point, I, J, counter-clockwise) arrays. decimals is the number of decimals X and Y
+    # are written with at every point, so I and J are checked as they are written.
+    x, y = points.x, points.y
+    inner = np.flatnonzero(~points.first & ~points.last)
+
+    # Turn of the path at every point between two moves, and the way it turns
+    ax, ay = x[inner] - x[inner-1], y[inner] - y[inner-1]
+    bx, by = x[inner+1] - x[inner], y[inner+1] - y[inner]
+    angle = np.arctan2(ax * by - ay * bx, ax * bx + ay * by)
+    turn = np.sign(angle)       # 1 when the path turns left (counter-clockwise)
+    ok = (turn != 0) & (np.abs(angle) <= maxArcTurn) & (np.hypot(ax, ay) > 0) & (np.hypot(bx, by) > 0)
+
+    # Candidate runs: points next to each other that turn the same way. A run is cut where it has turned
+    # maxArcSweep; the point there ends one piece and starts the next
+    chainStart = ok & ~np.concatenate(([False], ok[:-1] & ok[1:] & (inner[1:] == inner[:-1] + 1) & (turn[1:] == turn[:-1])))
+    chain = np.cumsum(chainStart) - 1
+    swept = np.cumsum(np.where(ok, np.abs(angle), 0))
+    chainSwept = swept - (swept - np.abs(angle))[np.flatnonzero(chainStart)][np.maximum(chain, 0)]
+    cut = ok & ~chainStart & (np.floor(chainSwept / maxArcSweep) != np.floor((chainSwept - np.abs(angle)) / maxArcSweep))
+    pieceId = np.cumsum(chainStart | cut)
+    members = np.flatnonzero(ok & ~cut)
+    if len(members) == 0:
+        return None
+    pieceStart = np.concatenate(([True], pieceId[members[1:]] != pieceId[members[:-1]]))
+    first = inner[members[pieceStart]] - 1
+    last = inner[members[np.append(np.flatnonzero(pieceStart)[1:], len(members)) - 1]] + 1
+    counterClockwise = turn[members[pieceStart]] > 0
+    first[1:] = np.maximum(first[1:], last[:-1])        # Runs that turn the other way share a move
+
+    # Fit every piece. Pieces that do not fit are split in two and tried again
+    arcs = []
+    for attempt in range(maxArcSplits + 1):
+        keep = last - first >= minArcSegments
+        first, last, counterClockwise = first[keep], last[keep], counterClockwise[keep]
+        if len(first) == 0:
+            break
+        good, i, j = _checkArcs(points, first, last, counterClockwise, tolerance, decimals)
+        arcs.append((first[good], last[good], i[good], j[good], counterClockwise[good]))
+        split = ~good & (last - first >= 2 * minArcSegments)
+        middle = (first[split] + last[split]) // 2
+        first = np.concatenate((first[split], middle))
+        last = np.concatenate((middle, last[split]))
+        counterClockwise = np.concatenate((counterClockwise[split], counterClockwise[split]))
+
+    arcs = [np.concatenate(values) for values in zip(*arcs)] if arcs else []
+    if not arcs or len(arcs[0]) == 0:
+        return None
+    order = np.argsort(arcs[0], kind='stable')
+    return tuple(values[order] for values in arcs)
+
+
+def _checkArcs(points, first, last, counterClockwise, tolerance, decimals):
+    # The circle that fits the points first..last of every piece best, with its center moved onto the perpendicular
+    # bisector of the first and last point. The arc is good when every point is within tolerance of the radius the
+    # printer takes (from the first point and I, J as written), the moves are no further from the arc than tolerance,
+    # they all turn the same way around the center and the flow is even. Returns good, I and J.
+    pointIndexes, pointOffsets = _expandRanges(first, last - first + 1)
+    pointPiece = np.repeat(np.arange(len(first)), last - first + 1)
+    u = points.x[pointIndexes] - points.x[first][pointPiece]       # Relative to the first point
+    v = points.y[pointIndexes] - points.y[first][pointPiece]
+    w = u * u + v * v
+
+    # Least squares circle u^2 + v^2 + D u + E v + F = 0 of every piece
+    def sums(values):
+        return np.add.reduceat(values, pointOffsets)
+    su, sv, suu, suv, svv = sums(u), sums(v), sums(u * u), sums(u * v), sums(v * v)
+    matrix = np.stack((np.stack((suu, suv, su), axis=1), np.stack((suv, svv, sv), axis=1),
+                       np.stack((su, sv, (last - first + 1).astype(float)), axis=1)), axis=1)
+    vector = -np.stack((sums(u * w), sums(v * w), sums(w)), axis=1)
+    solvable = np.abs(np.linalg.det(matrix)) > 1e-12 * np.maximum(suu * svv, 1e-300)
+    matrix[~solvable] = np.eye(3)
+    solution = np.linalg.solve(matrix, vector[..., None])[..., 0]
+    centerU, centerV = -solution[:,0] / 2, -solution[:,1] / 2
+
+    # Onto the bisector of the chord, and rounded as written
+    chordU, chordV = u[pointOffsets + last - first], v[pointOffsets + last - first]
+    chord = np.hypot(chordU, chordV)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalU, normalV = -chordV / chord, chordU / chord
+    along = (centerU - chordU / 2) * normalU + (centerV - chordV / 2) * normalV
+    scale = 10.0 ** decimals[last]
+    i = np.round((chordU / 2 + along * normalU) * scale) / scale
+    j = np.round((chordV / 2 + along * normalV) * scale) / scale
+    radius = np.hypot(i, j)
+
+    distance = np.hypot(u - i[pointPiece], v - j[pointPiece])
+    with np.errstate(invalid='ignore'):
+        radialError = np.maximum.reduceat(np.abs(distance - radius[pointPiece]), pointOffsets)
+
+    moveIndexes, moveOffsets = _expandRanges(first, last - first)
+    movePiece = np.repeat(np.arange(len(first)), last - first)
+    start = moveIndexes - first[movePiece] + pointOffsets[movePiece]       # Start point of every move in u and v
+    fromU, fromV = u[start], v[start]
+    toU, toV = u[start + 1], v[start + 1]
+    moveChord = np.hypot(toU - fromU, toV - fromV)
+    r = radius[movePiece]
+    sagitta = np.maximum.reduceat(r - np.sqrt(np.maximum(r * r - moveChord * moveChord / 4, 0)), moveOffsets)
+    turns = np.sign((fromU - i[movePiece]) * (toV - j[movePiece]) - (fromV - j[movePiece]) * (toU - i[movePiece]))
+    wrongTurns = np.add.reduceat(turns != np.where(counterClockwise, 1, -1)[movePiece], moveOffsets)
+
+    innerIndexes, innerOffsets = _expandRanges(first + 1, last - first - 1)
+    innerPiece = np.repeat(np.arange(len(first)), last - first - 1)
+    flow = np.maximum.reduceat(points.flowError(first[innerPiece], last[innerPiece], innerIndexes), innerOffsets)
+
+    with np.errstate(invalid='ignore'):
+        good = solvable & (chord > 0) & (radialError <= tolerance) & (sagitta <= tolerance) & (wrongTurns == 0) & \
+               (flow <= 0) & (radius <= maxArcRadius)
+    return good, i, j
+
+
+def _mergeLines(points, kept, fixed, tolerance):
+    # Leave out points whose moves on either side can be one move. kept is changed in place.
+    x, y = points.x, points.y
+    tie = (np.arange(len(points)) * 2654435761) % (1 << 32)     # Spreads the choice among equally good points
+    while True:
+        keptIndexes = np.flatnonzero(kept)
+        candidate = ~fixed[keptIndexes] & ~points.first[keptIndexes] & ~points.last[keptIndexes]
+        slots = np.flatnonzero(candidate)
+        if len(slots) == 0:
+            return
+        k = keptIndexes[slots]
+        a = keptIndexes[slots - 1]
+        b = keptIndexes[slots + 1]
+
+        # Distance of every point between a and b to the move a-b
+        q, offsets = _expandRanges(a + 1, b - a - 1)
+        owner = np.repeat(np.arange(len(k)), b - a - 1)
+        qa, qb = a[owner], b[owner]
+        dx, dy = x[qb] - x[qa], y[qb] - y[qa]
+        lengthSquared = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(((x[q] - x[qa]) * dx + (y[q] - y[qa]) * dy) / lengthSquared, 0, 1)
+        t = np.where(lengthSquared > 0, t, 0)
+        distance = np.maximum.reduceat(np.hypot(x[q] - x[qa] - t * dx, y[q] - y[qa] - t * dy), offsets)
+        flow = np.maximum.reduceat(points.flowError(qa, qb, q), offsets)
+        removable = (distance <= tolerance) & (flow <= 0)
+        if not removable.any():
+            return
+
+        # A removable point goes when it is better than the removable candidates next to it
+        rank = np.full(len(keptIndexes) + 2, len(keptIndexes) + 2, dtype=np.int64)
+        order = np.lexsort((tie[k[removable]], distance[removable]))
+        removableSlots = slots[removable]
+        rank[removableSlots[order] + 1] = np.arange(len(order))
+        mine = rank[removableSlots + 1]
+        chosen = removableSlots[(mine < rank[removableSlots]) & (mine < rank[removableSlots + 2])]
+        kept[keptIndexes[chosen]] = False
+
+
+def simplifyMoves(data, tolerance, fitArcs=True, mergeLines=True):
+    # data is cleaned g-code bytes. Returns the new bytes and counts for the export report.
+    columns = gcodeColumns.GcodeColumns.parse(data)
+    n = len(columns)
+    stats = dict(linesBefore=n, arcs=0, movesMerged=0)
+    if n == 0:
+        stats['linesAfter'] = 0
+        return data, stats
+
+    # Moves that can change: plain extrusion moves without comment, not the last line of a layer
+    formats = [_extrusion.fullmatch(fmt) for fmt, fields in columns.templates]
+    eligible = np.array([match is not None for match in formats], dtype=bool)[columns.template]
+    commentRows = np.array(sorted(columns.comments), dtype=np.int64)
+    eligible[commentRows] = False
+    layerRows = np.array([row for row, comment in columns.comments.items() if comment.startswith(';LAYER:')], dtype=np.int64)
+    eligible[layerRows[layerRows > 0] - 1] = False
+    eligible[-1] = False
+    eBefore = _valueBefore(columns.e)
+    eligible &= ~np.isnan(_valueBefore(columns.x)) & ~np.isnan(_valueBefore(columns.y)) & (columns.e > eBefore)
+
+    points = _Points(columns, eligible)
+    kept = np.ones(len(points), dtype=bool)
+    fixed = np.zeros(len(points), dtype=bool)
+    arcs = None
+    if fitArcs and len(points):
+        xDecimals = np.array([int(match.group(1)) if match else 0 for match in formats] + [0])
+        arcs = _fitArcs(points, tolerance, xDecimals[columns.template[points.row]])
+    if arcs is not None:
+        first, last = arcs[0], arcs[1]
+        inner, offsets = _expandRanges(first + 1, last - first - 1)
+        kept[inner] = False
+        fixed[first] = True
+        fixed[last] = True
+    if mergeLines and len(points):
+        _mergeLines(points, kept, fixed, tolerance)
+
+    lines = data.split(b'\n')
+    if arcs is not None:
+        first, last, offsetX, offsetY, counterClockwise = arcs
+        for start, end, i, j, ccw in zip(first.tolist(), last.tolist(), offsetX.tolist(), offsetY.tolist(), counterClockwise.tolist()):
+            row = int(points.row[end])
+            match = formats[columns.template[row]]
+            xDecimals, eDecimals = int(match.group(1)), int(match.group(3))
+            lines[row] = ('G%d X%.*f Y%.*f I%.*f J%.*f E%.*f' % (3 if ccw else 2, xDecimals, columns.x[row], xDecimals, columns.y[row],
+                          xDecimals, i, xDecimals, j, eDecimals, columns.e[row])).encode()
+        stats['arcs'] = len(first)
+    removed = points.row[~kept]
+    for row in removed.tolist():
+        lines[row] = None
+    stats['movesMerged'] = len(removed) - (int((arcs[1] - arcs[0] - 1).sum()) if arcs is not None else 0)
+    stats['linesAfter'] = n - len(removed)
+    return b'\n'.join(line for line in lines if line is not None), stats
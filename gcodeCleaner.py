@@ -0,0 +1,312 @@
+# Streaming cleanup of Slic3r g-code for exportEngine.py.
+# Reads the Slic3r output line by line and writes the same result as the old list based cleanup:
+#   1. Remove header and footer lines
+#   2. Copy M106 or M107 from the previous layer to set fan speed
+#   3. Put 'G1 X... Y... F...' at the 3rd line of every layer
+#   4. Reset E values after every layer change
+#   5. Add ';LAYER:n ;tag' before each 'G1 Z...'
+# A layer is a 'G1 Z...' line and everything up to the next one. Step 3 of a layer can take a line from the
+# previous layer and step 4 can add lines at the end of the previous layer, so only three layers are kept in memory.
+#
+# Step 4 moves and inserts lines as it goes but leaves the E values for later: it notes which runs of lines get which
+# E shifts, and the written lines are rebased a block at a time by gcodeEValues.rebaseEValues.
+
+import time
+
+import numpy as np
+
+from gcodeEValues import eValueOf, rebaseEValues
+
+
+batchLines = 1 << 16        # Written lines that are rebased together
+
+
+def stripHeader(lines):
+    # Drop everything before the second 'G1 Z...' and the two lines after it ('G1 E-2.00000 F2400.00000' and 'G92 E0').
+    # When the line before is 'G1 X...', the old cleanup copied it after 'G1 Z...' and then deleted the copy with the first line.
+    lines = iter(lines)
+    previous = None
+    zCount = 0
+    for line in lines:
+        if line.startswith('G1 Z'):
+            zCount += 1
+            if zCount == 2:
+                break
+        previous = line
+    else:
+        return
+
+    yield line
+    skip = 1 if previous is not None and previous.startswith('G1 X') else 2
+    for line in lines:
+        if skip > 0:
+            skip -= 1
+            continue
+        yield line
+
+
+def stripFooter(lines):
+    # Drop lines after the last 'G92 E0'. Only the lines since the latest 'G92 E0' are held back.
+    pending = []
+    for line in lines:
+        pending.append(line)
+        if line.startswith('G92 E0'):
+            yield from pending
+            pending = []
+
+
+def spanAt(spans, i):
+    for span in spans:
+        if span[0] <= i < span[1]:
+            return span
+    return None
+
+
+def popLine(layer, spans, i):
+    # layer.pop(i), keeping spans on the same lines. Returns the line and its span, if any.
+    span = spanAt(spans, i)
+    for other in spans:
+        if other[0] > i:
+            other[0] -= 1
+        if other[1] > i:
+            other[1] -= 1
+    spans[:] = [other for other in spans if other[0] < other[1]]
+    return layer.pop(i), span
+
+
+def insertLine(layer, spans, i, line):
+    # layer.insert(i, line) for a line without E shifts, splitting the span around i
+    for span in list(spans):
+        if span[0] >= i:
+            span[0] += 1
+            span[1] += 1
+        elif span[1] > i:
+            spans.append([i + 1, span[1] + 1, span[2], span[3]])
+            span[1] = i
+    layer.insert(i, line)
+
+
+def isTravelWithFeedrate(layer, i):
+    return i < len(layer) and layer[i].startswith('G1 X') and layer[i].find('F') != -1
+
+
+class LayerCleaner:
+    def __init__(self, tag, showMessage, timings=None):
+        self.tag = tag
+        self.showMessage = showMessage
+        self.timings = timings      # When a dict, wall and CPU seconds of steps 2 to 5 are added to it
+        self.layers = []            # Layers that are not written yet. At most three.
+        self.layerSpans = []        # For each of layers, [start, end, first, stop]: lines start to end-1 get the E shifts first to stop-1
+        self.layerRetracts = []     # For each of layers, (i, shift): line i is the retract before the 'G92 E0' of E shift shift
+        self.layerCount = 0         # Layers received so far
+        self.writtenCount = 0       # Layers written so far
+        self.lastFan = None         # Last M106/M107 of the previous layer
+        self.lastELine = None       # Last written line containing 'E'
+        self.lastESpan = None       # Span of lastELine
+        self.eValueDiffs = []       # Indexes of E shifts that have not met a 'G92 E0' yet
+        self.shiftSources = []      # For each E shift, the last E value before it, or (line, first, stop) to work it out
+        self.shiftValues = []       # E shifts worked out so far
+        self.written = []           # Written lines that are not rebased yet
+        self.writtenSpans = []      # Spans of written
+        self.writtenRetracts = []   # Retracts of written
+
+    def push(self, layer):
+        # Steps 2 and 3 for the new layer, step 4 for the layer before it, then write the layer before that.
+        self.timed('2 setFan', self.setFan, layer)
+        if self.layerCount > 0:
+            self.timed('3 moveTravel', self.moveTravel, layer, self.layers[-1])
+        self.layers.append(layer)
+        self.layerSpans.append([])
+        self.layerRetracts.append([])
+        self.layerCount += 1
+
+        if self.layerCount >= 3:
+            self.timed('4 resetEValues', self.resetEValues, -2)
+            self.timed('5 write', self.write)
+
+    def finish(self):
+        if self.layerCount >= 2:
+            self.timed('4 resetEValues', self.resetEValues, -1)
+        while self.layers:
+            self.timed('5 write', self.write)
+
+    def flush(self):
+        # The written lines with their E values rebased
+        lines = self.timed('4 normalizeEValues', self.normalizeEValues, self.written, self.writtenSpans, self.writtenRetracts)
+        self.written = []
+        self.writtenSpans = []
+        self.writtenRetracts = []
+        return lines
+
+    def timed(self, step, method, *args):
+        if self.timings is None:
+            return method(*args)
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time()
+        result = method(*args)
+        wall, cpu = self.timings.get(step, (0.0, 0.0))
+        self.timings[step] = (wall + time.perf_counter() - wallStart, cpu + time.thread_time() - cpuStart)
+        return result
+
+    def write(self):
+        layer = self.layers.pop(0)
+        spans = self.layerSpans.pop(0)
+        retracts = self.layerRetracts.pop(0)
+        self.writtenCount += 1
+        for i in range(len(layer)-1, -1, -1):
+            if layer[i].find('E') != -1:
+                self.lastELine = layer[i]
+                self.lastESpan = spanAt(spans, i)
+                break
+        self.written.append(';LAYER:'+str(self.writtenCount)+' ;'+self.tag+'\n')
+        offset = len(self.written)
+        self.written += layer
+        for start, end, first, stop in spans:
+            self.writtenSpans.append((offset + start, offset + end, first, stop))
+        for i, shift in retracts:
+            self.writtenRetracts.append((offset + i, shift))
+
+    ### 2. Copy M106 or M107 from the nearest previous line to set fan speed. First layer is always M107
+    def setFan(self, layer):
+        if self.layerCount == 0:
+            layer.insert(1, "M107\n")
+        elif self.lastFan is not None:
+            layer.insert(1, self.lastFan)
+
+        for line in reversed(layer[1:]):
+            if line.startswith('M106') or line.startswith('M107'):
+                self.lastFan = line
+                break
+
+    ### 3. Put 'G1 X... Y... F...' at the 3rd line
+    def moveTravel(self, layer, previousLayer):
+        # 3.1 Move 'G1 X... Y... F...' to the 3rd line if it is in the next 2 lines
+        if isTravelWithFeedrate(layer, 2):
+            pass
+        elif isTravelWithFeedrate(layer, 3):
+            layer.insert(2, layer.pop(3))
+        elif isTravelWithFeedrate(layer, 4):
+            layer.insert(2, layer.pop(4))
+
+        # 3.2 Otherwise move the last X,Y position of the previous layer. This also removes an unnecessary movement at the end of the previous layer
+        else:
+            for j in range(len(previousLayer)-1, 0, -1):
+                if previousLayer[j].startswith('G1 X'):
+                    layer.insert(2, previousLayer.pop(j))
+                    break
+
+    ### 4. Reset E values after every layer change
+    def resetEValues(self, k):
+        # Step 4 for self.layers[k], which adds lines to the layer before it
+        layer, previousLayer = self.layers[k], self.layers[k-1]
+        spans, previousSpans = self.layerSpans[k], self.layerSpans[k-1]
+        # E shifts of earlier layers continue until the next 'G92 E0'
+        if self.eValueDiffs:
+            self.shift(layer, spans, 0, self.eValueDiffs)
+
+        # 4.1 If there is 'G92 E0' at 4th line after 'G1 Z...', Move that line and the previous line above 'G1 Z...'
+        if len(layer) > 4 and layer[4].startswith('G92 E0'):
+            for k in range(2):
+                line, span = popLine(layer, spans, 3)
+                if span is not None:
+                    previousSpans.append([len(previousLayer), len(previousLayer) + 1, span[2], span[3]])
+                previousLayer.append(line)
+
+        # 4.2 If there is no 'G92 E0' before 'G1 Z...', Reset E value until meeting the next 'G92 E0'
+        elif not previousLayer[-1].startswith('G92 E0'):
+            # 4.2.1 Insert 'G92 E0' before layer change, using the last E value
+            prevEValue = -1
+            lastELine, lastESpan = self.lastELine, self.lastESpan
+            for j in range(len(previousLayer)-1, -1, -1):
+                if previousLayer[j].find('E') != -1:
+                    lastELine, lastESpan = previousLayer[j], spanAt(previousSpans, j)
+                    break
+
+            shift = len(self.shiftSources)
+            if lastELine is not None:
+                if lastELine.find('F') != -1:
+                    self.showMessage('Error!')
+                else:
+                    if lastESpan is not None and lastELine.startswith('G1 X'):
+                        prevEValue = (lastELine, lastESpan[2], lastESpan[3])
+                    else:
+                        head, sep, eValueStr = lastELine.partition('E')
+                        prevEValue = float(eValueStr.strip())
+                    self.layerRetracts[k-1].append((len(previousLayer), shift))
+                    previousLayer.append("G1 E0 F2400.000\n") # Retract, value set by normalizeEValues
+                    previousLayer.append("G92 E0\n")
+                    insertLine(layer, spans, 3, "G1 E2.00000 F2400.000\n")
+
+            # 4.2.2 Shift E values until meeting the next 'G92 E0'
+            self.shiftSources.append(prevEValue)
+            self.eValueDiffs.append(shift)
+            self.shift(layer, spans, 4, self.eValueDiffs[-1:])
+
+    def shift(self, layer, spans, start, eValueDiffs):
+        # Lines from start until the next 'G92 E0' get the E shifts eValueDiffs. They are numbered in order, so lines
+        # that already have the shifts just before get one span with both.
+        end = start
+        while end < len(layer) and not layer[end].startswith('G92 E0'):
+            end += 1
+        if end < len(layer):
+            self.eValueDiffs = []
+        first, stop = eValueDiffs[0], eValueDiffs[-1] + 1
+        if end == start:
+            return
+        for span in spans:
+            if span[3] == first and span[0] < end and span[1] > start:
+                low, high = max(span[0], start), min(span[1], end)
+                for outside in ([span[0], low, span[2], first], [high, span[1], span[2], first], [start, low, first, stop], [high, end, first, stop]):
+                    if outside[0] < outside[1]:
+                        spans.append(outside)
+                span[:] = [low, high, span[2], stop]
+                return
+        spans.append([start, end, first, stop])
+
+    def normalizeEValues(self, lines, spans, retracts):
+        # Step 4 for the values. E shifts are worked out in order, as each one can depend on a line shifted by the ones
+        # before, then the lines of all spans are rebased at once.
+        for source in self.shiftSources[len(self.shiftValues):]:
+            if isinstance(source, tuple):
+                line, first, stop = source
+                source = eValueOf(line)
+                for shift in range(first, stop):
+                    source = float("%.5f" % (source - self.shiftValues[shift]))
+            self.shiftValues.append(source - 2)
+
+        for i, shift in retracts:
+            lines[i] = "G1 E"+str(round(self.shiftValues[shift], 5))+" F2400.000\n"
+
+        if spans:
+            spanLines = []
+            for start, end, first, stop in spans:
+                spanLines += lines[start:end]
+            spans = np.array(spans, dtype=np.int64)
+            lengths = spans[:, 1] - spans[:, 0]
+            rebased = rebaseEValues(spanLines, np.repeat(spans[:, 2], lengths), np.repeat(spans[:, 3] - spans[:, 2], lengths),
+                                    np.array(self.shiftValues))
+            offset = 0
+            for (start, end, first, stop), length in zip(spans.tolist(), lengths.tolist()):
+                lines[start:end] = rebased[offset:offset + length]
+                offset += length
+        return lines
+
+
+def cleanSlic3rGcode(lines, tag, showMessage=print, timings=None):
+    # Generator of cleaned lines. lines can be an open file. See LayerCleaner for timings.
+    cleaner = LayerCleaner(tag, showMessage, timings)
+    layer = None
+    for line in stripFooter(stripHeader(lines)):
+        if line.startswith('G1 Z'):
+            if layer is not None:
+                cleaner.push(layer)
+                if len(cleaner.written) >= batchLines:
+                    yield from cleaner.flush()
+            layer = [line]
+        elif layer is not None:
+            layer.append(line)
+
+    if layer is not None:
+        cleaner.push(layer)
+    cleaner.finish()
+    yield from cleaner.flush()
@@ -0,0 +1,244 @@
+# Columnar g-code for exportEngine.py.
+# A g-code file becomes one row per line: an opcode array, float arrays for the X, Y, Z, E and F words (nan when a line
+# has no such word) and a side table of comments. The rest of a line, i.e. the other words, their order, spacing and
+# number of decimals, is kept in a small table of format templates shared by all lines of the same shape.
+# format() writes the lines back byte for byte, so transforms can work on the arrays instead of on strings.
+#
+# Parsing runs on the bytes with NumPy. A number becomes a column value only if it is written back the same way,
+# e.g. 'X12.500' but not 'X+12.5' or 'X012.5'; other numbers stay in the template as text.
+
+import re
+
+import numpy as np
+
+
+fieldNames = 'XYZEF'
+chunkSize = 1 << 22         # Bytes parsed at once. Bounds the size of the temporary arrays
+
+_letterCodes = np.frombuffer(fieldNames.encode(), dtype=np.uint8)
+_letterIndex = np.full(256, -1, dtype=np.int64)     # Byte -> index in fieldNames
+_letterIndex[_letterCodes] = np.arange(len(fieldNames))
+_isLetter = _letterIndex >= 0
+_isTerminator = np.zeros(256, dtype=bool)           # Ends a number: whitespace or ';'
+_isTerminator[[9, 10, 13, 32, 59]] = True
+_powersOfTen = 10.0 ** np.arange(16)
+_marker = re.compile('([XYZEF])(\x00(.)|\x01)')     # A column value in a shape string. See _parseChunk
+
+
+def _templateOfShape(shape):
+    # 'G1 X\x00d Y\x00d E\x00f' -> ('G1 X%.3f Y%.3f E%.5f', 'XYE'), the decimals are ord(c) - ord('a')
+    fields = ''.join(match.group(1) for match in _marker.finditer(shape))
+    fmt = _marker.sub(lambda match: match.group(1) + ('%.' + str(ord(match.group(3)) - 97) + 'f' if match.group(3) else '%.0f'),
+                      shape.replace('%', '%%'))
+    return fmt, fields
+
+
+def _parseChunk(data):
+    # data is bytes of whole lines. Returns the shape string of every line, the column values and the comments.
+    buf = np.frombuffer(data, dtype=np.uint8)
+    n = len(buf)
+    newlines = np.flatnonzero(buf == 10)
+    lineEnds = newlines if data.endswith(b'\n') else np.append(newlines, n)
+    lineStarts = np.concatenate(([0], newlines + 1))[:len(lineEnds)]
+    lineCount = len(lineEnds)
+    lineOf = lambda positions: np.searchsorted(lineStarts, positions, side='right') - 1
+
+    # Comments from the first ';' of a line to its end
+    semicolons = np.flatnonzero(buf == 59)
+    commentLines, first = np.unique(lineOf(semicolons), return_index=True)
+    commentStarts = semicolons[first]
+    codeEnds = lineEnds.copy()
+    codeEnds[commentLines] = commentStarts
+
+    # Candidate words: a field letter after a space or tab, in the code part of the line, on a line without marker bytes
+    isLetter = _isLetter[buf]
+    isLetter[0] = False
+    isLetter[1:] &= (buf[:-1] == 32) | (buf[:-1] == 9)
+    letters = np.flatnonzero(isLetter)
+    letterLines = lineOf(letters)
+    badLines = np.unique(lineOf(np.flatnonzero(buf <= 1)))
+    keep = (letters < codeEnds[letterLines]) & ~np.isin(letterLines, badLines)
+    letters, letterLines = letters[keep], letterLines[keep]
+
+    # A number runs to the next whitespace or ';' or the end of the code
+    terminators = np.append(np.flatnonzero(_isTerminator[buf]), n)
+    numStarts = letters + 1
+    numEnds = np.minimum(terminators[np.searchsorted(terminators, numStarts)], codeEnds[letterLines])
+    lengths = numEnds - numStarts
+    keep = lengths > 0
+    letters, letterLines, numStarts, numEnds, lengths = letters[keep], letterLines[keep], numStarts[keep], numEnds[keep], lengths[keep]
+    count = len(letters)
+
+    # Check the characters of every number: optional '-', digits, optional '.' followed by digits
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    token = np.repeat(np.arange(count), lengths)
+    position = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    chars = buf[np.repeat(numStarts, lengths) + position]
+    isDigit = (chars >= 48) & (chars <= 57)
+    isDot = chars == 46
+    starts = offsets[:-1]
+    if count:
+        bad = np.logical_or.reduceat(~(isDigit | isDot | ((chars == 45) & (position == 0))), starts)
+        dots = np.add.reduceat(isDot, starts, dtype=np.int32)
+        digits = np.add.reduceat(isDigit, starts, dtype=np.int32)
+    else:
+        bad = dots = digits = np.zeros(0, dtype=np.int32)
+    dotIndexes = np.flatnonzero(isDot)
+    dotPosition = np.full(count, -1, dtype=np.int64)    # Position of the '.' in the number, -1 if none
+    dotPosition[token[dotIndexes]] = position[dotIndexes]
+    negative = buf[numStarts] == 45
+    hasDot = dots == 1
+    intDigits = np.where(hasDot, dotPosition, lengths) - negative
+    decimals = np.where(hasDot, lengths - dotPosition - 1, 0)
+    firstDigit = buf[np.minimum(numStarts + negative, n - 1)]
+    valid = ~bad & (dots <= 1) & (intDigits >= 1) & (digits <= 15) & ~(hasDot & (decimals == 0)) & ~((firstDigit == 48) & (intDigits > 1))
+
+    # Values: integer mantissa of the digits divided by a power of ten, the same double as float().
+    # A digit is worth 10 to the power of the number of digits after it.
+    exponent = np.repeat(lengths - 1, lengths) - position - (position < np.repeat(dotPosition, lengths))
+    digitValues = np.where(isDigit, chars - 48, 0) * _powersOfTen[np.clip(exponent, 0, 15)]
+    mantissa = np.add.reduceat(digitValues, starts) if count else np.zeros(0)
+    values = mantissa / _powersOfTen[np.minimum(decimals, 15)]
+    values = np.where(negative, -values, values)
+
+    # Only the first valid word of each letter on a line becomes a column value
+    letterIndex = _letterIndex[buf[letters]]
+    validIds = np.flatnonzero(valid)
+    _, first = np.unique(letterLines[validIds] * len(fieldNames) + letterIndex[validIds], return_index=True)
+    used = validIds[np.sort(first)]
+
+    columns = np.full((len(fieldNames), lineCount), np.nan)
+    columns[letterIndex[used], letterLines[used]] = values[used]
+
+    # Shape of each line: the code with every used number replaced by a marker. '\x00' and a letter for the number
+    # of decimals ('a' is none), or '\x01' for a one character number. Comments are removed.
+    shape = buf.copy()
+    usedStarts, usedEnds, usedLengths = numStarts[used], numEnds[used], lengths[used]
+    long = usedLengths >= 2
+    shape[usedStarts[~long]] = 1
+    shape[usedStarts[long]] = 0
+    shape[usedStarts[long] + 1] = 97 + decimals[used][long]
+    # Ranges to remove: the rest of every long number, and every comment
+    removeStarts = np.concatenate((usedStarts[long] + 2, commentStarts))
+    removeEnds = np.concatenate((usedEnds[long], lineEnds[commentLines]))
+    remove = np.bincount(removeStarts, minlength=n + 1) - np.bincount(removeEnds, minlength=n + 1)
+    shapes = shape[np.cumsum(remove[:-1]) == 0].tobytes().decode('utf-8', 'surrogateescape').split('\n')[:lineCount]
+
+    comments = {}
+    for line, start in zip(commentLines.tolist(), commentStarts.tolist()):
+        comments[line] = data[start:lineEnds[line]].decode('utf-8', 'surrogateescape')
+    return shapes, columns, comments
+
+
+class GcodeColumns:
+    def __init__(self):
+        self.opNames = []           # Opcode names, e.g. 'G1'. op holds indexes into this list
+        self.templates = []         # (format string, field letters) of each line shape
+        self.templateOps = []       # Opcode index of each template
+        self.op = np.zeros(0, dtype=np.int16)
+        self.template = np.zeros(0, dtype=np.int32)
+        self.x = self.y = self.z = self.e = self.f = np.zeros(0)
+        self.comments = {}          # Row -> comment, from ';' to the end of the line
+        self.finalNewline = True
+
+    def __len__(self):
+        return len(self.op)
+
+    def column(self, letter):
+        return getattr(self, letter.lower())
+
+    def opcode(self, name):
+        # Index of an opcode name for masks like columns.op == columns.opcode('G92'). -1 if no line has it
+        try:
+            return self.opNames.index(name)
+        except ValueError:
+            return -1
+
+    @classmethod
+    def parse(cls, data):
+        # data is the bytes (or str) of a whole g-code file
+        if isinstance(data, str):
+            data = data.encode('utf-8', 'surrogateescape')
+        columns = cls()
+        shapeIndexes = {}
+        opIndexes = {}
+        templates = []
+        values = []
+        start = 0
+        row = 0
+        while start < len(data):
+            end = start + chunkSize
+            if end >= len(data):
+                end = len(data)
+            else:
+                cut = data.rfind(b'\n', start, end)
+                end = cut + 1 if cut != -1 else (data.find(b'\n', end) + 1 or len(data))
+            shapes, chunkValues, comments = _parseChunk(data[start:end])
+
+            for shape in shapes:
+                if shape not in shapeIndexes:
+                    shapeIndexes[shape] = len(columns.templates)
+                    columns.templates.append(_templateOfShape(shape))
+                    words = shape.split(None, 1)
+                    name = words[0] if words else ''
+                    if name not in opIndexes:
+                        opIndexes[name] = len(columns.opNames)
+                        columns.opNames.append(name)
+                    columns.templateOps.append(opIndexes[name])
+            templates.append(np.array([shapeIndexes[shape] for shape in shapes], dtype=np.int32))
+            values.append(chunkValues)
+            for line, comment in comments.items():
+                columns.comments[row + line] = comment
+            row += len(shapes)
+            start = end
+
+        columns.finalNewline = len(data) == 0 or data.endswith(b'\n')
+        columns.template = np.concatenate(templates) if templates else np.zeros(0, dtype=np.int32)
+        columns.op = np.array(columns.templateOps, dtype=np.int16)[columns.template] if len(columns.templates) else np.zeros(0, dtype=np.int16)
+        allValues = np.concatenate(values, axis=1) if values else np.zeros((len(fieldNames), 0))
+        for i, letter in enumerate(fieldNames):
+            setattr(columns, letter.lower(), allValues[i].copy())
+        return columns
+
+    @classmethod
+    def fromFile(cls, path):
+        with open(path, "rb") as f:
+            return cls.parse(f.read())
+
+    def format(self, blockSize=1 << 16):
+        # Generator of the lines. Rows are formatted in blocks, one % per row with all rows of a template together.
+        fieldIndexes = [[fieldNames.index(letter) for letter in fields] for fmt, fields in self.templates]
+        withNewline = [fmt + '\n' if fields else fmt.replace('%%', '%') + '\n' for fmt, fields in self.templates]
+        columns = [self.column(letter) for letter in fieldNames]
+        commentRows = np.array(sorted(self.comments), dtype=np.int64)
+
+        for blockStart in range(0, len(self), blockSize):
+            template = self.template[blockStart:blockStart + blockSize]
+            out = [None] * len(template)
+            order = np.argsort(template, kind='stable')
+            sortedTemplates = template[order]
+            bounds = np.flatnonzero(np.diff(sortedTemplates)) + 1
+            for rows in np.split(order, bounds):
+                t = int(template[rows[0]])
+                fmt = withNewline[t]
+                indexes = fieldIndexes[t]
+                if indexes:
+                    values = zip(*[columns[i][blockStart + rows].tolist() for i in indexes])
+                    for row, line in zip(rows.tolist(), [fmt % value for value in values]):
+                        out[row] = line
+                else:
+                    for row in rows.tolist():
+                        out[row] = fmt
+
+            first, last = np.searchsorted(commentRows, [blockStart, blockStart + len(template)])
+            for row in commentRows[first:last].tolist():
+                out[row - blockStart] = out[row - blockStart][:-1] + self.comments[row] + '\n'
+            if blockStart + len(template) == len(self) and not self.finalNewline:
+                out[-1] = out[-1][:-1]
+            yield from out
+
+    def write(self, f):
+        f.writelines(self.format())
+
+    def tobytes(self):
+        return ''.join(self.format()).encode('utf-8', 'surrogateescape')
@@ -0,0 +1,188 @@
+# Compact writer of output-all.gcode for exportEngine.exportAll.
+# The merged g-code goes through CompactWriter on its way to the file, a block of whole lines at a time:
+#   1. X, Y, Z and F are rounded to `decimals` and E to `eDecimals`, written without trailing zeros
+#   2. X, Y, Z and F words of G0/G1 lines that repeat the current position or feedrate are dropped. A G0/G1 line that
+#      is left without words, e.g. 'G0 Y117.50000' when the bed is already centered, is dropped
+#   3. 'G92 E0' when E is already 0 is dropped
+#   4. Comments after code and empty lines are dropped. Lines that are only a comment, e.g. ';LAYER:', are kept
+# The lines are parsed into columns by gcodeColumns, so the modal state is followed with NumPy and not line by line.
+# The position is unknown after a tool change, G28 and other G-codes that move, and X, Y and Z are not dropped after
+# G91 (relative positioning).
+
+import re
+
+import numpy as np
+
+import gcodeColumns
+
+
+blockSize = 1 << 22         # Bytes compacted at once
+
+_intPowersOfTen = 10 ** np.arange(19, dtype=np.int64)
+_field = re.compile('([ \t])([XYZEF])%\\.\\d+f')
+_eReset = re.compile('G92 E%\\.\\d+f')
+_keepsPosition = {'G0', 'G1', 'G2', 'G3', 'G4', 'G20', 'G21', 'G90', 'G92'}     # G-codes that leave a known position
+_dropLetters = 'XYZF'
+
+
+def formatTrimmed(values, decimals):
+    # Text of every value rounded to decimals without trailing zeros, e.g. '12.5', '-3', '0.001'
+    scale = int(_intPowersOfTen[decimals])
+    scaled = np.rint(np.abs(values) * scale).astype(np.int64)
+    negative = np.signbit(values) & (scaled > 0)
+    intPart, fraction = np.divmod(scaled, scale)
+    intDigits = np.searchsorted(_intPowersOfTen[1:], intPart, side='right') + 1
+    fractionDigits = np.full(len(values), decimals)
+    trimmed = fraction.copy()
+    for place in range(decimals):
+        zero = (fractionDigits > 0) & (trimmed % 10 == 0)
+        fractionDigits -= zero
+        trimmed = np.where(zero, trimmed // 10, trimmed)
+
+    # Every text is followed by '\n', so that one split gives the strings
+    lengths = negative + intDigits + (fractionDigits > 0) + fractionDigits + 1
+    offsets = np.concatenate(([0], np.cumsum(lengths)))[:-1]
+    text = np.full(int(lengths.sum()), 10, dtype=np.uint8)
+    text[offsets[negative]] = 45
+    digitsStart = offsets + negative
+    for place in range(int(intDigits.max()) if len(values) else 0):
+        rows = np.flatnonzero(intDigits > place)
+        text[digitsStart[rows] + intDigits[rows] - 1 - place] = 48 + intPart[rows] // _intPowersOfTen[place] % 10
+    dots = digitsStart + intDigits
+    rows = np.flatnonzero(fractionDigits > 0)
+    text[dots[rows]] = 46
+    for place in range(decimals):
+        rows = np.flatnonzero(fractionDigits > place)
+        text[dots[rows] + fractionDigits[rows] - place] = 48 + trimmed[rows] // _intPowersOfTen[place] % 10
+    return text.tobytes().decode().split('\n')[:-1]
+
+
+def _previous(values, events, start):
+    # State before every row when the event rows set it to their value (nan: unknown), and the state after the last row
+    lastEvent = np.maximum.accumulate(np.where(events, np.arange(len(values)), -1))
+    before = np.concatenate(([-1], lastEvent[:-1]))
+    state = np.where(before >= 0, values[np.maximum(before, 0)], start)
+    end = values[lastEvent[-1]] if len(values) and lastEvent[-1] >= 0 else start
+    return state, end
+
+
+class CompactWriter:
+    # File-like writer: write() takes g-code bytes, out gets the compacted lines. close() writes the rest but does not
+    # close out. bytesIn and bytesOut count the bytes before and after compaction.
+    def __init__(self, out, decimals=3, eDecimals=5):
+        self.out = out
+        self.decimals = decimals
+        self.eDecimals = eDecimals
+        self.pending = bytearray()
+        self.state = {letter: np.nan for letter in 'XYZEF'}
+        self.relative = False
+        self.templates = {}     # (format string, field letters, dropped letters) -> compacted format string
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def write(self, data):
+        self.pending += data
+        self.bytesIn += len(data)
+        if len(self.pending) >= blockSize:
+            self.flush(final=False)
+
+    def close(self):
+        self.flush(final=True)
+
+    def flush(self, final=True):
+        # Compact the pending whole lines, blockSize bytes at a time. With final, also a last line without '\n'
+        start = 0
+        while start < len(self.pending):
+            end = self.pending.rfind(b'\n', start, start + blockSize) + 1
+            if end <= start:
+                end = self.pending.find(b'\n', start + blockSize) + 1
+            if end <= start:
+                if not final:
+                    break
+                end = len(self.pending)
+            self._compact(bytes(self.pending[start:end]))
+            start = end
+            if not final and len(self.pending) - start < blockSize:
+                break
+        del self.pending[:start]
+
+    def _compact(self, data):
+        columns = gcodeColumns.GcodeColumns.parse(data)
+        n = len(columns)
+        isMove = np.isin(columns.op, [columns.opcode('G0'), columns.opcode('G1')])
+        isSetter = np.isin(columns.op, [columns.opcode(name) for name in ('G0', 'G1', 'G2', 'G3', 'G92')])
+        lostOps = [i for i, name in enumerate(columns.opNames) if (name[:1] == 'G' and name not in _keepsPosition) or name[:1] == 'T']
+        lost = np.isin(columns.op, lostOps)
+        if columns.opcode('G91') != -1:
+            self.relative = True    # From here on, X, Y and Z are kept on every line
+
+        # Templates that keep a word of a letter as text, e.g. 'X+1': the state of that letter is unknown after them
+        literal = {letter: np.array([re.search('[ \t]' + letter + '(?!%)', fmt) is not None for fmt, fields in columns.templates] + [False])
+                   for letter in 'XYZEF'}
+
+        values = {}
+        drop = np.zeros(n, dtype=np.int64)
+        for bit, letter in enumerate('XYZEF'):
+            decimals = self.eDecimals if letter == 'E' else self.decimals
+            column = columns.column(letter)
+            rounded = np.round(column, decimals)
+            has = ~np.isnan(column)
+            unknown = lost | literal[letter][columns.template]
+            events = (isSetter & has) | unknown
+            previous, self.state[letter] = _previous(np.where(unknown, np.nan, rounded), events, self.state[letter])
+            values[letter] = rounded
+            if letter in _dropLetters and not (self.relative and letter != 'F'):
+                drop |= (isMove & has & (rounded == previous)).astype(np.int64) << bit
+            if letter == 'E':
+                eResets = np.array([_eReset.fullmatch(fmt.rstrip()) is not None for fmt, fields in columns.templates] + [False])
+                skipReset = eResets[columns.template] & (rounded == 0) & (previous == 0)
+
+        # Lines with the same template and the same dropped words share a compacted format string
+        keys = columns.template.astype(np.int64) * 32 + drop
+        order = np.argsort(keys, kind='stable')
+        out = [None] * n
+        texts = {}
+        for rows in np.split(order, np.flatnonzero(np.diff(keys[order])) + 1) if n else []:
+            key = int(keys[rows[0]])
+            fmt, fields = columns.templates[key // 32]
+            dropped = ''.join(letter for bit, letter in enumerate('XYZEF') if key % 32 >> bit & 1)
+            compactFmt = self._template(fmt, fields, dropped)
+            if compactFmt is None:
+                continue
+            kept = [letter for letter in fields if letter not in dropped]
+            if not kept:
+                line = compactFmt.replace('%%', '%')
+                for row in rows.tolist():
+                    out[row] = line
+                continue
+            for letter in kept:
+                if letter not in texts:
+                    texts[letter] = np.empty(n, dtype=object)
+                    wanted = np.flatnonzero(~np.isnan(values[letter]))
+                    texts[letter][wanted] = formatTrimmed(values[letter][wanted], self.eDecimals if letter == 'E' else self.decimals)
+            for row, value in zip(rows.tolist(), zip(*[texts[letter][rows].tolist() for letter in kept])):
+                out[row] = compactFmt % value
+
+        # Lines that are only a comment keep it
+        for row, comment in columns.comments.items():
+            if out[row] == '':
+                out[row] = comment
+        for row in np.flatnonzero(skipReset).tolist():
+            out[row] = None
+
+        text = '\n'.join(line for line in out if line) + '\n'
+        if text != '\n':
+            data = text.encode('utf-8', 'surrogateescape')
+            self.out.write(data)
+            self.bytesOut += len(data)
+
+    def _template(self, fmt, fields, dropped):
+        # Format string of a template with the dropped words removed and every other field written with %s.
+        # '' for lines without code, None for lines that are left out.
+        key = (fmt, fields, dropped)
+        if key not in self.templates:
+            compactFmt = _field.sub(lambda match: '' if match.group(2) in dropped else match.group(1) + match.group(2) + '%s', fmt).rstrip()
+            if compactFmt in ('G0', 'G1'):
+                compactFmt = None
+            self.templates[key] = compactFmt
+        return self.templates[key]
@@ -0,0 +1,157 @@
+# Bulk E value shifts for step 4 of gcodeCleaner.py.
+# The old cleanup shifted the E value of a line with shiftEValue, once for every shift, writing it with "%.5f" each time.
+# rebaseEValues gives the same lines for many lines at once: the values are parsed, shifted and rounded with NumPy and
+# the lines are put back together from their bytes. Lines with numbers it does not read, e.g. 'E1e3', go through
+# shiftEValue.
+
+import re
+
+import numpy as np
+
+
+_intPowersOfTen = 10 ** np.arange(19, dtype=np.int64)
+_numberWidth = 16
+_line = re.compile('[^\n]*\n')
+
+
+def shiftEValue(line, eValueDiff):
+    # Subtract eValueDiff from the E value of an extrusion or retraction line
+    if line.startswith('G1 X') and line.find('E') != -1: #G1 X26.295 Y147.794 E75.48784
+        head, sep, strEValue = line.partition('E')
+        return head + sep + "%.5f\n" % (float(strEValue.strip()) - eValueDiff)
+    elif line.startswith('G1 E') and line.find('F') != -1: #G1 E88.29126 F2400.00000
+        head, sepE, tail = line.partition('E')
+        strEValue, sepF, tailF = tail.partition('F')
+        return head + sepE + ("%.5f " % (float(strEValue.strip()) - eValueDiff)) + sepF + tailF
+    return line
+
+
+def eValueOf(line):
+    # The E value shiftEValue reads from line
+    head, sep, strEValue = line.partition('E')
+    if line.startswith('G1 E'):
+        strEValue = strEValue.partition('F')[0]
+    return float(strEValue.strip())
+
+
+def _shiftLine(line, first, count, shiftValues):
+    for shift in range(first, first + count):
+        line = shiftEValue(line, shiftValues[shift])
+    return line
+
+
+def roundDecimals(values, decimals=5):
+    # float('%.5f' % v) of every value. Values whose scaled product is too close to a rounding tie are formatted instead.
+    scale = 10.0 ** decimals
+    scaled = values * scale
+    rounded = np.rint(scaled)
+    result = rounded / scale
+    unsure = ~(np.abs(np.abs(scaled - rounded) - 0.5) > 1e-3) | ~(np.abs(scaled) < 2.0 ** 40)
+    for i in np.flatnonzero(unsure).tolist():
+        result[i] = float('%.*f' % (decimals, values[i]))
+    return result
+
+
+def _firstAt(positions, starts, ends):
+    # First of the sorted positions in every range [start, end), or -1
+    if len(positions) == 0:
+        return np.full(len(starts), -1, dtype=np.int64)
+    found = positions[np.minimum(np.searchsorted(positions, starts), len(positions) - 1)]
+    return np.where((found >= starts) & (found < ends), found, -1)
+
+
+def _parseNumbers(buf, starts, ends):
+    # float() of buf[start:end] for every range of at most _numberWidth bytes, and whether it was read.
+    # NumPy parses bytes as float() does. buf must end with a 0 byte and have no other.
+    lengths = ends - starts
+    width = int(min(lengths.max(), _numberWidth)) if len(lengths) else 1
+    positions = starts[:, None].astype(np.int32) + np.arange(width, dtype=np.int32)
+    chars = buf[np.where(positions < ends[:, None], positions, len(buf) - 1)]
+    valid = (lengths > 0) & (lengths <= width)
+    values = np.zeros(len(starts))
+    try:
+        values[valid] = chars[valid].view('S%d' % width).ravel().astype(np.float64)
+    except ValueError:
+        valid[:] = False    # Left to float(), which raises the error of the line
+    return values, valid
+
+
+def _formatFixed(values, trailingSpace):
+    # Bytes of "%.5f" % v for every value, with ' ' after the ones in trailingSpace, and the length of each text.
+    # Values must be below 1e9.
+    negative = np.signbit(values)
+    scaled = np.rint(np.abs(values) * 1e5).astype(np.int64)
+    intPart, fraction = np.divmod(scaled, 100000)
+    intDigits = np.searchsorted(_intPowersOfTen[1:10], intPart, side='right') + 1
+    lengths = negative + intDigits + 6 + trailingSpace
+    offsets = np.concatenate(([0], np.cumsum(lengths)))[:-1]
+    text = np.full(int(lengths.sum()), 32, dtype=np.uint8)
+    text[offsets[negative]] = 45
+    digitsStart = offsets + negative
+    for place in range(int(intDigits.max()) if len(values) else 0):
+        rows = np.flatnonzero(intDigits > place)
+        text[digitsStart[rows] + intDigits[rows] - 1 - place] = 48 + intPart[rows] // _intPowersOfTen[place] % 10
+    dots = digitsStart + intDigits
+    text[dots] = 46
+    for place in range(5):
+        text[dots + 5 - place] = 48 + fraction // _intPowersOfTen[place] % 10
+    return text, lengths
+
+
+def rebaseEValues(lines, first, count, shiftValues):
+    # Line i gets the shifts first[i] to first[i]+count[i]-1 of shiftValues, as if shiftEValue was called once for each
+    # in that order. lines end with '\n'. Returns the new lines.
+    data = ''.join(lines).encode('utf-8', 'surrogateescape')
+    if b'\0' in data:
+        return [_shiftLine(line, first[i], count[i], shiftValues) for i, line in enumerate(lines)]
+    padded = np.frombuffer(data + b'\0', dtype=np.uint8)
+    buf = padded[:-1]
+    lineEnds = np.flatnonzero(buf == 10)
+    lineStarts = np.concatenate(([0], lineEnds[:-1] + 1))
+    head = buf[np.minimum(lineStarts[:, None] + np.arange(4), len(buf) - 1)]
+    isLong = lineEnds - lineStarts >= 4
+    isG1 = isLong & (head[:, 0] == 71) & (head[:, 1] == 49) & (head[:, 2] == 32)
+    firstE = _firstAt(np.flatnonzero(buf == 69), lineStarts, lineEnds)
+    firstF = _firstAt(np.flatnonzero(buf == 70), lineStarts, lineEnds)
+    xForm = isG1 & (head[:, 3] == 88) & (firstE != -1) & (count > 0)
+    eForm = isG1 & (head[:, 3] == 69) & (firstF != -1) & (count > 0)
+
+    # The number after 'E' runs to the end of the line, or to 'F'
+    rows = np.flatnonzero(xForm | eForm)
+    values, valid = _parseNumbers(padded, firstE[rows] + 1, np.where(eForm, firstF, lineEnds)[rows])
+
+    eValues = values[valid]
+    simpleRows = rows[valid]
+    rowFirst = first[simpleRows]
+    rowCount = count[simpleRows]
+    for k in range(int(rowCount.max()) if len(rowCount) else 0):
+        active = np.flatnonzero(rowCount > k)
+        eValues[active] = roundDecimals(eValues[active] - shiftValues[rowFirst[active] + k])
+    small = np.abs(eValues) < 1e9
+    fallbackRows = np.concatenate((rows[~valid], simpleRows[~small]))
+    eValues, simpleRows = eValues[small], simpleRows[small]
+
+    # Every line is copied from buf in up to three parts: up to and including 'E', the new number, and the end of the
+    # line ('\n', or from 'F' on). The new numbers are put after buf in the source of the copy.
+    text, textLengths = _formatFixed(eValues, eForm[simpleRows])
+    source = np.concatenate((buf, text))
+    partStarts = np.stack((lineStarts, np.zeros_like(lineStarts), lineEnds), axis=1)
+    partLengths = np.stack((lineEnds + 1 - lineStarts, np.zeros_like(lineStarts), np.zeros_like(lineStarts)), axis=1)
+    partLengths[simpleRows, 0] = firstE[simpleRows] + 1 - lineStarts[simpleRows]
+    partStarts[simpleRows, 1] = len(buf) + np.concatenate(([0], np.cumsum(textLengths)))[:-1]
+    partLengths[simpleRows, 1] = textLengths
+    partStarts[simpleRows, 2] = np.where(eForm[simpleRows], firstF[simpleRows], lineEnds[simpleRows])
+    partLengths[simpleRows, 2] = lineEnds[simpleRows] + 1 - partStarts[simpleRows, 2]
+    partStarts, partLengths = partStarts.ravel().astype(np.int32), partLengths.ravel().astype(np.int32)
+    outOffsets = np.cumsum(partLengths, dtype=np.int32) - partLengths
+    out = source[np.repeat(partStarts - outOffsets, partLengths) + np.arange(int(partLengths.sum()), dtype=np.int32)]
+
+    # str.splitlines() also breaks at other control characters and some non-ASCII ones
+    text = out.tobytes().decode('utf-8', 'surrogateescape')
+    if text.isascii() and not np.any((out < 32) & (out != 10) & (out != 9)):
+        result = text.splitlines(True)
+    else:
+        result = _line.findall(text)
+    for i in fallbackRows.tolist():
+        result[i] = _shiftLine(lines[i], first[i], count[i], shiftValues)
+    return result
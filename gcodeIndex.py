@@ -0,0 +1,331 @@
+# Layer index of cleaned g-code for exportEngine.py.
+# Built once while a g-code stream is written (or with one scan of a file) and then shared by every stage,
+# so that no stage has to search the lines for 'G1 Z' or ';LAYER:' again.
+# Byte offsets of the layers let GcodeFile copy ranges of a file or of an in-memory buffer without splitting it into lines.
+# Files are written with '\n' line endings (newline='\n') so that the offsets counted from the lines are exact.
+#
+# Files are memory-mapped. The scan of a file finds the line and layer starts with NumPy and only decodes the few
+# lines that give the height, fan speed and E value of each layer.
+
+import mmap
+import os
+
+import numpy as np
+
+
+_moves = ('G1', 'G2 ', 'G3 ')     # Lines that can set Z and E. G2/G3 are arcs, see gcodeArcs.py
+
+
+class LayerIndex:
+    def __init__(self, lineStarts, z, fan, eStart, lineCount, byteStarts, lastLineBytes, byteCount):
+        self.lineStarts = lineStarts    # Line number of the ';LAYER:' line of each layer
+        self.z = z                      # Height of each layer, from its 'G1 Z...' line
+        self.fan = fan                  # Fan speed during each layer. 0 is M107
+        self.eStart = eStart            # E value when each layer starts. 0 after 'G92 E0'
+        self.lineCount = lineCount
+        self.byteStarts = byteStarts        # Byte offset of the ';LAYER:' line of each layer
+        self.lastLineBytes = lastLineBytes  # Byte offset of the last line of each layer
+        self.byteCount = byteCount
+
+    def __len__(self):
+        return len(self.lineStarts)
+
+    def layerAtZ(self, z):
+        # Index of the first layer above height z, O(log n). Layer heights are increasing.
+        return int(np.searchsorted(self.z, z + 1e-9, side='right'))
+
+    @classmethod
+    def fromLines(cls, lines):
+        builder = LayerIndexBuilder()
+        for line in lines:
+            builder.add(line)
+        return builder.finish()
+
+    @classmethod
+    def fromFile(cls, path):
+        data = mapFile(path)
+        try:
+            return cls.fromBytes(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    @classmethod
+    def fromBytes(cls, data):
+        # The index fromLines gives for the lines of data, which is bytes or a memory map
+        buf = np.frombuffer(data, dtype=np.uint8)
+        lineStarts = _lineStarts(buf)
+        lineEnds = np.append(lineStarts[1:], len(buf))
+        layerLines = np.flatnonzero(_startsWith(buf, lineStarts, b';LAYER:'))
+        layerCount = len(layerLines)
+
+        # Lines that can set the height, fan speed or E value. Each one is decoded and checked as LayerIndexBuilder.add
+        # does, so a 'Z' in a comment is not taken for a height
+        isMove = _startsWith(buf, lineStarts, b'G1') | _startsWith(buf, lineStarts, b'G2 ') | _startsWith(buf, lineStarts, b'G3 ')
+        zLines = np.flatnonzero(isMove & _hasByte(buf, lineStarts, b'Z'))
+        fanLines = np.flatnonzero(_startsWith(buf, lineStarts, b'M106') | _startsWith(buf, lineStarts, b'M107'))
+        eLines = np.flatnonzero((isMove & _hasByte(buf, lineStarts, b'E')) | _startsWith(buf, lineStarts, b'G92 E0'))
+        del buf
+
+        starts, ends = lineStarts.tolist(), lineEnds.tolist()
+
+        def line(k):
+            return data[starts[k]:ends[k]].decode()
+
+        # Candidates of every layer: from the layer line to the next one. E values count from the start of the file
+        bounds = np.append(layerLines, len(lineStarts))
+        zFirst = np.searchsorted(zLines, bounds).tolist()
+        fanFirst = np.searchsorted(fanLines, bounds).tolist()
+        eLast = np.searchsorted(eLines, bounds).tolist()
+        zLines, fanLines, eLines = zLines.tolist(), fanLines.tolist(), eLines.tolist()
+
+        z = np.zeros(layerCount)
+        fan = np.zeros(layerCount, dtype=np.int16)
+        eStart = np.zeros(layerCount)
+        height = 0.0
+        speed = 0
+        eValue = 0.0
+        for i in range(layerCount):
+            # E value at the layer start: set by the last line before it that sets E, else the same as at the layer before
+            for k in reversed(eLines[eLast[i-1] if i else 0:eLast[i]]):
+                value = _eValueOf(line(k))
+                if value is not None:
+                    eValue = value
+                    break
+            eStart[i] = eValue
+
+            for k in zLines[zFirst[i]:zFirst[i+1]]:
+                value = _zValueOf(line(k))
+                if value is not None:
+                    height = value
+                    break
+            z[i] = height
+
+            if fanFirst[i] < fanFirst[i+1]:
+                speed = fanSpeed(line(fanLines[fanFirst[i]]))
+            fan[i] = speed
+
+        lastLineBytes = np.append(lineStarts[layerLines[1:] - 1], lineStarts[-1]) if layerCount else np.zeros(0, dtype=np.int64)
+        return LayerIndex(layerLines.astype(np.int64), z, fan, eStart, len(lineStarts),
+                          lineStarts[layerLines], lastLineBytes, len(data))
+
+
+class LayerIndexBuilder:
+    # Feed every written line to add(), then call finish()
+    def __init__(self):
+        self.lineStarts = []
+        self.z = []
+        self.fan = []
+        self.eStart = []
+        self.lineCount = 0
+        self.byteStarts = []
+        self.lastLineBytes = []
+        self.byteCount = 0
+        self.lineByte = 0       # Byte offset of the last added line
+        self.previousLineByte = 0
+        self.eValue = 0.0
+        self.needZ = False
+        self.needFan = False
+
+    def add(self, line):
+        self.lineByte = self.byteCount
+        self.byteCount += len(line) if line.isascii() else len(line.encode())
+
+        if line.startswith(';LAYER:'):
+            if self.lineStarts:
+                self.lastLineBytes.append(self.previousLineByte)
+            self.lineStarts.append(self.lineCount)
+            self.byteStarts.append(self.lineByte)
+            self.eStart.append(self.eValue)
+            self.z.append(self.z[-1] if self.z else 0.0)
+            self.fan.append(self.fan[-1] if self.fan else 0)
+            self.needZ = True
+            self.needFan = True
+
+        elif line.startswith(_moves):
+            for word in line.partition(';')[0].split()[1:]:
+                if word[0] == 'E':
+                    self.eValue = float(word[1:])
+                elif word[0] == 'Z' and self.needZ:
+                    self.z[-1] = float(word[1:])
+                    self.needZ = False
+
+        elif line.startswith('G92 E0'):
+            self.eValue = 0.0
+
+        elif self.needFan and (line.startswith('M106') or line.startswith('M107')):
+            self.fan[-1] = fanSpeed(line)
+            self.needFan = False
+
+        self.lineCount += 1
+        self.previousLineByte = self.lineByte
+
+    def finish(self):
+        lastLineBytes = self.lastLineBytes + [self.lineByte] if self.lineStarts else []
+        return LayerIndex(np.array(self.lineStarts, dtype=np.int64), np.array(self.z), np.array(self.fan, dtype=np.int16),
+                          np.array(self.eStart), self.lineCount,
+                          np.array(self.byteStarts, dtype=np.int64), np.array(lastLineBytes, dtype=np.int64), self.byteCount)
+
+
+class GcodeFile:
+    # Cleaned g-code and its layer index. data is the bytes of the g-code, or a read-only memory map of a file.
+    # A range of layers is written to the output as one slice of data, without reading or splitting its lines.
+    def __init__(self, data, index=None):
+        self.data = data
+        self.view = memoryview(data)
+        if index is None:
+            index = LayerIndex.fromBytes(data)
+        self.index = index
+
+    @classmethod
+    def open(cls, path, index=None):
+        return cls(mapFile(path), index)
+
+    @classmethod
+    def fromBytes(cls, data, index=None):
+        return cls(data, index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def tobytes(self):
+        return bytes(self.data)
+
+    def save(self, path):
+        # Write the whole g-code to path, e.g. the -tmp files of the debug output
+        with open(path, "wb") as out:
+            out.write(self.view)
+
+    def copyLayers(self, out, start, stop):
+        # Copy layers start..stop-1 to out without the last line of layer stop-1,
+        # the same lines as lines[lineStarts[start]:lineStarts[stop]-1] (or lines[lineStarts[start]:-1] for the last layer)
+        if start >= stop:
+            return
+        out.write(self.view[self.index.byteStarts[start]:self.index.lastLineBytes[stop-1]])
+
+    def layerEndpoints(self):
+        # XY where every layer starts and ends: the first and last move with X and Y among the lines copyLayers
+        # writes for it. nan for layers without such a move. Only those two lines of a layer are decoded.
+        buf = np.frombuffer(self.data, dtype=np.uint8)
+        layerCount = len(self.index)
+        starts = np.full((layerCount, 2), np.nan)
+        ends = np.full((layerCount, 2), np.nan)
+        if layerCount == 0:
+            return starts, ends
+        lineStarts = _lineStarts(buf)
+        lineEnds = np.append(lineStarts[1:], len(buf))
+        isMove = _startsWith(buf, lineStarts, b'G0 ') | _startsWith(buf, lineStarts, b'G1 ') | \
+                 _startsWith(buf, lineStarts, b'G2 ') | _startsWith(buf, lineStarts, b'G3 ')
+        xyLines = np.flatnonzero(isMove & _hasByte(buf, lineStarts, b'X') & _hasByte(buf, lineStarts, b'Y'))
+        del buf
+
+        # Candidates of every layer: after the layer line up to the line before its last one
+        layerLines = np.searchsorted(lineStarts, self.index.byteStarts)
+        lastLines = np.searchsorted(lineStarts, self.index.lastLineBytes)
+        first = np.searchsorted(xyLines, layerLines).tolist()
+        last = np.searchsorted(xyLines, lastLines).tolist()
+        xyLines, lineStarts, lineEnds = xyLines.tolist(), lineStarts.tolist(), lineEnds.tolist()
+
+        def pointOf(k):
+            line = self.data[lineStarts[k]:lineEnds[k]].decode()
+            return _xyValueOf(line)
+
+        for i in range(layerCount):
+            for k in xyLines[first[i]:last[i]]:
+                point = pointOf(k)
+                if point is not None:
+                    starts[i] = point
+                    break
+            for k in reversed(xyLines[first[i]:last[i]]):
+                point = pointOf(k)
+                if point is not None:
+                    ends[i] = point
+                    break
+        return starts, ends
+
+
+def mapFile(path):
+    # Read-only memory map of a file. Empty files cannot be mapped and give b''
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def markerRanges(data, marker):
+    # Byte ranges of the text after each line starting with marker, up to the next marker line or the end of data.
+    # data is bytes or a memory map. Used for the ';anchor' blocks of the thread g-code.
+    buf = np.frombuffer(data, dtype=np.uint8)
+    lineStarts = _lineStarts(buf)
+    markerLines = np.flatnonzero(_startsWith(buf, lineStarts, marker))
+    del buf
+    starts = np.append(lineStarts, len(data))[markerLines + 1]
+    ends = np.append(lineStarts[markerLines[1:]], len(data))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _lineStarts(buf):
+    # Byte offset of every line. A last line without '\n' is a line too
+    lineStarts = np.concatenate(([0], np.flatnonzero(buf == 10) + 1))
+    return lineStarts[:-1] if lineStarts[-1] == len(buf) else lineStarts
+
+
+def _startsWith(buf, lineStarts, prefix):
+    # Whether every line starts with the bytes prefix
+    result = lineStarts + len(prefix) <= len(buf)
+    for i, byte in enumerate(prefix):
+        rows = np.flatnonzero(result)
+        result[rows] = buf[lineStarts[rows] + i] == byte
+    return result
+
+
+def _hasByte(buf, lineStarts, byte):
+    # Whether every line has the byte somewhere in it
+    lines = np.searchsorted(lineStarts, np.flatnonzero(buf == byte[0]), side='right') - 1
+    result = np.zeros(len(lineStarts), dtype=bool)
+    result[lines] = True
+    return result
+
+
+def _zValueOf(line):
+    # Height of a move line as LayerIndexBuilder.add reads it, or None
+    for word in line.partition(';')[0].split()[1:]:
+        if word[0] == 'Z':
+            return float(word[1:])
+    return None
+
+
+def _xyValueOf(line):
+    # (X, Y) of a move line, or None if it does not set both
+    x = y = None
+    for word in line.partition(';')[0].split()[1:]:
+        if word[0] == 'X':
+            x = float(word[1:])
+        elif word[0] == 'Y':
+            y = float(word[1:])
+    return None if x is None or y is None else (x, y)
+
+
+def _eValueOf(line):
+    # E value after a move or 'G92 E0' line as LayerIndexBuilder.add reads it, or None if the line leaves it
+    if not line.startswith(_moves):
+        return 0.0
+    value = None
+    for word in line.partition(';')[0].split()[1:]:
+        if word[0] == 'E':
+            value = float(word[1:])
+    return value
+
+
+def fanSpeed(line):
+    if line.startswith('M107'):
+        return 0
+    for word in line.split(';')[0].split()[1:]:
+        if word.startswith('S'):
+            return int(float(word[1:]))
+    return 255
@@ -0,0 +1,107 @@
+# On-disk cache of Slic3r output for exportEngine.py.
+# Entries are named by a hash of the STL bytes and the Slic3r command line, so unchanged bodies and anchors
+# are not sliced again. The least recently used entries are removed when the cache grows over maxBytes.
+
+import hashlib
+import os, shutil
+import threading
+
+
+def hashFile(path, h=None):
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h
+
+
+class SlicerCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, stlPath, command):
+        # command is the Slic3r argument list without the input and output files
+        h = hashFile(stlPath)
+        h.update('\0'.join(command).encode())
+        return h.hexdigest()
+
+    def subKey(self, key, *parts):
+        # Key of a file derived from a cached entry, e.g. the cleaned g-code of one anchor
+        return hashlib.sha256('\0'.join((key,) + tuple(str(p) for p in parts)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + ".gcode")
+
+    def get(self, key, outPath):
+        # Copy the cached file to outPath. Returns False on a miss.
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, outPath)
+            os.utime(path)      # Mark as recently used
+        except FileNotFoundError:
+            return False
+        return True
+
+    def load(self, key):
+        # Contents of a cached entry, or None on a miss
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def record(self, hit):
+        # Count one slicing job. hit is True when Slic3r did not have to run.
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, path):
+        # Copy under a temporary name first so that other workers never read a partial file
+        tmpPath = self._path(key) + "." + str(threading.get_ident()) + ".part"
+        shutil.copyfile(path, tmpPath)
+        os.replace(tmpPath, self._path(key))
+
+    def store(self, key, data):
+        # Same as put() for g-code kept in memory
+        tmpPath = self._path(key) + "." + str(threading.get_ident()) + ".part"
+        with open(tmpPath, "wb") as f:
+            f.write(data)
+        os.replace(tmpPath, self._path(key))
+
+    def evict(self):
+        entries = []
+        totalBytes = 0
+        for entry in os.scandir(self.cacheDir):
+            if entry.is_file() and entry.name.endswith(".gcode"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                totalBytes += stat.st_size
+
+        entries.sort()      # Least recently used first
+        for mtime, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(path)
+            totalBytes -= size
+            self.evictions += 1
+
+        return totalBytes
+
+    def summary(self):
+        return "Slic3r cache: {} hits, {} misses, {} evicted".format(self.hits, self.misses, self.evictions)
@@ -0,0 +1,75 @@
+# STL helpers for exportEngine.py. Binary STL files are read as memory-mapped NumPy record arrays
+# and merged by copying the packed triangle records, without parsing or formatting any text.
+
+import hashlib
+import os
+
+import numpy as np
+
+
+# One triangle of a binary STL file: normal, three vertices and the attribute byte count. 50 bytes.
+stlTriangle = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attr', '<u2')])
+_headerSize = 84    # 80 bytes of header and the triangle count
+
+
+def isBinaryStl(path):
+    # ASCII files start with 'solid', but so do some binary headers. The file size is the reliable check.
+    size = os.path.getsize(path)
+    if size < _headerSize:
+        return False
+    with open(path, "rb") as f:
+        f.seek(80)
+        count = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+    return size == _headerSize + count * stlTriangle.itemsize
+
+
+def readAsciiStl(path):
+    vertices = []
+    with open(path, "r") as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 4 and words[0] == 'vertex':
+                vertices.append([float(words[1]), float(words[2]), float(words[3])])
+
+    triangles = np.zeros(len(vertices) // 3, dtype=stlTriangle)
+    triangles['vertices'] = np.array(vertices, dtype='<f4').reshape(-1, 3, 3)
+    return triangles
+
+
+def readStlTriangles(path):
+    # Triangles of a binary or ASCII STL file. Binary files are memory-mapped, not copied.
+    if not isBinaryStl(path):
+        return readAsciiStl(path)
+    if os.path.getsize(path) == _headerSize:
+        return np.zeros(0, dtype=stlTriangle)
+    return np.memmap(path, dtype=stlTriangle, mode='r', offset=_headerSize)
+
+
+def shapeFingerprint(path, decimals=3):
+    # Hash of the triangles of an stl file moved so that their lowest X and Y are 0, and that lowest XY corner.
+    # Copies of a shape at other XY positions get the same hash. Vertices are rounded to decimals mm and the triangles
+    # are sorted, so the order in which they were exported does not matter. None if the file has no triangles.
+    triangles = readStlTriangles(path)
+    if len(triangles) == 0:
+        return None
+    vertices = np.asarray(triangles['vertices'], dtype=float).reshape(-1, 3)
+    corner = vertices.min(axis=0)
+    corner[2] = 0
+    rounded = np.rint((vertices - corner) * 10 ** decimals).astype(np.int64).reshape(-1, 9)
+    rounded = rounded[np.lexsort(rounded.T[::-1])]
+    return hashlib.sha256(rounded.tobytes()).hexdigest(), corner[:2]
+
+
+def mergeStlFiles(stlPaths, outPath):
+    # Write all triangles of stlPaths into one binary STL file with the triangle count fixed up.
+    allTriangles = [readStlTriangles(path) for path in stlPaths]
+    count = sum(len(triangles) for triangles in allTriangles)
+
+    with open(outPath, "wb") as f:
+        f.write(b'binary STL merged by ExportThread'.ljust(80, b' '))
+        f.write(np.array([count], dtype='<u4').tobytes())
+        for triangles in allTriangles:
+            triangles.tofile(f)
+
+    # Release the memory maps before the files can be overwritten by the next export
+    del allTriangles
@@ -0,0 +1,45 @@
+# Checks of exportEngine.threadGroupLayers: every thread group is laid after the body reaches its height.
+# Run with python -m pytest, or python test_threadGroupLayers.py.
+
+import numpy as np
+
+import benchmark
+import exportEngine
+import gcodeIndex
+
+
+def bodyIndex(layers, layerHeight=0.2):
+    # Layer index of a body with layers at layerHeight, layerHeight * 2, ...
+    z = layerHeight * np.arange(1, layers + 1)
+    starts = np.arange(layers, dtype=np.int64)
+    return gcodeIndex.LayerIndex(starts, z, np.zeros(layers, dtype=np.int16), np.zeros(layers), layers, starts, starts, layers)
+
+
+def test_groupRisesFromGroupBefore():
+    # Group 1 starts where group 0 ended, at z=2, and is laid at z=4
+    nan = [np.nan] * 3
+    lines = np.array([[[0, 0, 0], [60, 30, 2]], [nan, nan],
+                      [[60, 30, 2], [60, 30, 4]], [[60, 30, 4], [15, 150, 4]]], dtype=float)
+    index = bodyIndex(40)
+    layers = exportEngine.threadGroupLayers(lines, index)
+    assert [index.z[layer] for layer in layers] == [index.z[index.layerAtZ(2)], index.z[index.layerAtZ(4)]]
+    assert index.z[layers[1]] > 4
+
+
+def test_chainedGroupsAtRisingHeights():
+    settings = exportEngine.PrintSettings()
+    segments, groups = 40, 8
+    lines, pieces = exportEngine.chainThreadLines(benchmark.synthThreadLines(segments, groups, settings, heightStep=2.0),
+                                                  (settings.threadOriginX, 0, 0))
+    index = bodyIndex(100)
+    layers = exportEngine.threadGroupLayers(lines, index)
+    for group in range(groups):
+        height = 2.0 + group * 2.0
+        assert index.z[layers[group]] > height, 'Thread group {} at z={} is laid after body layer {} at z={}'.format(
+            group, height, layers[group], index.z[layers[group]])
+
+
+if __name__ == '__main__':
+    test_groupRisesFromGroupBefore()
+    test_chainedGroupsAtRisingHeights()
+    print('ok')